@@ -0,0 +1,446 @@
+"""
+    Benchmarks for the distributed key-value store
+
+    Usage:
+        python benchmark.py merge       causal context merge cost vs store size
+        python benchmark.py server      GET/PUT requests per second per server setting
+        python benchmark.py wal         durable writes per second with group commit
+        python benchmark.py storage     heap memory and put/get cost of the storage engines
+        python benchmark.py routing     key to shard lookups per second, uhashring vs routing table
+        python benchmark.py runtime     requests per second of a two shard store, Flask vs asyncio runtime
+        python benchmark.py codec       bytes and CPU per node to node message, JSON vs msgpack
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import requests
+from uhashring import HashRing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'distributed_kvs'))
+
+from shard_node import ShardNodeWrapper
+from wal import WriteAheadLog
+from storage import STORAGE_ENGINES, create_storage
+from routing import RoutingTable
+import codec
+
+
+def make_node():
+    node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800', 1)
+    node.setup_address()
+    node.setup_pototetial_replicas()
+    return node
+
+
+def legacy_combine(node, curr_context, clients_context):
+    """
+    The merge every request used to do: rebuild the whole context, parse
+    every timestamp and rewrite every key of the store
+    """
+    new_context = {**curr_context, **clients_context}
+
+    for key in new_context:
+        if key in curr_context and key in clients_context:
+            if float(clients_context[key]['timestamp']) > float(curr_context[key]['timestamp']):
+                new_context[key] = clients_context[key]
+            else:
+                new_context[key] = curr_context[key]
+
+    for key in new_context:
+        if new_context[key]['doesExist']:
+            node.kv_store.put(key, new_context[key]['value'])
+        else:
+            node.kv_store.delete(key)
+
+    node.causal_context = new_context
+
+
+def time_per_call(function, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(i)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_merge(args):
+    """
+    Time merging a one key context into a node holding N keys
+    """
+    print('{0:>10} {1:>16} {2:>16}'.format('keys', 'legacy us/merge', 'merge us/merge'))
+
+    for size in args.sizes:
+        node = make_node()
+        # contexts used to hold every value, the legacy merge needs its own node
+        legacy_node = make_node()
+
+        for i in range(size):
+            node.handle_causal_context('key{0}'.format(i), 'value{0}'.format(i))
+            node.kv_store.put('key{0}'.format(i), 'value{0}'.format(i))
+
+            legacy_node.causal_context['key{0}'.format(i)] = {'timestamp': node.clock.now(), 'value': 'value{0}'.format(i),
+                                                              'doesExist': True}
+            legacy_node.kv_store.put('key{0}'.format(i), 'value{0}'.format(i))
+
+        def incoming(i):
+            return {'key{0}'.format(i % size): {'timestamp': node.clock.now(), 'value': 'new', 'doesExist': True}}
+
+        legacy = time_per_call(lambda i: legacy_combine(legacy_node, incoming(i), legacy_node.causal_context),
+                               args.iterations)
+        merge = time_per_call(lambda i: node.combine_causal_contexts(incoming(i)), args.iterations)
+
+        print('{0:>10} {1:>16.1f} {2:>16.1f}'.format(size, legacy, merge))
+
+
+def start_node(port, extra_args, view=None, repl_factor=1):
+    """
+    Start a node in a subprocess and wait until it answers
+    :param view: addresses of every node, defaults to a single node store
+    """
+    address = '127.0.0.1:{0}'.format(port)
+    env = dict(os.environ, ADDRESS=address, VIEW=view or address, REPL_FACTOR=str(repl_factor))
+    node_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'distributed_kvs')
+
+    process = subprocess.Popen([sys.executable, 'app.py', '-p', str(port)] + extra_args, cwd=node_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            requests.get('http://{0}/kvs/key-count'.format(address), timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError('node did not start')
+
+
+def run_load(port, method, clients, duration, keys=1000):
+    """
+    Send requests from concurrent clients for a while
+    :return float: requests per second
+    """
+    deadline = time.time() + duration
+    counts = [0] * clients
+
+    def client(index):
+        session = requests.Session()
+        i = 0
+
+        while time.time() < deadline:
+            url = 'http://127.0.0.1:{0}/kvs/keys/key{1}'.format(port, (index * 7919 + i) % keys)
+            body = {'causal-context': {}}
+
+            if method == 'PUT':
+                body['value'] = 'value{0}'.format(i)
+
+            session.request(method, url, json=body, timeout=10)
+            counts[index] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.time()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / (time.time() - start)
+
+
+def bench_server(args):
+    """
+    Requests per second of a single node for each server mode and thread count
+    """
+    settings = [('dev', None)]
+    settings.extend(('production', threads) for threads in args.threads)
+
+    print('{0:>12} {1:>8} {2:>8} {3:>10} {4:>10}'.format('server', 'threads', 'clients', 'PUT/s', 'GET/s'))
+
+    for server, threads in settings:
+        extra_args = ['-s', server]
+        if threads is not None:
+            extra_args.extend(['-t', str(threads)])
+
+        process = start_node(args.port, extra_args)
+
+        try:
+            puts = run_load(args.port, 'PUT', args.clients, args.duration)
+            gets = run_load(args.port, 'GET', args.clients, args.duration)
+        finally:
+            process.kill()
+            process.wait()
+
+        print('{0:>12} {1:>8} {2:>8} {3:>10.0f} {4:>10.0f}'.format(server, threads or '-', args.clients, puts, gets))
+
+
+def bench_runtime(args):
+    """
+    Requests per second of a store of two single replica shards, sent to
+    the first node so about half of the keys are forwarded to the other
+    """
+    ports = [args.port, args.port + 1]
+    view = ','.join('127.0.0.1:{0}'.format(port) for port in ports)
+
+    print('{0:>12} {1:>8} {2:>8} {3:>10} {4:>10}'.format('runtime', 'threads', 'clients', 'PUT/s', 'GET/s'))
+
+    for server in ['production', 'asyncio']:
+        extra_args = ['-s', server, '-t', str(args.threads)]
+        processes = [start_node(port, extra_args, view) for port in ports]
+
+        try:
+            for clients in args.clients:
+                puts = run_load(ports[0], 'PUT', clients, args.duration)
+                gets = run_load(ports[0], 'GET', clients, args.duration)
+
+                print('{0:>12} {1:>8} {2:>8} {3:>10.0f} {4:>10.0f}'.format(server, args.threads, clients, puts, gets))
+        finally:
+            for process in processes:
+                process.kill()
+                process.wait()
+
+
+def cpu_seconds(processes):
+    """
+    User and system CPU time the processes used so far, read from /proc
+    :return float:
+    """
+    total = 0
+
+    for process in processes:
+        with open('/proc/{0}/stat'.format(process.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime, the 14th and 15th fields
+        total += int(fields[11]) + int(fields[12])
+
+    return total / float(os.sysconf('SC_CLK_TCK'))
+
+
+def bench_codec(args):
+    """
+    Bytes and encode plus decode cost of the messages nodes exchange, in
+    JSON and msgpack, then PUTs per second and node CPU per PUT of a three
+    replica shard acknowledging writes after every replica
+    """
+    if not codec.available():
+        print('Error: msgpack is not installed, nothing to compare JSON with')
+        return
+
+    node = make_node()
+    value = 'v' * args.value_size
+
+    for i in range(args.keys):
+        node.handle_causal_context('key{0}'.format(i), value)
+        node.kv_store.put('key{0}'.format(i), value)
+
+    def entries(count):
+        return {'key{0}'.format(i): node.context_entry('key{0}'.format(i)) for i in range(count)}
+
+    messages = [
+        ('forwarded put', {'value': value, 'causal-context': {node.shard_id: node.clock.now()}}),
+        ('replicate 1 key', {'causal-context': entries(1)}),
+        ('replicate 500 keys', {'causal-context': entries(500)}),
+        ('gossip {0} keys'.format(args.keys), node.build_delta(0)),
+    ]
+
+    print('{0:>20} {1:>12} {2:>12} {3:>10} {4:>12} {5:>12}'.format(
+        'message', 'json bytes', 'msgpack', 'saved', 'json us', 'msgpack us'))
+
+    for name, message in messages:
+        iterations = max(args.iterations * 10 // (len(codec.encode(codec.JSON, message)) // 100 + 1), 10)
+        sizes = {}
+        costs = {}
+
+        for content_type in [codec.JSON, codec.MSGPACK]:
+            sizes[content_type] = len(codec.encode(content_type, message))
+            costs[content_type] = time_per_call(
+                lambda i: codec.decode(content_type, codec.encode(content_type, message)), iterations)
+
+        print('{0:>20} {1:>12} {2:>12} {3:>9.0f}% {4:>12.1f} {5:>12.1f}'.format(
+            name, sizes[codec.JSON], sizes[codec.MSGPACK], 100.0 * (1 - sizes[codec.MSGPACK] / sizes[codec.JSON]),
+            costs[codec.JSON], costs[codec.MSGPACK]))
+
+    ports = [args.port, args.port + 1, args.port + 2]
+    view = ','.join('127.0.0.1:{0}'.format(port) for port in ports)
+
+    print()
+    print('{0:>10} {1:>8} {2:>10} {3:>14}'.format('codec', 'clients', 'PUT/s', 'CPU ms/PUT'))
+
+    for name in ['json', 'msgpack']:
+        extra_args = ['-c', name, '-w', 'all']
+        processes = [start_node(port, extra_args, view, repl_factor=3) for port in ports]
+
+        try:
+            # the first answers tell the nodes which codec their peers take
+            run_load(ports[0], 'PUT', 1, 0.5)
+
+            cpu = cpu_seconds(processes)
+            start = time.time()
+            puts = run_load(ports[0], 'PUT', args.clients, args.duration)
+            cpu = cpu_seconds(processes) - cpu
+
+            print('{0:>10} {1:>8} {2:>10.0f} {3:>14.2f}'.format(
+                name, args.clients, puts, cpu * 1000 / (puts * (time.time() - start))))
+        finally:
+            for process in processes:
+                process.kill()
+                process.wait()
+
+
+def bench_wal(args):
+    """
+    Durable writes per second of concurrent writers. Writers waiting on the
+    same fsync are committed together, so throughput grows with writers
+    """
+    print('{0:>8} {1:>12} {2:>16}'.format('writers', 'writes/s', 'records/fsync'))
+
+    for writers in args.writers:
+        directory = tempfile.mkdtemp(dir=args.dir)
+        wal = WriteAheadLog(directory)
+        wal.open()
+        wal.start()
+
+        def writer(index):
+            for i in range(args.writes):
+                ticket = wal.append({'op': 'entry', 'key': 'key{0}'.format(i), 'seq': i, 'entry': {'value': index}})
+                wal.wait(ticket)
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+        start = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - start
+        stats = wal.stats()
+        wal.close()
+        shutil.rmtree(directory)
+
+        print('{0:>8} {1:>12.0f} {2:>16.1f}'.format(writers, writers * args.writes / elapsed, stats['records-per-fsync']))
+
+
+def bench_storage(args):
+    """
+    Python heap used per key and put/get cost of each storage engine
+    """
+    print('{0:>8} {1:>10} {2:>14} {3:>10} {4:>10}'.format('engine', 'keys', 'heap bytes/key', 'put us', 'get us'))
+    padding = 'x' * args.value_size
+
+    for engine in STORAGE_ENGINES:
+        directory = tempfile.mkdtemp(dir=args.dir)
+
+        tracemalloc.start()
+        store = create_storage(engine, directory)
+        put = time_per_call(lambda i: store.put('key{0}'.format(i), '{0}{1}'.format(i, padding)), args.keys)
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        get = time_per_call(lambda i: store.get('key{0}'.format(i)), args.keys)
+
+        store.close()
+        shutil.rmtree(directory)
+
+        print('{0:>8} {1:>10} {2:>14.0f} {3:>10.1f} {4:>10.1f}'.format(engine, args.keys, heap / args.keys, put, get))
+
+
+def bench_routing(args):
+    """
+    Lookups per second of uhashring, of the routing table one key at a
+    time and of route_many, and the cost of building a view's ring
+    """
+    print('{0:>8} {1:>14} {2:>14} {3:>14} {4:>12} {5:>12}'.format(
+        'shards', 'uhashring/s', 'table/s', 'route_many/s', 'build ms', 'table ms'))
+
+    keys = ['key{0}'.format(i) for i in range(args.keys)]
+
+    for shards in args.shards:
+        shard_ids = [str(i) for i in range(1, shards + 1)]
+        partitions = {shard_id: ['127.0.0.1:{0}'.format(13800 + i)] for i, shard_id in enumerate(shard_ids)}
+
+        start = time.perf_counter()
+        ring = HashRing(nodes=shard_ids)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        table = RoutingTable(partitions)
+        table_build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for key in keys:
+            ring.get_node(key)
+        uhashring = len(keys) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for key in keys:
+            table.get_node(key)
+        single = len(keys) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        table.route_many(keys)
+        bulk = len(keys) / (time.perf_counter() - start)
+
+        print('{0:>8} {1:>14.0f} {2:>14.0f} {3:>14.0f} {4:>12.2f} {5:>12.2f}'.format(
+            shards, uhashring, single, bulk, build * 1000, table_build * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the distributed key-value store')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    merge_parser = subparsers.add_parser('merge', help='causal context merge cost vs store size')
+    merge_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    merge_parser.add_argument('--iterations', type=int, default=200)
+    merge_parser.set_defaults(func=bench_merge)
+
+    server_parser = subparsers.add_parser('server', help='GET/PUT requests per second per server setting')
+    server_parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 32])
+    server_parser.add_argument('--clients', type=int, default=32)
+    server_parser.add_argument('--duration', type=float, default=5)
+    server_parser.add_argument('--port', type=int, default=13900)
+    server_parser.set_defaults(func=bench_server)
+
+    wal_parser = subparsers.add_parser('wal', help='durable writes per second with group commit')
+    wal_parser.add_argument('--writers', type=int, nargs='+', default=[1, 4, 16, 64])
+    wal_parser.add_argument('--writes', type=int, default=500, help='writes per writer')
+    wal_parser.add_argument('--dir', default=None, help='directory to put the logs in, defaults to the temp directory')
+    wal_parser.set_defaults(func=bench_wal)
+
+    storage_parser = subparsers.add_parser('storage', help='heap memory and put/get cost of the storage engines')
+    storage_parser.add_argument('--keys', type=int, default=100000)
+    storage_parser.add_argument('--value-size', type=int, default=1000, help='bytes per value')
+    storage_parser.add_argument('--dir', default=None, help='directory to put on-disk engines in, defaults to the temp directory')
+    storage_parser.set_defaults(func=bench_storage)
+
+    routing_parser = subparsers.add_parser('routing', help='key to shard lookups per second, uhashring vs routing table')
+    routing_parser.add_argument('--shards', type=int, nargs='+', default=[2, 8, 32])
+    routing_parser.add_argument('--keys', type=int, default=200000)
+    routing_parser.set_defaults(func=bench_routing)
+
+    runtime_parser = subparsers.add_parser('runtime', help='requests per second of a two shard store, Flask vs asyncio runtime')
+    runtime_parser.add_argument('--threads', type=int, default=8)
+    runtime_parser.add_argument('--clients', type=int, nargs='+', default=[8, 32, 128])
+    runtime_parser.add_argument('--duration', type=float, default=5)
+    runtime_parser.add_argument('--port', type=int, default=13900)
+    runtime_parser.set_defaults(func=bench_runtime)
+
+    codec_parser = subparsers.add_parser('codec', help='bytes and CPU per node to node message, JSON vs msgpack')
+    codec_parser.add_argument('--keys', type=int, default=1000, help='keys of the store and of the gossip delta')
+    codec_parser.add_argument('--value-size', type=int, default=100, help='bytes per value')
+    codec_parser.add_argument('--iterations', type=int, default=1000)
+    codec_parser.add_argument('--clients', type=int, default=16)
+    codec_parser.add_argument('--duration', type=float, default=5)
+    codec_parser.add_argument('--port', type=int, default=13900)
+    codec_parser.set_defaults(func=bench_codec)
+
+    args = parser.parse_args()
+    args.func(args)
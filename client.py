@@ -79,6 +79,36 @@ class Client():
 
         return self.formatResult(result)
 
+    def batch_put(self, items, port):
+        result = requests.put('http://%s:%s/kvs/batch'%(localhost, str(port)),timeout=timeout,
+                              json={'items':items,'causal-context':self.causal_context},
+                              headers = {"Content-Type": "application/json"})
+
+        if self.print_response:
+            print("PUT batch result %s"%str(result.content))
+
+        return self.formatResult(result)
+
+    def batch_get(self, keys, port):
+        result = requests.get('http://%s:%s/kvs/batch'%(localhost, str(port)),timeout=timeout,
+                              json={'keys':list(keys),'causal-context':self.causal_context},
+                              headers = {"Content-Type": "application/json"})
+
+        if self.print_response:
+            print("GET batch result %s"%str(result.content))
+
+        return self.formatResult(result)
+
+    def batch_delete(self, keys, port):
+        result = requests.delete('http://%s:%s/kvs/batch'%(localhost, str(port)),timeout=timeout,
+                                 json={'keys':list(keys),'causal-context':self.causal_context},
+                                 headers = {"Content-Type": "application/json"})
+
+        if self.print_response:
+            print("DELETE batch result %s"%str(result.content))
+
+        return self.formatResult(result)
+
     # this just turns the requests result object into a simplified json object
     # containing only fields I care about
     def formatResult(self, result):
@@ -0,0 +1,463 @@
+"""
+    asyncio runtime of a node, started with -s asyncio. The node's routes
+    are served by aiohttp on one event loop. Key requests for other shards
+    are forwarded, replication batches and gossip rounds sent and view
+    change phases broadcast by coroutines, so waiting on a slow peer holds a
+    coroutine instead of a worker thread. The other routes run the node's
+    Flask views in a thread pool, so both runtimes serve the same routes
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import re
+import time
+import aiohttp
+from aiohttp import web
+import requests
+from werkzeug.test import EnvironBuilder
+from health import PeerUnavailable, PROBE, REJECT
+from replication import ReplicationPipeline, acknowledged, retriable
+import codec
+import myconstants
+
+# headers aiohttp sets itself
+HOP_HEADERS = {'content-length', 'transfer-encoding', 'connection'}
+
+
+class AsyncResponse(object):
+    """
+        Answer of a peer, with the parts of requests.Response the node uses
+    """
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        if self.headers.get('Content-Type', '').startswith(codec.MSGPACK):
+            return codec.decode(codec.MSGPACK, self.content)
+
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('{0} Error'.format(self.status_code))
+
+
+class AsyncTransport(object):
+    """
+        Node to node requests with aiohttp. Peer health, timeouts and
+        encodings are the ones of the node's PeerTransport, and errors are
+        raised as the requests exceptions, so callers keep their error handling
+    """
+    def __init__(self, transport, connections=myconstants.ASYNC_PEER_CONNECTIONS):
+        """
+        :param transport: PeerTransport of the node
+        :param connections: max open connections per peer
+        """
+        self.transport = transport
+        self.health = transport.health
+        self.connections = connections
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.connections)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def request(self, method, node_address, path, timeout=None, **kwargs):
+        """
+        Send a request to another node
+        :param timeout: optional seconds overriding the peer's timeout
+        :param kwargs: json, data, headers or params of the request
+        :return AsyncResponse:
+        """
+        decision = self.health.before(node_address)
+
+        if decision == REJECT:
+            raise PeerUnavailable('Node {0} is down'.format(node_address))
+
+        if timeout is None:
+            if decision == PROBE:
+                timeout = myconstants.BREAKER_PROBE_TIMEOUT
+            else:
+                timeout = self.transport.timeouts.get(node_address, self.transport.timeout)
+
+        kwargs = self.transport.prepare(node_address, path, kwargs)
+
+        try:
+            async with self.session.request(method, self.transport.url(node_address, path),
+                                            timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as resp:
+                content = await resp.read()
+        except asyncio.TimeoutError:
+            self.health.failure(node_address)
+            raise requests.Timeout('Node {0} did not answer in time'.format(node_address))
+        except aiohttp.ClientConnectionError as error:
+            self.health.failure(node_address)
+            raise requests.exceptions.ConnectionError(str(error))
+        except aiohttp.ClientError as error:
+            self.health.success(node_address)
+            raise requests.exceptions.RequestException(str(error))
+
+        self.health.success(node_address)
+        self.transport.learn(node_address, resp.headers)
+
+        return AsyncResponse(resp.status, content, resp.headers)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncReplicationPipeline(ReplicationPipeline):
+    """
+        Replication pipeline whose senders are tasks on the event loop.
+        Writes are still queued by the threads running the Flask views.
+        Batches are settled on the loop, as those threads may all be waiting
+        for them, and hints are written by a thread of their own
+    """
+    def __init__(self, transport, handoff, loop):
+        """
+        :param transport: AsyncTransport the batches are sent with
+        :param loop: event loop the senders run on
+        """
+        ReplicationPipeline.__init__(self, transport, handoff)
+        self.loop = loop
+        self.hint_executor = ThreadPoolExecutor(max_workers=1)
+
+    def start_sender(self, queue):
+        queue.event = asyncio.Event()
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.sender(queue))
+
+    def wake(self, queue):
+        self.loop.call_soon_threadsafe(queue.event.set)
+
+    async def sender(self, queue):
+        while True:
+            await queue.event.wait()
+            queue.event.clear()
+
+            if queue.closed:
+                return
+
+            while True:
+                with queue.cond:
+                    batch = self.take(queue)
+
+                if not batch:
+                    break
+
+                payload = self.payload(batch)
+                hint = True
+
+                try:
+                    resp = await self.transport.request('PUT', queue.node_address, 'proxy/replicate-batch',
+                                                        json=payload)
+                    acked = acknowledged(resp)
+                    hint = retriable(resp)
+                except (requests.Timeout, requests.exceptions.ConnectionError):
+                    print('Error: we were not able to communicate with another replica')
+                    acked = False
+                except Exception as error:
+                    print('Error: was not able to send a batch to node {0} {1}'.format(queue.node_address, error))
+                    acked = False
+
+                try:
+                    self.settle(queue, batch, payload, acked, hint)
+                except Exception as error:
+                    print('Error: replicating to node {0} failed {1}'.format(queue.node_address, error))
+
+    def hint(self, queue, payload):
+        # appending to a hint file blocks, the writes waiting are already settled
+        if self.handoff is not None:
+            self.hint_executor.submit(self.handoff.hint, queue.node_address, payload['causal-context'])
+
+
+class AsyncNodeRuntime(object):
+    """
+        Serves a ShardNodeWrapper with aiohttp. The routes are the ones of
+        the node's Flask app, /kvs/keys/<key> forwards to other shards by
+        itself and every other route calls its Flask view in a worker thread
+    """
+    def __init__(self, node, threads=myconstants.SERVER_THREADS):
+        """
+        :param node: ShardNodeWrapper set up with its routes, address and view
+        :param threads: worker threads running Flask views and blocking work
+        """
+        self.node = node
+        self.transport = AsyncTransport(node.transport)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.loop = None
+
+    def serve(self, host, port):
+        """
+        Start the runtime and serve until the process stops
+        :return None:
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+
+        self.loop.run_until_complete(self.start(host, port))
+
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.loop.run_until_complete(self.transport.close())
+
+    async def start(self, host, port):
+        node = self.node
+
+        await self.transport.start()
+
+        # the runtime takes over replication, view change fan-out and gossip
+        node.replicator.pipeline = AsyncReplicationPipeline(self.transport, node.handoff, self.loop)
+        node.coordinator.broadcast = self.broadcast
+        node.coordinator.key_counts = self.key_counts
+        node.gossip.stop()
+        self.loop.create_task(self.gossip_loop())
+
+        app = web.Application(client_max_size=myconstants.ASYNC_MAX_BODY)
+        self.add_routes(app)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+
+        site = web.TCPSite(runner, host, port, backlog=myconstants.SERVER_CONNECTION_LIMIT)
+        await site.start()
+
+    def add_routes(self, app):
+        """
+        Route every rule of the node's Flask app
+        :return None:
+        """
+        native = {'keys': self.keys}
+
+        for rule in self.node.app.url_map.iter_rules():
+            if rule.endpoint == 'static':
+                continue
+
+            # /kvs/keys/<string:key> -> /kvs/keys/{key}
+            path = re.sub(r'<(?:\w+:)?(\w+)>', r'{\1}', rule.rule)
+            handler = native.get(rule.endpoint, self.flask)
+
+            for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+                app.router.add_route(method, path, handler)
+
+    async def flask(self, request):
+        """
+        Answer a request with the node's Flask view, run in a worker thread.
+        Responses without a length, e.g. streamed scans, are streamed a chunk at a time
+        :return web.StreamResponse:
+        """
+        body = await request.read()
+        headers = [(name, value) for name, value in request.headers.items() if name.lower() not in HOP_HEADERS]
+
+        status, response_headers, app_iter = await self.loop.run_in_executor(
+            self.executor, self.call_view, request.method, request.path, request.rel_url.raw_query_string,
+            headers, body)
+
+        streamed = not any(name.lower() == 'content-length' for name, _ in response_headers)
+        response_headers = [(name, value) for name, value in response_headers if name.lower() not in HOP_HEADERS]
+        chunks = iter(app_iter)
+
+        try:
+            if not streamed:
+                content = await self.loop.run_in_executor(self.executor, b''.join, chunks)
+                return web.Response(body=content, status=status, headers=response_headers)
+
+            response = web.StreamResponse(status=status, headers=response_headers)
+            await response.prepare(request)
+
+            while True:
+                chunk = await self.loop.run_in_executor(self.executor, next, chunks, None)
+
+                if chunk is None:
+                    break
+                if chunk:
+                    await response.write(chunk)
+
+            await response.write_eof()
+
+            return response
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def call_view(self, method, path, query_string, headers, body):
+        """
+        Call the node's Flask app with a WSGI environ of the request
+        :return (int, list, iterable): status, headers and body chunks
+        """
+        environ = EnvironBuilder(path=path, method=method, query_string=query_string, headers=headers,
+                                 data=body).get_environ()
+        started = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = response_headers
+
+        app_iter = self.node.app(environ, start_response)
+
+        return started['status'], started['headers'], app_iter
+
+    async def keys(self, request):
+        """
+        /kvs/keys/<key>. A key of another shard is forwarded by a coroutine,
+        keys of this shard and keys during a view change go to the Flask view
+        :return web.Response:
+        """
+        node = self.node
+        key = request.match_info['key']
+        shard_id = node.currentHashRing.get_node(key)
+
+        if shard_id == node.shard_id or node.transition is not None or node.pending_view is not None:
+            return await self.flask(request)
+
+        body = await request.read()
+
+        try:
+            contents = json.loads(body) if body else {}
+        except ValueError:
+            contents = {}
+
+        if not isinstance(contents, dict):
+            contents = {}
+
+        token = node.context_token(contents)
+
+        for node_address in node.selector.order(node.all_partitions[shard_id]):
+            start = node.selector.begin(node_address)
+
+            try:
+                resp = await self.transport.request(request.method, node_address, 'proxy/kvs/keys/' + key,
+                                                    json=contents, headers={'Accept': codec.JSON})
+            except (requests.Timeout, requests.exceptions.ConnectionError):
+                node.selector.end(node_address, start)
+                continue
+
+            node.selector.record(node_address, node.selector.end(node_address, start))
+
+            return web.Response(body=resp.content, status=resp.status_code, content_type='application/json')
+
+        response = {}
+        response['message'] = node.error_message(request.method)
+        response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+        response['causal-context'] = token
+
+        return web.json_response(response, status=503)
+
+    def broadcast(self, phase, nodes, body):
+        """
+        ViewChangeCoordinator.broadcast, called from the thread running the
+        view change: the phase is sent to every node by coroutines
+        :return dict: node -> answer, None for nodes which failed
+        """
+        return asyncio.run_coroutine_threadsafe(self.broadcast_async(phase, nodes, body), self.loop).result()
+
+    async def broadcast_async(self, phase, nodes, body):
+        coordinator = self.node.coordinator
+
+        async def run(node_address):
+            coordinator.update(node_address, phase, 'running')
+            start = time.time()
+
+            try:
+                if node_address == coordinator.address:
+                    answer = await self.loop.run_in_executor(self.executor, coordinator.local[phase], body)
+                else:
+                    timeout = coordinator.commit_timeout if phase == 'commit' else None
+                    resp = await self.transport.request('PUT', node_address, 'proxy/view-change/' + phase,
+                                                        json=body, timeout=timeout)
+                    resp.raise_for_status()
+                    answer = resp.json()
+
+                coordinator.update(node_address, phase, 'done', (time.time() - start) * 1000.0, answer)
+                return answer
+            except (requests.exceptions.RequestException, ValueError) as error:
+                print('Error: {0} of view change failed on {1}'.format(phase, node_address))
+                coordinator.update(node_address, phase, 'failed', (time.time() - start) * 1000.0,
+                                   {'error': str(error)})
+                return None
+
+        answers = await asyncio.gather(*(run(node_address) for node_address in nodes))
+
+        return dict(zip(nodes, answers))
+
+    def key_counts(self, partitions):
+        """
+        ViewChangeCoordinator.key_counts with one coroutine per shard
+        :return dict: shard_id -> key count, None if no replica answered
+        """
+        return asyncio.run_coroutine_threadsafe(self.key_counts_async(partitions), self.loop).result()
+
+    async def key_counts_async(self, partitions):
+        async def count(replicas):
+            for node_address in replicas:
+                try:
+                    resp = await self.transport.request('GET', node_address, 'kvs/key-count')
+                    return resp.json()['key-count']
+                except (requests.exceptions.RequestException, ValueError, KeyError):
+                    print('Not able to get key count of annother shard')
+
+            return None
+
+        shard_ids = list(partitions)
+        counts = await asyncio.gather(*(count(partitions[shard_id]) for shard_id in shard_ids))
+
+        return dict(zip(shard_ids, counts))
+
+    async def gossip_loop(self):
+        """
+        Gossip rounds of the node's GossipScheduler, every interval with jitter
+        :return None:
+        """
+        gossip = self.node.gossip
+
+        while True:
+            await asyncio.sleep(gossip.interval * random.uniform(1 - gossip.jitter, 1 + gossip.jitter))
+
+            try:
+                await self.gossip_round()
+            except Exception as error:
+                print('Error: gossip round failed {0}'.format(error))
+
+    async def gossip_round(self):
+        """
+        Push the changes of this node to every selected replica at once
+        :return dict: counters of the round
+        """
+        gossip = self.node.gossip
+        start = time.time()
+        round_stats = gossip.new_round()
+
+        async def push(peer):
+            # building a payload waits for the write-ahead log
+            payload = await self.loop.run_in_executor(self.executor, gossip.build_payload, peer)
+
+            if payload is None:
+                return
+
+            content_type, body = self.transport.transport.encode(peer, payload)
+
+            try:
+                resp = await self.transport.request('PUT', peer, 'proxy/node-causal-context', data=body,
+                                                    headers={'Content-Type': content_type})
+                resp.raise_for_status()
+            except requests.exceptions.RequestException:
+                gossip.failed(peer, round_stats)
+                return
+
+            gossip.succeeded(peer, payload, body, resp, round_stats)
+
+        await asyncio.gather(*(push(peer) for peer in gossip.select_peers()))
+
+        # merkle repair rounds use the blocking transport
+        return await self.loop.run_in_executor(self.executor, gossip.finish_round, round_stats, start)
@@ -11,6 +11,9 @@ from flask import jsonify
 import argparse
 import os
 from shard_node import ShardNodeWrapper
+from replication import ACK_POLICIES
+from storage import STORAGE_ENGINES
+import myconstants
 
 def handle_args():
     """
@@ -30,6 +33,27 @@ def handle_args():
     parser.add_argument('-r', '--repl-factor', dest='repl_factor', type=int, default=1,
          help='Argument used to determine the replication factor for the distributed key-value store')
 
+    parser.add_argument('-w', '--write-ack', dest='write_ack', default=myconstants.DEFAULT_WRITE_ACK, choices=ACK_POLICIES,
+         help='When to acknowledge a write: after the local write, one replica, a quorum or all replicas. Value defaults to local')
+
+    parser.add_argument('-g', '--gossip-interval', dest='gossip_interval', type=float, default=myconstants.GOSSIP_INTERVAL,
+         help='Seconds between gossip rounds with the other replicas of the shard. Value defaults to 2')
+
+    parser.add_argument('-s', '--server', dest='server', default=myconstants.DEFAULT_SERVER, choices=['dev', 'production', 'asyncio'],
+         help='Server to run the node under: the Flask development server, a multi-threaded production server or the asyncio runtime (needs aiohttp). Value defaults to production')
+
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=myconstants.SERVER_THREADS,
+         help='Number of threads handling requests with the production server, or running Flask views with the asyncio runtime. Value defaults to 16')
+
+    parser.add_argument('-d', '--data-dir', dest='data_dir', default=None,
+         help='Directory of the write-ahead log and snapshots the node recovers from after a restart. Data is only kept in memory if no directory is provided')
+
+    parser.add_argument('-e', '--storage', dest='storage', default=myconstants.DEFAULT_STORAGE, choices=STORAGE_ENGINES,
+         help='Storage engine: keep keys and values in memory, or values in a memory-mapped file for stores larger than memory. Value defaults to memory')
+
+    parser.add_argument('-c', '--codec', dest='codec', default=myconstants.DEFAULT_CODEC, choices=myconstants.CODECS,
+         help='Encoding of requests between nodes: msgpack with nodes which take it (needs msgpack), or always JSON. Clients always talk JSON. Value defaults to msgpack')
+
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -37,11 +61,17 @@ if __name__ == '__main__':
         Code main entrance
     """
     args = handle_args()
-    app = ShardNodeWrapper(args.ip, args.port, args.view, args.repl_factor)
+    app = ShardNodeWrapper(args.ip, args.port, args.view, args.repl_factor, args.write_ack,
+                           args.gossip_interval, args.data_dir, args.storage)
     app.setup_routes()
+    app.setup_codec(args.codec)
     app.setup_address()
     app.setup_view()
     app.setup_repl_factor()
+    app.setup_write_ack()
     app.setup_pototetial_replicas()
+    app.setup_storage()
+    app.setup_wal()
+    app.setup_hints()
     app.setup_gossip()
-    app.run()
+    app.run(args.server, args.threads)
@@ -0,0 +1,79 @@
+"""
+    Per-node change log. Every change to the causal context gets a
+    sequence number so gossip can send only what a peer has not seen yet
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class ChangeLog(object):
+    """
+        Keys ordered by the sequence number of their latest change. A key
+        written again moves to the end, so the log holds one entry per key
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.entries = OrderedDict()    # key -> seq of latest change
+
+    def record(self, key):
+        """
+        Record a change to a key
+        :param key: key that changed
+        :return int: sequence number of the change
+        """
+        with self.lock:
+            self.seq += 1
+            self.entries[key] = self.seq
+            self.entries.move_to_end(key)
+
+            return self.seq
+
+    def since(self, seq):
+        """
+        Keys changed after a sequence number, walking back from the newest
+        change so the cost is proportional to the number of changes
+        :param seq: last sequence number the caller has seen
+        :return (list, int): changed keys oldest first, current sequence number
+        """
+        with self.lock:
+            keys = []
+
+            for key in reversed(self.entries):
+                if self.entries[key] <= seq:
+                    break
+                keys.append(key)
+
+            keys.reverse()
+
+            return keys, self.seq
+
+    def items(self):
+        """
+        Keys and the sequence number of their latest change, oldest first
+        :return list of (key, seq):
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def restore(self, key, seq):
+        """
+        Re-add a change read back from the write-ahead log, keeping its
+        sequence number so peers' watermarks stay valid across a restart
+        :param key: key that changed
+        :param seq: sequence number the change had
+        :return None:
+        """
+        with self.lock:
+            self.seq = max(self.seq, seq)
+            self.entries[key] = seq
+            self.entries.move_to_end(key)
+
+    def reset(self):
+        """
+        Forget all changes, used when the causal context is reset
+        :return None:
+        """
+        with self.lock:
+            self.entries = OrderedDict()
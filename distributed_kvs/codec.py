@@ -0,0 +1,119 @@
+"""
+    Encoding of node to node requests. Nodes talk JSON until a peer lists
+    msgpack in the X-Kvs-Codecs header of its answers, from then on the
+    bodies of /proxy/* requests to that peer and its answers are msgpack.
+    msgpack is optional, nodes without it keep talking JSON. The /kvs/*
+    API clients use is always JSON
+"""
+
+import json
+import flask
+from flask import Request, request, has_request_context
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+CODECS_HEADER = 'X-Kvs-Codecs'      # codecs a node takes besides JSON
+
+# asking a peer for msgpack, JSON is still fine
+ACCEPT_MSGPACK = MSGPACK + ', ' + JSON + ';q=0.5'
+
+
+def available():
+    """
+    Whether msgpack is installed
+    :return bool:
+    """
+    return msgpack is not None
+
+
+def encode(content_type, obj):
+    """
+    Body of a request or answer
+    :param content_type: JSON or MSGPACK
+    :return bytes:
+    """
+    if content_type == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    return json.dumps(obj).encode('utf-8')
+
+
+def decode(content_type, body):
+    """
+    Object of a request or answer body
+    :param content_type: JSON or MSGPACK
+    :return object:
+    """
+    if content_type == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+
+    return json.loads(body)
+
+
+class NodeRequest(Request):
+    """
+        Flask request whose get_json also decodes msgpack bodies, so views
+        read requests of peers the same way whatever their encoding
+    """
+    msgpack_body = None
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK or msgpack is None:
+            return Request.get_json(self, force=force, silent=silent, cache=cache)
+
+        if self.msgpack_body is not None:
+            return self.msgpack_body
+
+        try:
+            body = decode(MSGPACK, self.get_data(cache=cache))
+        except ValueError as error:
+            if silent:
+                return None
+            return self.on_json_loading_failed(error)
+
+        if cache:
+            self.msgpack_body = body
+
+        return body
+
+
+def wants_msgpack():
+    """
+    Whether the request being served asked for a msgpack answer
+    :return bool:
+    """
+    if msgpack is None or not has_request_context():
+        return False
+
+    # JSON first, so */* still gets JSON
+    return request.accept_mimetypes.best_match([JSON, MSGPACK]) == MSGPACK
+
+
+def jsonify(*args, **kwargs):
+    """
+    flask.jsonify, except that peers which asked for msgpack get msgpack
+    :return flask.Response:
+    """
+    if not wants_msgpack():
+        return flask.jsonify(*args, **kwargs)
+
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+
+    if len(args) == 1:
+        obj = args[0]
+    else:
+        obj = list(args) or kwargs
+
+    try:
+        body = encode(MSGPACK, obj)
+    except (OverflowError, TypeError, ValueError):
+        # e.g. ints of 64 bits and more, JSON takes them
+        return flask.jsonify(*args, **kwargs)
+
+    return flask.current_app.response_class(body, mimetype=MSGPACK)
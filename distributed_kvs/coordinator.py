@@ -0,0 +1,180 @@
+"""
+    Two-phase view change coordination. The node which receives the view
+    change broadcasts every phase to all nodes at once, so a view change
+    takes as long as the slowest node rather than the sum of all nodes
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import requests
+import myconstants
+
+
+class ViewChangeCoordinator(object):
+    """
+        Runs a view change in two phases:
+            prepare     every node checks the new view and keeps it aside
+            commit      every node switches to the new view, sends the keys
+                        changing owner and answers once they were acknowledged
+        followed by finish, once every node sent its keys, where nodes forget
+        the old view and drop the keys which moved away. If a node of the new view cannot prepare, the prepared nodes are told
+        to abort and the view stays as it was. If a node could not send all of
+        its keys, the nodes are told to abort after the commit too: they go
+        back to the old view, which still holds every key
+    """
+    def __init__(self, transport, address, prepare_local, commit_local, finish_local, abort_local,
+                 max_workers=myconstants.VIEW_CHANGE_WORKERS, commit_timeout=myconstants.VIEW_CHANGE_COMMIT_TIMEOUT):
+        """
+        :param transport: PeerTransport used to contact the other nodes
+        :param address: address of this node, its phases run in process
+        :param prepare_local: function(body) -> dict, prepare phase of this node
+        :param commit_local: function(body) -> dict, commit phase of this node
+        :param finish_local: function(body) -> dict, finish of this node
+        :param abort_local: function(body) -> dict, abort of this node
+        """
+        self.transport = transport
+        self.address = address
+        self.local = {'prepare': prepare_local, 'commit': commit_local, 'finish': finish_local, 'abort': abort_local}
+        self.commit_timeout = commit_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def call(self, phase, node_address, body):
+        """
+        Run a phase on a node
+        :return dict: the node's answer
+        """
+        if node_address == self.address:
+            return self.local[phase](body)
+
+        timeout = self.commit_timeout if phase == 'commit' else self.transport.timeout
+        resp = self.transport.put(node_address, 'proxy/view-change/' + phase, json=body, timeout=timeout)
+        resp.raise_for_status()
+
+        return resp.json()
+
+    def broadcast(self, phase, nodes, body):
+        """
+        Run a phase on all nodes at once, recording each node's progress
+        :return dict: node -> answer, None for nodes which failed
+        """
+        def run(node_address):
+            self.update(node_address, phase, 'running')
+            start = time.time()
+
+            try:
+                answer = self.call(phase, node_address, body)
+                self.update(node_address, phase, 'done', (time.time() - start) * 1000.0, answer)
+                return answer
+            except (requests.exceptions.RequestException, ValueError) as error:
+                print('Error: {0} of view change failed on {1}'.format(phase, node_address))
+                self.update(node_address, phase, 'failed', (time.time() - start) * 1000.0, {'error': str(error)})
+                return None
+
+        futures = {node_address: self.executor.submit(run, node_address) for node_address in nodes}
+
+        return {node_address: future.result() for node_address, future in futures.items()}
+
+    def update(self, node_address, phase, progress, ms=None, answer=None):
+        with self.lock:
+            node = self.state['nodes'].setdefault(node_address, {})
+            node['phase'] = phase
+            node['progress'] = progress
+
+            if ms is not None:
+                node[phase + '-ms'] = ms
+            if answer:
+                node.update(answer)
+
+    def run(self, body, nodes):
+        """
+        Run a view change
+        :param body: view change sent to every phase, with 'view', 'repl-factor' and 'view-id'
+        :param nodes: every node of the old and new view
+        :return bool: True if the view change finished, False if it was aborted
+        """
+        new_view = body['view'].split(',')
+        start = time.time()
+
+        with self.lock:
+            self.state = {'view-id': body['view-id'], 'view': body['view'], 'phase': 'prepare',
+                          'started': start, 'nodes': {}}
+
+        answers = self.broadcast('prepare', nodes, body)
+        prepared = [node_address for node_address in nodes if answers[node_address] is not None]
+        missing = [node_address for node_address in new_view if answers.get(node_address) is None]
+
+        if missing:
+            return self.abort(body, prepared, start, 'Nodes of the new view are unreachable')
+
+        self.set_phase('commit')
+
+        commit_body = dict(body)
+        commit_body['alive'] = prepared
+        answers = self.broadcast('commit', prepared, commit_body)
+
+        # finishing drops the keys which moved away, even those which never arrived
+        if not all(answers[node_address] and answers[node_address].get('migrated') for node_address in prepared):
+            return self.abort(body, prepared, start, 'Keys of the view change could not be migrated')
+
+        self.set_phase('finish')
+        self.broadcast('finish', prepared, body)
+
+        self.set_phase('done', start)
+
+        return True
+
+    def abort(self, body, nodes, start, error):
+        """
+        Tell the nodes to forget the view change, committed or not
+        :param error: why the view change was aborted
+        :return bool: False
+        """
+        with self.lock:
+            self.state['error'] = error
+
+        self.set_phase('abort')
+        self.broadcast('abort', nodes, body)
+        self.set_phase('aborted', start)
+
+        return False
+
+    def set_phase(self, phase, start=None):
+        with self.lock:
+            self.state['phase'] = phase
+            if start is not None:
+                self.state['total-ms'] = (time.time() - start) * 1000.0
+
+    def key_counts(self, partitions):
+        """
+        Ask one replica of every shard for its key count, all shards at once
+        :param partitions: shard_id -> replicas
+        :return dict: shard_id -> key count, None if no replica answered
+        """
+        def count(replicas):
+            for node_address in replicas:
+                try:
+                    resp = self.transport.get(node_address, 'kvs/key-count')
+                    return resp.json()['key-count']
+                except (requests.exceptions.RequestException, ValueError, KeyError):
+                    print('Not able to get key count of annother shard')
+
+            return None
+
+        futures = {shard_id: self.executor.submit(count, replicas) for shard_id, replicas in partitions.items()}
+
+        return {shard_id: future.result() for shard_id, future in futures.items()}
+
+    def status(self):
+        """
+        Progress and timing of the latest view change
+        :return dict:
+        """
+        with self.lock:
+            status = dict(self.state)
+            status['nodes'] = {node_address: dict(node) for node_address, node in self.state.get('nodes', {}).items()}
+
+            return status
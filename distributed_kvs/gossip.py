@@ -0,0 +1,229 @@
+"""
+    In-process anti-entropy scheduler. Periodically pushes the changes
+    of this node's causal context to the other replicas of its shard
+"""
+
+import random
+import threading
+import time
+import requests
+import myconstants
+
+
+class GossipScheduler(object):
+    """
+        Background thread running gossip rounds every interval (with jitter).
+        Peers that could not be reached are backed off exponentially
+    """
+    def __init__(self, transport, get_peers, build_payload, handle_reply=None, repair=None,
+                 interval=myconstants.GOSSIP_INTERVAL, fanout=myconstants.GOSSIP_FANOUT,
+                 jitter=myconstants.GOSSIP_JITTER, max_backoff=myconstants.GOSSIP_MAX_BACKOFF,
+                 repair_every=myconstants.MERKLE_REPAIR_ROUNDS):
+        """
+        :param transport: PeerTransport used to contact peers
+        :param get_peers: function returning the addresses of the other replicas
+        :param build_payload: function(peer) returning the json body to send to a peer
+        :param handle_reply: optional function(peer, payload, response) called on success
+        :param repair: optional function(peer) returning the number of keys it repaired,
+                       run against the peers of every repair_every-th round
+        """
+        self.transport = transport
+        self.get_peers = get_peers
+        self.build_payload = build_payload
+        self.handle_reply = handle_reply
+        self.interval = interval
+        self.fanout = fanout
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.repair = repair
+        self.repair_every = repair_every
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.failures = {}          # peer -> consecutive failed rounds
+        self.next_attempt = {}      # peer -> time before which the peer is skipped
+
+        self.rounds = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.last_round = {}
+        self.repairs = 0
+        self.repaired_keys = 0
+
+    def start(self):
+        """
+        Start the gossip thread
+        :return None:
+        """
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='gossip')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        """
+        Gossip loop, sleeps a jittered interval between rounds so replicas
+        started together do not gossip in lock step
+        """
+        while not self.stop_event.is_set():
+            delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+            if self.stop_event.wait(delay):
+                break
+
+            try:
+                self.run_round()
+            except Exception as error:
+                print('Error: gossip round failed {0}'.format(error))
+
+    def select_peers(self):
+        """
+        Pick up to fanout random peers which are not backed off
+        :return list:
+        """
+        now = time.time()
+        peers = self.get_peers()
+
+        # the back-off state is also changed by rounds /proxy/handle-gossip runs
+        with self.lock:
+            peers = [peer for peer in peers if self.next_attempt.get(peer, 0) <= now]
+
+        random.shuffle(peers)
+
+        if self.fanout > 0:
+            peers = peers[:self.fanout]
+
+        return peers
+
+    def run_round(self):
+        """
+        Run one gossip round
+        :return dict: counters of the round
+        """
+        start = time.time()
+        round_stats = self.new_round()
+
+        for peer in self.select_peers():
+            payload = self.build_payload(peer)
+
+            if payload is None:
+                continue
+
+            content_type, body = self.transport.encode(peer, payload)
+
+            try:
+                resp = self.transport.put(peer, 'proxy/node-causal-context', data=body,
+                                          headers={'Content-Type': content_type})
+                resp.raise_for_status()
+            except requests.exceptions.RequestException:
+                self.failed(peer, round_stats)
+                continue
+
+            self.succeeded(peer, payload, body, resp, round_stats)
+
+        return self.finish_round(round_stats, start)
+
+    def new_round(self):
+        return {'peers': [], 'failed': [], 'bytes-sent': 0, 'bytes-received': 0}
+
+    def failed(self, peer, round_stats):
+        """
+        Back a peer off after it could not be reached during a round
+        :return None:
+        """
+        print('Error: Was not able to reach node {0} when gossiping'.format(peer))
+        self.backoff(peer)
+        round_stats['failed'].append(peer)
+
+    def succeeded(self, peer, payload, body, resp, round_stats):
+        """
+        Count a payload a peer acknowledged and hand its reply over
+        :param body: encoded payload sent
+        :return None:
+        """
+        with self.lock:
+            self.failures.pop(peer, None)
+            self.next_attempt.pop(peer, None)
+
+        round_stats['peers'].append(peer)
+        round_stats['bytes-sent'] += len(body)
+        round_stats['bytes-received'] += len(resp.content)
+
+        if self.handle_reply is not None:
+            self.handle_reply(peer, payload, resp)
+
+    def finish_round(self, round_stats, start):
+        """
+        Repair from the peers reached if it is a repair round, and record the round
+        :return dict: counters of the round
+        """
+        with self.lock:
+            repair_round = self.repair is not None and self.repair_every > 0 and \
+                (self.rounds + 1) % self.repair_every == 0
+
+        if repair_round:
+            round_stats['repaired-keys'] = 0
+
+            for peer in round_stats['peers']:
+                try:
+                    round_stats['repaired-keys'] += self.repair(peer)
+                except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+                    # e.g. a malformed answer, the round must still be counted
+                    print('Error: Was not able to repair from node {0}'.format(peer))
+
+        round_stats['latency-ms'] = (time.time() - start) * 1000.0
+
+        with self.lock:
+            self.rounds += 1
+            if repair_round:
+                self.repairs += 1
+                self.repaired_keys += round_stats['repaired-keys']
+            self.bytes_sent += round_stats['bytes-sent']
+            self.bytes_received += round_stats['bytes-received']
+            self.last_round = round_stats
+
+        return round_stats
+
+    def backoff(self, peer):
+        """
+        Skip a peer for interval * 2^(failures - 1) seconds, capped at max_backoff.
+        The cap is kept small so a healed partition converges within a few rounds
+        :return None:
+        """
+        with self.lock:
+            failures = self.failures.get(peer, 0) + 1
+            self.failures[peer] = failures
+            self.next_attempt[peer] = time.time() + min(self.interval * (2 ** (failures - 1)), self.max_backoff)
+
+    def reset(self):
+        """
+        Forget peer back-off state, used when the view changes
+        :return None:
+        """
+        with self.lock:
+            self.failures = {}
+            self.next_attempt = {}
+
+    def stats(self):
+        """
+        Gossip counters
+        :return dict:
+        """
+        with self.lock:
+            return {
+                'interval': self.interval,
+                'rounds': self.rounds,
+                'repairs': self.repairs,
+                'repaired-keys': self.repaired_keys,
+                'bytes-sent': self.bytes_sent,
+                'bytes-received': self.bytes_received,
+                'backed-off': dict(self.next_attempt),
+                'last-round': self.last_round
+            }
@@ -0,0 +1,318 @@
+"""
+    Hinted handoff. Writes a replica missed because it could not be reached
+    are kept as hints, one queue per replica, and replayed to it in batches
+    once its breaker lets requests through again. A key keeps only its
+    newest hint, so a replica which was away for a while gets every key once
+"""
+
+from collections import OrderedDict
+import json
+import os
+import threading
+import requests
+import myconstants
+
+
+class HintQueue(object):
+    """
+        Hints of one replica, oldest first. With a path every hint is also
+        appended to an NDJSON file, so hints outlive a restart of this node
+    """
+    def __init__(self, node_address, max_keys=myconstants.HINT_MAX_KEYS, path=None):
+        """
+        :param node_address: replica the hints are for
+        :param max_keys: keys kept, the oldest hints are dropped beyond it
+        :param path: optional file the hints are appended to
+        """
+        self.node_address = node_address
+        self.max_keys = max_keys
+        self.path = path
+
+        self.entries = OrderedDict()    # key -> causal context entry
+        self.hinted = 0                 # entries added
+        self.replayed = 0               # entries the replica acknowledged
+        self.dropped = 0                # entries dropped because the queue was full
+        self.lines = 0                  # lines in the file
+
+        self.file = None
+
+        if path is not None:
+            self.load()
+            self.file = open(path, 'a')
+
+    def load(self):
+        """
+        Read the hints of the file, the last line of a key wins
+        :return None:
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # torn last line of a crash
+                    break
+
+                self.put(item['key'], item['entry'])
+
+        self.compact()
+
+    def put(self, key, entry):
+        known = self.entries.pop(key, None)
+
+        if known is not None and known.get('timestamp', 0) > entry.get('timestamp', 0):
+            entry = known
+
+        self.entries[key] = entry
+
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+            self.dropped += 1
+
+    def add(self, entries):
+        """
+        Add the entries of a write the replica missed
+        :param entries: key -> causal context entry
+        :return None:
+        """
+        for key, entry in entries.items():
+            self.put(key, entry)
+            self.hinted += 1
+
+        if self.file is not None:
+            self.file.write(''.join(json.dumps({'key': key, 'entry': entry}) + '\n' for key, entry in entries.items()))
+            self.file.flush()
+            self.lines += len(entries)
+
+            if self.lines > 2 * self.max_keys:
+                self.compact()
+
+    def take(self, limit):
+        """
+        Oldest hints, left in the queue until they are acknowledged
+        :return dict: key -> entry
+        """
+        batch = {}
+
+        for key, entry in self.entries.items():
+            if len(batch) >= limit:
+                break
+            batch[key] = entry
+
+        return batch
+
+    def remove(self, batch):
+        """
+        Forget hints the replica acknowledged, unless a newer write replaced them
+        :return None:
+        """
+        for key, entry in batch.items():
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+                self.replayed += 1
+
+        if self.file is not None and not self.entries:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the file with the hints still queued
+        :return None:
+        """
+        if self.path is None:
+            return
+
+        if self.file is not None:
+            self.file.close()
+
+        temp_path = self.path + '.tmp'
+
+        with open(temp_path, 'w') as f:
+            for key, entry in self.entries.items():
+                f.write(json.dumps({'key': key, 'entry': entry}) + '\n')
+
+        os.replace(temp_path, self.path)
+
+        self.lines = len(self.entries)
+        self.file = open(self.path, 'a') if self.file is not None else None
+
+    def close(self, delete=False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        if delete and self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def stats(self):
+        return {
+            'hints': len(self.entries),
+            'hinted': self.hinted,
+            'replayed': self.replayed,
+            'dropped': self.dropped,
+            'file': self.path
+        }
+
+
+class HintedHandoff(object):
+    """
+        Hint queues of every replica and the thread replaying them. A queue is
+        replayed only while the transport takes its replica as available, so
+        replaying never waits on a replica which is still down
+    """
+    def __init__(self, transport, max_keys=myconstants.HINT_MAX_KEYS, batch_keys=myconstants.HINT_BATCH_KEYS,
+                 interval=myconstants.HINT_REPLAY_INTERVAL):
+        """
+        :param transport: PeerTransport the hints are replayed with
+        :param max_keys: keys kept per replica
+        :param batch_keys: keys per replayed batch
+        :param interval: seconds between replay rounds
+        """
+        self.transport = transport
+        self.max_keys = max_keys
+        self.batch_keys = batch_keys
+        self.interval = interval
+        self.directory = None
+
+        self.lock = threading.Lock()
+        self.queues = {}                # node_address -> HintQueue
+        self.failures = 0               # replayed batches which failed
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def file_path(self, node_address):
+        if self.directory is None:
+            return None
+
+        return os.path.join(self.directory, node_address.replace(':', '_') + '.ndjson')
+
+    def open(self, directory):
+        """
+        Keep hints in files of a directory, loading the hints left by the
+        previous run of the node
+        :param directory: directory of the hint files
+        :return None:
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        with self.lock:
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.ndjson'):
+                    continue
+
+                node_address = name[:-len('.ndjson')].replace('_', ':')
+
+                if node_address not in self.queues:
+                    self.queues[node_address] = HintQueue(node_address, self.max_keys, self.file_path(node_address))
+
+    def start(self):
+        """
+        Start the replay thread
+        :return None:
+        """
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.loop, name='hinted-handoff')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.replay_all()
+            except Exception as error:
+                print('Error: replaying hints failed {0}'.format(error))
+
+    def hint(self, node_address, entries):
+        """
+        Keep the entries of a write a replica missed
+        :param node_address: replica which could not be reached
+        :param entries: key -> causal context entry
+        :return None:
+        """
+        with self.lock:
+            queue = self.queues.get(node_address)
+
+            if queue is None:
+                queue = HintQueue(node_address, self.max_keys, self.file_path(node_address))
+                self.queues[node_address] = queue
+
+            queue.add(entries)
+
+    def replay_all(self):
+        """
+        Replay the hints of every available replica
+        :return int: entries acknowledged
+        """
+        with self.lock:
+            node_addresses = [node_address for node_address, queue in self.queues.items() if queue.entries]
+
+        return sum(self.replay(node_address) for node_address in node_addresses
+                   if self.transport.available(node_address))
+
+    def replay(self, node_address):
+        """
+        Send the hints of a replica in batches, until it has them all or a batch fails
+        :return int: entries acknowledged
+        """
+        replayed = 0
+
+        while True:
+            with self.lock:
+                queue = self.queues.get(node_address)
+
+                if queue is None or not queue.entries:
+                    return replayed
+
+                batch = queue.take(self.batch_keys)
+
+            try:
+                resp = self.transport.put(node_address, 'proxy/replicate-batch', json={'causal-context': batch})
+                resp.raise_for_status()
+            except requests.exceptions.RequestException:
+                print('Error: Was not able to replay hints to node {0}'.format(node_address))
+                with self.lock:
+                    self.failures += 1
+                return replayed
+
+            with self.lock:
+                queue.remove(batch)
+
+            replayed += len(batch)
+
+    def peers(self):
+        with self.lock:
+            return list(self.queues)
+
+    def drop(self, node_address):
+        """
+        Forget the hints of a replica, e.g. when it is not a replica anymore
+        :return None:
+        """
+        with self.lock:
+            queue = self.queues.pop(node_address, None)
+
+            if queue is not None:
+                queue.close(delete=True)
+
+    def stats(self):
+        """
+        Counters of every hint queue
+        :return dict:
+        """
+        response = {}
+
+        with self.lock:
+            response['failures'] = self.failures
+            response['directory'] = self.directory
+            response['peers'] = {node_address: queue.stats() for node_address, queue in self.queues.items()}
+
+        return response
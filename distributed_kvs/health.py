@@ -0,0 +1,291 @@
+"""
+    Peer health. A phi accrual failure detector, fed by the gossip rounds,
+    suspects peers which stopped answering, and a circuit breaker per peer
+    opens after consecutive failed requests. Requests to a peer whose breaker
+    is open fail at once instead of waiting for a timeout, and a single probe
+    request is let through on a back-off schedule to find out if it is back
+"""
+
+import math
+import threading
+import time
+import requests
+import myconstants
+
+# breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# answers of PeerHealth.before()
+ALLOW = 'allow'
+PROBE = 'probe'
+REJECT = 'reject'
+
+
+class PeerUnavailable(requests.exceptions.ConnectionError):
+    """
+        Raised instead of sending a request to a peer whose breaker is open.
+        It is a ConnectionError, so callers handle it like an unreachable peer
+    """
+    pass
+
+
+class PhiAccrualDetector(object):
+    """
+        Phi accrual failure detector (Hayashibara et al.). The intervals
+        between a peer's heartbeats are taken as normally distributed, and
+        phi = -log10(probability that the next heartbeat is still to come),
+        so phi 8 means a 1 in 10^8 chance of suspecting a live peer.
+        Heartbeats come from gossip, which reaches every replica at a steady
+        pace; any other answer of the peer only moves its last seen time
+    """
+    def __init__(self, window=myconstants.PHI_WINDOW, min_std=myconstants.PHI_MIN_STD,
+                 min_samples=myconstants.PHI_MIN_SAMPLES):
+        """
+        :param window: heartbeat intervals kept per peer
+        :param min_std: lower bound of the standard deviation in seconds
+        :param min_samples: intervals needed before a peer can be suspected
+        """
+        self.window = window
+        self.min_std = min_std
+        self.min_samples = min_samples
+
+        self.intervals = {}         # node_address -> latest heartbeat intervals
+        self.last_heartbeat = {}    # node_address -> time of the last heartbeat
+        self.last_seen = {}         # node_address -> time of the last heartbeat or answer
+
+    def heartbeat(self, node_address, now):
+        last = self.last_heartbeat.get(node_address)
+
+        if last is not None:
+            intervals = self.intervals.setdefault(node_address, [])
+            intervals.append(now - last)
+            del intervals[:-self.window]
+
+        self.last_heartbeat[node_address] = now
+        self.last_seen[node_address] = now
+
+    def seen(self, node_address, now):
+        if node_address in self.last_seen:
+            self.last_seen[node_address] = now
+
+    def phi(self, node_address, now):
+        """
+        Suspicion level of a peer, 0 for peers without enough heartbeats
+        :return float:
+        """
+        intervals = self.intervals.get(node_address)
+
+        if not intervals or len(intervals) < self.min_samples:
+            return 0.0
+
+        mean = sum(intervals) / len(intervals)
+        variance = sum((interval - mean) ** 2 for interval in intervals) / len(intervals)
+        std = max(math.sqrt(variance), self.min_std)
+
+        elapsed = now - self.last_seen[node_address]
+        # probability that a heartbeat comes later than elapsed
+        later = 0.5 * math.erfc((elapsed - mean) / (std * math.sqrt(2)))
+
+        if later <= 0:
+            return myconstants.PHI_MAX
+
+        return min(-math.log10(later), myconstants.PHI_MAX)
+
+    def forget(self, node_address):
+        self.intervals.pop(node_address, None)
+        self.last_heartbeat.pop(node_address, None)
+        self.last_seen.pop(node_address, None)
+
+
+class CircuitBreaker(object):
+    """
+        Breaker of one peer.
+            closed      requests are sent, consecutive failures are counted
+            open        requests fail at once until the probe time
+            half-open   one probe request is sent, the breaker closes if it
+                        succeeds and opens again for twice as long if not
+    """
+    def __init__(self, failures=myconstants.BREAKER_FAILURES, open_seconds=myconstants.BREAKER_OPEN_SECONDS,
+                 max_open_seconds=myconstants.BREAKER_MAX_OPEN_SECONDS):
+        self.max_failures = failures
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = open_seconds
+        self.probe_at = 0
+        self.opened = 0             # times the breaker opened
+        self.rejected = 0           # requests failed at once
+
+    def open(self, now):
+        self.state = OPEN
+        self.probe_at = now + self.open_seconds
+        self.opened += 1
+
+    def before(self, now):
+        """
+        Whether a request may be sent
+        :return string: ALLOW, PROBE or REJECT
+        """
+        if self.state == CLOSED:
+            return ALLOW
+
+        # a probe whose outcome never came back does not block the next one
+        if (self.state == OPEN and now >= self.probe_at) or \
+                (self.state == HALF_OPEN and now >= self.probe_at + self.max_open_seconds):
+            self.state = HALF_OPEN
+            self.probe_at = now
+            return PROBE
+
+        self.rejected += 1
+        return REJECT
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.open_seconds = self.base_open_seconds
+
+    def failure(self, now):
+        if self.state == HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            self.open(now)
+            return
+
+        self.failures += 1
+
+        if self.state == CLOSED and self.failures >= self.max_failures:
+            self.open(now)
+
+
+class PeerHealth(object):
+    """
+        Failure detector and breakers of every peer, consulted by the
+        transport before each request and told the outcome after it
+    """
+    def __init__(self, threshold=myconstants.PHI_THRESHOLD, detector=None, clock=time.time):
+        """
+        :param threshold: phi above which a peer is suspected and its breaker opens
+        :param detector: optional PhiAccrualDetector
+        :param clock: function returning the time in seconds
+        """
+        self.threshold = threshold
+        self.detector = detector or PhiAccrualDetector()
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.breakers = {}          # node_address -> CircuitBreaker
+
+    def breaker(self, node_address):
+        breaker = self.breakers.get(node_address)
+
+        if breaker is None:
+            breaker = self.breakers.setdefault(node_address, CircuitBreaker())
+
+        return breaker
+
+    def before(self, node_address):
+        """
+        Decide whether a request to a peer is sent. A closed breaker opens
+        first if the detector suspects the peer
+        :return string: ALLOW, PROBE or REJECT
+        """
+        now = self.clock()
+
+        with self.lock:
+            breaker = self.breaker(node_address)
+
+            if breaker.state == CLOSED and self.detector.phi(node_address, now) >= self.threshold:
+                print('Error: node {0} is suspected down'.format(node_address))
+                breaker.open(now)
+
+            return breaker.before(now)
+
+    def success(self, node_address):
+        """
+        The peer answered, whatever the status code
+        :return None:
+        """
+        now = self.clock()
+
+        with self.lock:
+            self.detector.seen(node_address, now)
+            breaker = self.breaker(node_address)
+
+            if breaker.state != CLOSED or breaker.failures:
+                breaker.success()
+
+    def failure(self, node_address):
+        """
+        The peer could not be reached or did not answer in time
+        :return None:
+        """
+        now = self.clock()
+
+        with self.lock:
+            self.breaker(node_address).failure(now)
+
+    def heartbeat(self, node_address):
+        """
+        The peer answered a gossip round
+        :return None:
+        """
+        now = self.clock()
+
+        with self.lock:
+            self.detector.heartbeat(node_address, now)
+            self.breaker(node_address).success()
+
+    def available(self, node_address):
+        """
+        Whether requests to a peer are sent right now. A peer whose probe
+        is due counts as available, so the next request probes it
+        :return bool:
+        """
+        now = self.clock()
+
+        with self.lock:
+            breaker = self.breakers.get(node_address)
+
+            if breaker is not None and breaker.state != CLOSED:
+                return breaker.state == OPEN and now >= breaker.probe_at
+
+            return self.detector.phi(node_address, now) < self.threshold
+
+    def forget(self, node_address):
+        """
+        Drop what is known about a peer, e.g. when it leaves the view
+        :return None:
+        """
+        with self.lock:
+            self.breakers.pop(node_address, None)
+            self.detector.forget(node_address)
+
+    def stats(self):
+        """
+        Breaker state and suspicion level of every peer
+        :return dict:
+        """
+        now = self.clock()
+        response = {}
+
+        with self.lock:
+            for node_address, breaker in self.breakers.items():
+                intervals = self.detector.intervals.get(node_address) or []
+                last_seen = self.detector.last_seen.get(node_address)
+
+                response[node_address] = {
+                    'state': breaker.state,
+                    'phi': self.detector.phi(node_address, now),
+                    'failures': breaker.failures,
+                    'opened': breaker.opened,
+                    'rejected': breaker.rejected,
+                    'probe-in': max(breaker.probe_at - now, 0) if breaker.state == OPEN else 0,
+                    'heartbeats': len(intervals),
+                    'heartbeat-interval': (sum(intervals) / len(intervals)) if intervals else None,
+                    'last-seen': (now - last_seen) if last_seen is not None else None
+                }
+
+        return response
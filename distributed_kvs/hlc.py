@@ -0,0 +1,79 @@
+"""
+    Hybrid logical clock used for all version stamps. A stamp is a single
+    integer: milliseconds since the epoch shifted left 16 bits, plus a
+    logical counter in the low 16 bits
+"""
+
+import threading
+import time
+
+LOGICAL_BITS = 16
+
+
+def physical_stamp():
+    """
+    Stamp of the current wall clock time with a logical counter of 0
+    :return int:
+    """
+    return int(time.time() * 1000) << LOGICAL_BITS
+
+
+def stamp_millis(stamp):
+    """
+    Wall clock part of a stamp in milliseconds since the epoch
+    :return int:
+    """
+    return stamp >> LOGICAL_BITS
+
+
+class HybridLogicalClock(object):
+    """
+        Stamps follow the wall clock while it moves forward, and never go
+        backwards or fall behind a stamp observed from another node, so a
+        write ordered after something a client saw always gets a larger stamp
+        even if this node's clock is behind
+    """
+    def __init__(self, max_offset=None):
+        """
+        :param max_offset: optional milliseconds an observed stamp may be ahead
+                           of the wall clock, stamps further ahead are ignored
+        """
+        self.lock = threading.Lock()
+        self.last = 0
+        self.max_offset = max_offset
+
+    def too_far(self, stamp):
+        """
+        Whether a stamp is further ahead of the wall clock than max_offset
+        :return bool:
+        """
+        if self.max_offset is None:
+            return False
+
+        return stamp_millis(stamp) > int(time.time() * 1000) + self.max_offset
+
+    def now(self):
+        """
+        Stamp for a local event
+        :return int:
+        """
+        with self.lock:
+            self.last = max(self.last + 1, physical_stamp())
+            return self.last
+
+    def update(self, stamp):
+        """
+        Observe a stamp from another node or a client, later local stamps
+        will be greater than it. A stamp too far ahead of the wall clock is
+        ignored, or every later stamp of the node would be in the future too
+        :param stamp: observed stamp
+        :return bool: False if the stamp was ignored
+        """
+        if self.too_far(stamp):
+            return False
+
+        with self.lock:
+            if stamp > self.last:
+                self.last = stamp
+
+        return True
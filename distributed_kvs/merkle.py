@@ -0,0 +1,195 @@
+"""
+    Incrementally updated Merkle tree over the keys of a node, used by
+    replicas to find which keys differ without exchanging the whole store
+"""
+
+import hashlib
+import json
+import threading
+import myconstants
+
+
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+class MerkleTree(object):
+    """
+        Complete binary tree stored as an array. Node 1 is the root, node i has
+        children 2i and 2i + 1, and the 2^depth leaves are the hash buckets
+        keys fall in. A leaf hash is the XOR of the digests of its keys, so a
+        write only rehashes the depth nodes on the path to the root
+    """
+    def __init__(self, depth=myconstants.MERKLE_DEPTH):
+        self.lock = threading.Lock()
+        self.depth = depth
+        self.leaves = 2 ** depth
+        self.reset()
+
+    def reset(self):
+        """
+        Empty the tree
+        :return None:
+        """
+        with self.lock:
+            self.digests = {}                                   # key -> digest of its current entry
+            self.buckets = [set() for _ in range(self.leaves)]  # bucket -> keys
+            self.leaf_values = [0] * self.leaves                # bucket -> XOR of key digests
+            self.nodes = [b'\x00' * 8] * (2 * self.leaves)
+            self.hash_inner_nodes()
+
+    def bucket(self, key):
+        """
+        Bucket (leaf number) a key falls in
+        :return int:
+        """
+        return int.from_bytes(hash_bytes(key.encode('utf-8')), 'big') % self.leaves
+
+    def entry_digest(self, key, timestamp, exists, value=None):
+        """
+        Digest of a single entry, two replicas holding the same version
+        and value of a key produce the same digest. The value is part of
+        it so replicas holding different values under the same timestamp
+        (e.g. keys without a version) still differ
+        :return int:
+        """
+        if exists:
+            value = hash_bytes(json.dumps(value, sort_keys=True).encode('utf-8')).hex()
+        else:
+            value = ''
+
+        data = '{0}|{1}|{2}|{3}'.format(key, int(timestamp), 1 if exists else 0, value).encode('utf-8')
+        return int.from_bytes(hash_bytes(data), 'big')
+
+    def update(self, key, timestamp, exists, value=None):
+        """
+        Add or replace the entry of a key
+        :return None:
+        """
+        digest = self.entry_digest(key, timestamp, exists, value)
+
+        with self.lock:
+            bucket = self.bucket(key)
+            old = self.digests.get(key)
+
+            if old == digest:
+                return
+            if old is not None:
+                self.leaf_values[bucket] ^= old
+
+            self.digests[key] = digest
+            self.buckets[bucket].add(key)
+            self.leaf_values[bucket] ^= digest
+            self.rehash(bucket)
+
+    def remove(self, key):
+        """
+        Remove a key from the tree
+        :return None:
+        """
+        with self.lock:
+            old = self.digests.pop(key, None)
+
+            if old is None:
+                return
+
+            bucket = self.bucket(key)
+            self.buckets[bucket].discard(key)
+            self.leaf_values[bucket] ^= old
+            self.rehash(bucket)
+
+    def rehash(self, bucket):
+        """
+        Recompute the hashes on the path from a leaf to the root, lock must be held
+        :return None:
+        """
+        index = self.leaves + bucket
+        self.nodes[index] = self.leaf_values[bucket].to_bytes(8, 'big')
+        index //= 2
+
+        while index >= 1:
+            self.nodes[index] = hash_bytes(self.nodes[2 * index] + self.nodes[2 * index + 1])
+            index //= 2
+
+    def rebuild(self, items):
+        """
+        Rebuild the whole tree from (key, timestamp, exists, value) tuples
+        :return None:
+        """
+        self.reset()
+
+        with self.lock:
+            for key, timestamp, exists, value in items:
+                digest = self.entry_digest(key, timestamp, exists, value)
+                bucket = self.bucket(key)
+                self.digests[key] = digest
+                self.buckets[bucket].add(key)
+                self.leaf_values[bucket] ^= digest
+
+            for bucket in range(self.leaves):
+                self.nodes[self.leaves + bucket] = self.leaf_values[bucket].to_bytes(8, 'big')
+
+            self.hash_inner_nodes()
+
+    def hash_inner_nodes(self):
+        """
+        Recompute the hashes of all nodes above the leaves, lock must be held.
+        An empty tree is hashed too, so removing every key of a bucket gives
+        back the hashes of a tree which never had them
+        :return None:
+        """
+        for index in range(self.leaves - 1, 0, -1):
+            self.nodes[index] = hash_bytes(self.nodes[2 * index] + self.nodes[2 * index + 1])
+
+    def root(self):
+        return self.node_hash(1)
+
+    def node_hash(self, index):
+        """
+        Hex hash of a tree node
+        :return string:
+        """
+        return self.nodes[index].hex()
+
+    def is_leaf(self, index):
+        return index >= self.leaves
+
+    def bucket_keys(self, bucket):
+        """
+        Keys in a bucket
+        :return list:
+        """
+        with self.lock:
+            return list(self.buckets[bucket])
+
+    def diff(self, get_remote_hashes, batch_size=myconstants.MERKLE_BATCH):
+        """
+        Walk down from the root comparing against another replica's tree
+        and return the buckets whose hashes differ
+        :param get_remote_hashes: function(list of node indices) -> dict index -> hex hash
+        :param batch_size: max number of node hashes asked for at once
+        :return list: differing bucket numbers
+        """
+        remote = get_remote_hashes([1])
+
+        if remote.get(1) == self.root():
+            return []
+
+        frontier = [1]
+
+        while frontier and not self.is_leaf(frontier[0]):
+            children = []
+            for index in frontier:
+                children.extend([2 * index, 2 * index + 1])
+
+            frontier = []
+
+            for i in range(0, len(children), batch_size):
+                chunk = children[i : i + batch_size]
+                remote = get_remote_hashes(chunk)
+
+                for index in chunk:
+                    if remote.get(index) != self.node_hash(index):
+                        frontier.append(index)
+
+        return [index - self.leaves for index in frontier]
@@ -0,0 +1,362 @@
+"""
+    Streaming key migration between nodes during a view change. Keys are
+    sent in bounded NDJSON batches, each acknowledged by the receiver, so a
+    failed batch is resent from the receiver's last acknowledged batch
+    instead of resending the whole shard in one request. MigrationPlan works
+    out which ranges of the hash ring change owner, so only their keys move
+"""
+
+from bisect import bisect_right
+import json
+import threading
+import time
+import requests
+import myconstants
+
+
+def encode_batch(items):
+    """
+    NDJSON body of a batch, one {"key", "value", "timestamp"} object per line
+    :param items: list of (key, value, timestamp)
+    :return bytes:
+    """
+    lines = []
+
+    for key, value, timestamp in items:
+        lines.append(json.dumps({'key': key, 'value': value, 'timestamp': timestamp}))
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def decode_batch(body):
+    """
+    Causal context entries of the keys of an NDJSON batch
+    :param body: bytes of the request body
+    :return dict: key -> entry
+    """
+    entries = {}
+
+    for line in body.decode('utf-8').splitlines():
+        if not line.strip():
+            continue
+
+        item = json.loads(line)
+
+        entry = {}
+        entry['timestamp'] = item.get('timestamp', 0)
+        entry['value'] = item['value']
+        entry['doesExist'] = True
+
+        entries[item['key']] = entry
+
+    return entries
+
+
+def batches(items, max_keys=myconstants.MIGRATION_BATCH_KEYS, max_bytes=myconstants.MIGRATION_BATCH_BYTES):
+    """
+    Split a stream of items into batches of at most max_keys keys and about max_bytes bytes
+    :param items: iterator of (key, value, timestamp)
+    :return iterator of list:
+    """
+    batch = []
+    size = 0
+
+    for item in items:
+        batch.append(item)
+        size += len(item[0]) + len(json.dumps(item[1]))
+
+        if len(batch) >= max_keys or size >= max_bytes:
+            yield batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield batch
+
+
+class MigrationStats(object):
+    """
+        Counters of the migration of keys from this node to one receiver
+    """
+    def __init__(self, migration_id, node_address):
+        self.migration_id = migration_id
+        self.node_address = node_address
+        self.start = time.time()
+        self.end = None
+        self.keys = 0
+        self.bytes = 0
+        self.batches = 0
+        self.retries = 0
+        self.resumes = 0
+        self.done = False
+        self.error = None
+
+    def to_dict(self):
+        elapsed = (self.end or time.time()) - self.start
+
+        return {
+            'migration': self.migration_id,
+            'to': self.node_address,
+            'keys': self.keys,
+            'bytes': self.bytes,
+            'batches': self.batches,
+            'retries': self.retries,
+            'resumes': self.resumes,
+            'seconds': elapsed,
+            'keys-per-second': self.keys / elapsed if elapsed > 0 else 0,
+            'bytes-per-second': self.bytes / elapsed if elapsed > 0 else 0,
+            'done': self.done,
+            'error': self.error
+        }
+
+
+class MigrationSender(object):
+    """
+        Sends keys to other nodes over /proxy/migrate/<migration id>. Batches
+        are numbered from 1 in the order of the stream, which must be the
+        same on every attempt (e.g. keys sorted) for resuming to work
+    """
+    def __init__(self, transport, retries=myconstants.MIGRATION_RETRIES, max_keys=myconstants.MIGRATION_BATCH_KEYS,
+                 max_bytes=myconstants.MIGRATION_BATCH_BYTES):
+        self.transport = transport
+        self.retries = retries
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.history = []           # MigrationStats of the latest migrations
+
+    def acked(self, node_address, migration_id):
+        """
+        Last batch of a migration the receiver acknowledged
+        :return int:
+        """
+        resp = self.transport.get(node_address, 'proxy/migrate/' + migration_id)
+        resp.raise_for_status()
+
+        return resp.json()['acked']
+
+    def send(self, node_address, migration_id, items, forward=None):
+        """
+        Stream items to a node. A batch that fails is retried up to retries
+        times after a back-off, starting again from the last batch the
+        receiver acknowledged
+        :param node_address: receiver
+        :param migration_id: id of the migration, the receiver tracks acks per id
+        :param items: iterator of (key, value, timestamp)
+        :param forward: optional nodes the receiver forwards every batch to
+        :return MigrationStats: done is False if the receiver could not be reached
+        """
+        stats = MigrationStats(migration_id, node_address)
+
+        with self.lock:
+            self.history.append(stats)
+            del self.history[:-myconstants.MIGRATION_HISTORY]
+
+        acked = 0
+        params = {}
+
+        if forward:
+            params['forward'] = ','.join(forward)
+
+        for number, batch in enumerate(batches(items, self.max_keys, self.max_bytes), 1):
+            if number <= acked:
+                continue
+
+            body = encode_batch(batch)
+            params['batch'] = number
+            failures = 0
+
+            while True:
+                try:
+                    resp = self.transport.put(node_address, 'proxy/migrate/' + migration_id, data=body,
+                                              params=params,
+                                              headers={'Content-Type': 'application/x-ndjson'})
+                    resp.raise_for_status()
+                    acked = resp.json()['acked']
+                    break
+                except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+                    failures += 1
+                    stats.retries += 1
+
+                    if failures > self.retries:
+                        print('Error: migration {0} to {1} failed {2}'.format(migration_id, node_address, error))
+                        stats.error = str(error)
+                        stats.end = time.time()
+                        return stats
+
+                    time.sleep(min(0.1 * (2 ** (failures - 1)), 1))
+
+                    # the batch may have been applied before the failure
+                    try:
+                        acked = self.acked(node_address, migration_id)
+                        stats.resumes += 1
+                    except (requests.exceptions.RequestException, ValueError, KeyError):
+                        pass
+
+                    if number <= acked:
+                        break
+
+            stats.keys += len(batch)
+            stats.bytes += len(body)
+            stats.batches += 1
+
+        stats.done = True
+        stats.end = time.time()
+
+        return stats
+
+    def forward(self, node_address, migration_id, number, body):
+        """
+        Pass a received batch on to another node
+        :return bool: True if the node acknowledged it
+        """
+        try:
+            resp = self.transport.put(node_address, 'proxy/migrate/' + migration_id, data=body,
+                                      params={'batch': number},
+                                      headers={'Content-Type': 'application/x-ndjson'})
+            resp.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as error:
+            print('Error: unable to forward migration {0} to {1} {2}'.format(migration_id, node_address, error))
+            return False
+
+    def stats(self):
+        """
+        Counters of the latest migrations
+        :return list:
+        """
+        with self.lock:
+            return [stats.to_dict() for stats in self.history]
+
+
+def ring_owner(positions, owners, position):
+    """
+    Owner of a position on a hash ring, the first point after it (wrapping around)
+    :param positions: sorted positions of the ring's points
+    :param owners: owner of each point
+    :return: owner
+    """
+    return owners[bisect_right(positions, position) % len(positions)]
+
+
+class MigrationPlan(object):
+    """
+        Compares the old and new hash rings of a view change. The positions of
+        the points of both rings cut the ring into intervals whose keys have
+        the same old and new shard. An interval's keys are sent only to the
+        new replicas of its new shard which were not replicas of its old
+        shard, by a single sender among the old replicas. The first of those
+        new replicas receives them and forwards them to the others
+    """
+    def __init__(self, old_ring, old_partitions, new_ring, new_partitions, alive=None):
+        """
+        :param old_ring: hash ring of the old view, with get_points() and hashi(key)
+        :param old_partitions: shard_id -> replicas in the old view
+        :param new_ring: hash ring of the new view, hashing keys the same way
+        :param new_partitions: shard_id -> replicas in the new view
+        :param alive: optional set of nodes which can send keys, the first
+                      live old replica of a shard is its sender
+        """
+        self.hashi = new_ring.hashi
+
+        old_points = sorted(old_ring.get_points())
+        new_points = sorted(new_ring.get_points())
+        old_positions = [position for position, _ in old_points]
+        new_positions = [position for position, _ in new_points]
+        old_owners = [shard_id for _, shard_id in old_points]
+        new_owners = [shard_id for _, shard_id in new_points]
+
+        self.boundaries = sorted(set(old_positions) | set(new_positions))
+        self.intervals = []         # interval -> (old shard, new shard)
+        self.moves = {}             # (old shard, new shard) -> move
+
+        for i in range(len(self.boundaries)):
+            # interval i holds positions in [boundaries[i - 1], boundaries[i]),
+            # interval 0 wraps around the end of the ring
+            start = self.boundaries[i - 1] if i > 0 else self.boundaries[-1]
+            old_shard = ring_owner(old_positions, old_owners, start)
+            new_shard = ring_owner(new_positions, new_owners, start)
+
+            self.intervals.append((old_shard, new_shard))
+
+            if (old_shard, new_shard) in self.moves:
+                self.moves[(old_shard, new_shard)]['intervals'] += 1
+                continue
+
+            old_replicas = old_partitions.get(old_shard, [])
+            new_replicas = new_partitions[new_shard]
+            senders = [node for node in old_replicas if alive is None or node in alive]
+
+            move = {}
+            move['from'] = old_shard
+            move['to'] = new_shard
+            move['keep'] = set(new_replicas)
+            move['had'] = set(old_replicas)
+            move['targets'] = [node for node in new_replicas if node not in old_replicas]
+            move['sender'] = senders[0] if senders else None
+            move['intervals'] = 1
+
+            self.moves[(old_shard, new_shard)] = move
+
+    def move(self, key):
+        """
+        Move of the interval a key falls in
+        :return dict:
+        """
+        i = bisect_right(self.boundaries, self.hashi(key))
+
+        return self.moves[self.intervals[i % len(self.intervals)]]
+
+    def split(self, node_address, keys):
+        """
+        Decide what a node does with each of its keys
+        :param node_address: the node
+        :param keys: keys the node holds
+        :return (dict, list): (old shard, new shard) -> sorted keys the node sends,
+                              and keys the node no longer holds in the new view
+        """
+        outgoing = {}
+        drop = []
+
+        for key in keys:
+            move = self.move(key)
+
+            if move['targets'] and move['sender'] == node_address:
+                outgoing.setdefault((move['from'], move['to']), []).append(key)
+
+            if node_address not in move['keep']:
+                drop.append(key)
+
+        for keys in outgoing.values():
+            keys.sort()
+
+        return outgoing, drop
+
+    def rollback(self, node_address, keys):
+        """
+        Keys a node drops when the view change is aborted after its commit
+        :param node_address: the node
+        :param keys: keys the node holds
+        :return list: keys the node did not hold in the old view
+        """
+        return [key for key in keys if node_address not in self.move(key)['had']]
+
+    def summary(self):
+        """
+        Moves of the plan which send keys
+        :return list:
+        """
+        summary = []
+
+        for move in self.moves.values():
+            if move['targets']:
+                summary.append({
+                    'from': move['from'],
+                    'to': move['to'],
+                    'sender': move['sender'],
+                    'targets': move['targets'],
+                    'intervals': move['intervals']
+                })
+
+        return summary
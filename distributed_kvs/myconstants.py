@@ -32,3 +32,92 @@ LONG_KEY_RESPONSE = {
 UNABLE_TO_SERVICE_MESSAGE = 'Unable to satisfy request'
 
 TIMEOUT = 3
+
+# Replication
+DEFAULT_WRITE_ACK = 'local'
+REPLICATION_WORKERS = 16
+REPLICATION_BATCH_KEYS = 500  # max keys of a batch sent to one replica
+
+# Node to node transport
+PEER_POOL_SIZE = 32
+DEFAULT_CODEC = 'msgpack'   # encoding of /proxy/* requests to peers which take it, else json
+CODECS = ['msgpack', 'json']
+
+# Gossip
+GOSSIP_INTERVAL = 2         # seconds between gossip rounds
+GOSSIP_JITTER = 0.2         # interval is randomized by +/- 20%
+GOSSIP_FANOUT = 0           # peers contacted per round, 0 means every replica
+GOSSIP_MAX_BACKOFF = 3      # max seconds an unreachable peer is skipped
+
+# Merkle tree anti-entropy
+MERKLE_DEPTH = 10           # tree has 2^10 hash buckets
+MERKLE_BATCH = 256          # max node hashes or buckets asked for in one request
+MERKLE_REPAIR_ROUNDS = 5    # compare trees with replicas every 5 gossip rounds
+
+# Causal consistency
+CATCH_UP_TIMEOUT = 1        # seconds to wait on a replica when pulling missing writes
+HLC_MAX_OFFSET = 60000      # ms an observed version may be ahead of the wall clock
+
+# Server
+DEFAULT_SERVER = 'production'
+SERVER_THREADS = 16
+SERVER_CONNECTION_LIMIT = 1000
+ASYNC_PEER_CONNECTIONS = 100            # connections the asyncio runtime opens per peer at most
+ASYNC_MAX_BODY = 64 * 1024 * 1024       # largest request body the asyncio runtime accepts
+
+# Storage
+DEFAULT_STORAGE = 'memory'
+STORAGE_STRIPES = 64        # locks of the storage engines
+
+# Write-ahead log
+WAL_SNAPSHOT_RECORDS = 100000   # take a snapshot after this many logged changes
+WAL_GROUP_COMMIT_DELAY = 0      # seconds to gather more records before each fsync
+
+# Memory-mapped storage engine
+MMAP_INITIAL_SIZE = 16 * 1024 * 1024    # bytes the memory-mapped store file starts with
+MMAP_COMPACT_RATIO = 1                  # rewrite the file once garbage outgrows the live data
+
+# Key migration during view changes
+MIGRATION_BATCH_KEYS = 500              # max keys sent in one batch
+MIGRATION_BATCH_BYTES = 1024 * 1024     # batches are cut after about 1 MB
+MIGRATION_RETRIES = 5                   # failed batches are retried this many times
+MIGRATION_HISTORY = 64                  # migrations kept in the stats
+
+# View change coordination
+VIEW_CHANGE_WORKERS = 32                # nodes contacted at once during a view change
+VIEW_CHANGE_COMMIT_TIMEOUT = 600        # seconds a node may take to commit, i.e. send its keys
+
+# Routing
+RING_VNODES = 160                       # virtual nodes per shard on the hash ring
+RING_CACHE_SIZE = 16                    # rings of the latest views kept built
+
+# Batch API
+BATCH_MAX_KEYS = 1000                   # max keys of one /kvs/batch request
+BATCH_WORKERS = 16                      # shards a batch is sent to at once
+BATCH_MESSAGE = 'Batch processed'
+
+# Ordered key index and scans
+INDEX_CHUNK_SIZE = 512                  # keys per chunk of the ordered index
+INDEX_SCAN_PAGE = 256                   # keys read from the index at a time by a scan
+SCAN_DEFAULT_LIMIT = 100                # keys of a /kvs/scan page
+SCAN_MAX_LIMIT = 1000
+
+# Replica selection
+LATENCY_EWMA_ALPHA = 0.2                # weight of the latest response time in a peer's average
+LATENCY_STALE_SECONDS = 1               # response times older than this are measured again
+
+# Peer health
+PHI_THRESHOLD = 8                       # suspicion level above which a peer is taken as down
+PHI_WINDOW = 100                        # gossip heartbeat intervals kept per peer
+PHI_MIN_SAMPLES = 3                     # heartbeat intervals needed before a peer can be suspected
+PHI_MIN_STD = 0.5                       # seconds, lower bound of the heartbeat interval deviation
+PHI_MAX = 100
+BREAKER_FAILURES = 2                    # consecutive failed requests which open a peer's breaker
+BREAKER_OPEN_SECONDS = 0.5              # requests fail at once for this long before a probe
+BREAKER_MAX_OPEN_SECONDS = 4            # the wait doubles after every failed probe, up to this
+BREAKER_PROBE_TIMEOUT = 0.5             # timeout of a probe request
+
+# Hinted handoff
+HINT_MAX_KEYS = 50000                   # hinted keys kept per replica, the oldest are dropped beyond it
+HINT_BATCH_KEYS = 500                   # keys per replayed batch
+HINT_REPLAY_INTERVAL = 0.5              # seconds between replay rounds
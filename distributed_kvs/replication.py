@@ -0,0 +1,528 @@
+"""
+    Replication engine used to fan out writes to the other
+    replicas of a shard concurrently. Writes are queued per replica and a
+    sender thread per replica drains its queue in batches, so a write costs
+    a queue append and many writes share one request
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import threading
+import time
+import requests
+import myconstants
+
+# Write acknowledgement policies
+ACK_LOCAL = 'local'         # respond once the write is applied locally
+ACK_ONE = 'one'             # respond once one other replica acknowledged
+ACK_QUORUM = 'quorum'       # respond once a majority of the shard has the write
+ACK_ALL = 'all'             # respond once every replica acknowledged
+
+ACK_POLICIES = [ACK_LOCAL, ACK_ONE, ACK_QUORUM, ACK_ALL]
+
+
+def acknowledged(resp):
+    """
+    Whether a replica's answer acknowledges a write, only 2xx does
+    :return bool:
+    """
+    return 200 <= resp.status_code < 300
+
+
+def retriable(resp):
+    """
+    Whether a write a replica did not acknowledge is worth replaying later,
+    a 4xx would be answered again
+    :return bool:
+    """
+    return resp.status_code >= 500
+
+
+class LatencyHistogram(object):
+    """
+        Fixed bucket latency histogram, bucket bounds are in milliseconds
+    """
+    BOUNDS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Record a single latency sample
+        :param seconds: latency of the sample in seconds
+        :return None:
+        """
+        millis = seconds * 1000.0
+        index = len(self.BOUNDS)
+
+        for i, bound in enumerate(self.BOUNDS):
+            if millis <= bound:
+                index = i
+                break
+
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += millis
+            self.max = max(self.max, millis)
+
+    def percentile(self, fraction):
+        """
+        Approximate a percentile using the upper bound of the bucket it falls in
+        :param fraction: percentile as a fraction, e.g. 0.99
+        :return float: latency in milliseconds
+        """
+        if self.count == 0:
+            return 0.0
+
+        target = fraction * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if i < len(self.BOUNDS):
+                    return float(self.BOUNDS[i])
+                return self.max
+
+        return self.max
+
+    def to_dict(self):
+        """
+        Get a json serializable view of the histogram
+        :return dict:
+        """
+        with self.lock:
+            buckets = {}
+            for i, bound in enumerate(self.BOUNDS):
+                buckets['<={0}ms'.format(bound)] = self.counts[i]
+            buckets['>{0}ms'.format(self.BOUNDS[-1])] = self.counts[-1]
+
+            return {
+                'count': self.count,
+                'mean-ms': (self.total / self.count) if self.count else 0.0,
+                'max-ms': self.max,
+                'p50-ms': self.percentile(0.50),
+                'p99-ms': self.percentile(0.99),
+                'buckets': buckets
+            }
+
+
+class PendingWrite(object):
+    """
+        Keys of one write queued for one replica. Its future is True once
+        the replica acknowledged every key, False as soon as one batch failed
+    """
+    def __init__(self, keys):
+        self.remaining = keys
+        self.future = Future()
+
+    def acked(self):
+        self.remaining -= 1
+        if self.remaining == 0 and not self.future.done():
+            self.future.set_result(True)
+
+    def failed(self):
+        if not self.future.done():
+            self.future.set_result(False)
+
+
+class ReplicaQueue(object):
+    """
+        Outbound writes of one replica, oldest first. A key queued again
+        before it was sent keeps only its newest entry
+    """
+    def __init__(self, node_address):
+        self.node_address = node_address
+        self.cond = threading.Condition()
+        self.entries = OrderedDict()    # key -> [entry, time queued, PendingWrite list]
+        self.thread = None
+        self.closed = False             # the node is not a replica of the shard anymore
+
+        self.queued = 0                 # keys queued
+        self.coalesced = 0              # keys queued again before they were sent
+        self.batches = 0                # batches acknowledged
+        self.sent = 0                   # keys acknowledged
+        self.failures = 0               # batches which failed
+        self.lag = LatencyHistogram()   # time from queueing a key to its acknowledgement
+
+    def stats(self, now):
+        with self.cond:
+            oldest = next(iter(self.entries.values()), None)
+
+            return {
+                'depth': len(self.entries),
+                'oldest-ms': (now - oldest[1]) * 1000.0 if oldest is not None else 0.0,
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'batches': self.batches,
+                'sent': self.sent,
+                'keys-per-batch': (float(self.sent) / self.batches) if self.batches else 0.0,
+                'failures': self.failures,
+                'lag': self.lag.to_dict()
+            }
+
+
+class ReplicationPipeline(object):
+    """
+        Per replica queues of causal context entries, each drained by its own
+        sender thread to /proxy/replicate-batch. A sender takes everything
+        queued, up to batch_keys, so the busier the shard the larger the
+        batches. Entries of a failed batch are handed to the hinted handoff
+    """
+    def __init__(self, transport, handoff=None, batch_keys=myconstants.REPLICATION_BATCH_KEYS):
+        """
+        :param transport: PeerTransport the batches are sent with
+        :param handoff: optional HintedHandoff keeping the entries of failed batches
+        :param batch_keys: max keys of a batch
+        """
+        self.transport = transport
+        self.handoff = handoff
+        self.batch_keys = batch_keys
+
+        self.lock = threading.Lock()
+        self.queues = {}                # node_address -> ReplicaQueue
+
+    def queue(self, node_address):
+        queue = self.queues.get(node_address)
+
+        if queue is not None:
+            return queue
+
+        with self.lock:
+            if node_address not in self.queues:
+                queue = ReplicaQueue(node_address)
+                self.start_sender(queue)
+
+                self.queues[node_address] = queue
+
+            return self.queues[node_address]
+
+    def start_sender(self, queue):
+        queue.thread = threading.Thread(target=self.run, args=(queue,), name='replicate-' + queue.node_address)
+        queue.thread.daemon = True
+        queue.thread.start()
+
+    def wake(self, queue):
+        """
+        Tell the sender of a queue there are entries to send, called with the queue's lock held
+        :return None:
+        """
+        queue.cond.notify()
+
+    def submit(self, node_address, entries):
+        """
+        Queue the entries of a write for a replica
+        :param node_address: replica
+        :param entries: key -> causal context entry
+        :return Future: True once the replica acknowledged every entry
+        """
+        pending = PendingWrite(len(entries))
+        now = time.time()
+
+        while True:
+            queue = self.queue(node_address)
+
+            with queue.cond:
+                # dropped while we got it, the next call makes a new one
+                if queue.closed:
+                    continue
+
+                self.add(queue, entries, pending, now)
+                self.wake(queue)
+
+            return pending.future
+
+    def add(self, queue, entries, pending, now):
+        """
+        Queue the entries of a write, called with the queue's lock held
+        :return None:
+        """
+        for key, entry in entries.items():
+            queued = queue.entries.get(key)
+
+            if queued is None:
+                queue.entries[key] = [entry, now, [pending]]
+            else:
+                # replicas keep the newest write, so only the newest is sent
+                if entry.get('timestamp', 0) >= queued[0].get('timestamp', 0):
+                    queued[0] = entry
+                queued[2].append(pending)
+                queue.coalesced += 1
+
+            queue.queued += 1
+
+    def drop(self, node_address):
+        """
+        Forget the queue of a node which is not a replica anymore. Its sender
+        stops, and the writes still queued for it fail without being hinted
+        :return None:
+        """
+        with self.lock:
+            queue = self.queues.pop(node_address, None)
+
+        if queue is None:
+            return
+
+        with queue.cond:
+            queue.closed = True
+            batch = list(queue.entries.items())
+            queue.entries.clear()
+            self.wake(queue)
+
+        for _, (_, _, pendings) in batch:
+            for pending in pendings:
+                pending.failed()
+
+    def peers(self):
+        with self.lock:
+            return list(self.queues)
+
+    def run(self, queue):
+        """
+        Sender thread of a replica
+        :return None:
+        """
+        while True:
+            with queue.cond:
+                while not queue.entries and not queue.closed:
+                    queue.cond.wait()
+
+                if queue.closed:
+                    return
+
+                batch = self.take(queue)
+
+            try:
+                self.send(queue, batch)
+            except Exception as error:
+                # the thread must outlive a bad batch, or the replica is never sent to again
+                print('Error: replicating to node {0} failed {1}'.format(queue.node_address, error))
+
+    def take(self, queue):
+        """
+        Oldest entries of a queue, up to batch_keys, called with the queue's lock held
+        :return list: (key, [entry, time queued, PendingWrite list])
+        """
+        batch = []
+
+        while queue.entries and len(batch) < self.batch_keys:
+            batch.append(queue.entries.popitem(last=False))
+
+        return batch
+
+    def payload(self, batch):
+        return {'causal-context': {key: queued[0] for key, queued in batch}}
+
+    def send(self, queue, batch):
+        """
+        Send one batch, settling the writes waiting for its keys
+        :param batch: list of (key, [entry, time queued, PendingWrite list])
+        :return bool: True if the replica acknowledged the batch
+        """
+        payload = self.payload(batch)
+        hint = True
+
+        try:
+            resp = self.transport.put(queue.node_address, 'proxy/replicate-batch', json=payload)
+            acked = acknowledged(resp)
+            hint = retriable(resp)
+        except (requests.Timeout, requests.exceptions.ConnectionError):
+            print('Error: we were not able to communicate with another replica')
+            acked = False
+        except Exception as error:
+            # the writes waiting on the batch are settled whatever went wrong
+            print('Error: was not able to send a batch to node {0} {1}'.format(queue.node_address, error))
+            acked = False
+
+        self.settle(queue, batch, payload, acked, hint)
+
+        return acked
+
+    def settle(self, queue, batch, payload, acked, hint=True):
+        """
+        Settle the writes waiting for the keys of a batch, handing the
+        entries of a failed batch to the hinted handoff
+        :param hint: False if the replica rejected the batch, replaying it would not help
+        :return None:
+        """
+        now = time.time()
+
+        with queue.cond:
+            if acked:
+                queue.batches += 1
+                queue.sent += len(batch)
+            else:
+                queue.failures += 1
+
+        for _, (_, queued_at, pendings) in batch:
+            if acked:
+                queue.lag.record(now - queued_at)
+
+            for pending in pendings:
+                if acked:
+                    pending.acked()
+                else:
+                    pending.failed()
+
+        if not acked and hint and not queue.closed:
+            self.hint(queue, payload)
+
+    def hint(self, queue, payload):
+        """
+        Hand the entries of a failed batch to the hinted handoff
+        :return None:
+        """
+        if self.handoff is not None:
+            self.handoff.hint(queue.node_address, payload['causal-context'])
+
+    def stats(self):
+        """
+        Depth, lag and batching of every replica's queue
+        :return dict:
+        """
+        now = time.time()
+
+        with self.lock:
+            queues = list(self.queues.values())
+
+        return {queue.node_address: queue.stats(now) for queue in queues}
+
+
+class Replicator(object):
+    """
+        Sends a write to every other replica of a shard in parallel and
+        waits for as many acknowledgements as the write policy requires
+    """
+    def __init__(self, transport, policy=myconstants.DEFAULT_WRITE_ACK, max_workers=myconstants.REPLICATION_WORKERS,
+                 handoff=None):
+        """
+        :param handoff: optional HintedHandoff keeping the writes a replica missed
+        """
+        self.transport = transport
+        self.policy = policy
+        self.handoff = handoff
+        self.pipeline = ReplicationPipeline(transport, handoff)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.histograms = {}
+
+        for name in ACK_POLICIES:
+            self.histograms[name] = LatencyHistogram()
+
+    def required_acks(self, policy, peer_count):
+        """
+        Number of remote acknowledgements a policy waits for. The local
+        write counts towards the quorum, so a shard of 3 replicas needs 1 peer
+        :param policy: write acknowledgement policy
+        :param peer_count: number of other replicas in the shard
+        :return int:
+        """
+        if policy == ACK_ONE:
+            return min(1, peer_count)
+        if policy == ACK_QUORUM:
+            # majority of (peer_count + 1) replicas, minus the local write
+            return (peer_count + 1) // 2
+        if policy == ACK_ALL:
+            return peer_count
+
+        return 0
+
+    def send(self, method, node_address, key, payload, path=None):
+        """
+        Send a single replicate request to another node. A write the replica
+        could not be reached for, or failed with a 5xx, is handed to the hinted handoff
+        :param path: optional path to send to instead of proxy/replicate/<key>
+        :return bool: True if the replica acknowledged the write
+        """
+        try:
+            resp = self.transport.request(method, node_address, path or 'proxy/replicate/' + key, json=payload)
+            if acknowledged(resp):
+                return True
+            if not retriable(resp):
+                return False
+        except (requests.Timeout, requests.exceptions.ConnectionError):
+            print('Error: we were not able to communicate with another replica')
+
+        # writes passed on to an old shard during a view change are not hinted
+        if self.handoff is not None and 'transition' not in payload:
+            self.handoff.hint(node_address, payload['causal-context'])
+
+        return False
+
+    def replicate(self, method, peers, key, payload, policy=None, path=None):
+        """
+        Fan out a write to all peers concurrently, one request per peer.
+        Returns as soon as the policy is satisfied, remaining sends finish
+        in the background
+        :param method: 'PUT' or 'DELETE'
+        :param peers: addresses of the other replicas in the shard
+        :param key: key being written
+        :param payload: json body for /proxy/replicate/<key>
+        :param policy: optional policy overriding the node default
+        :param path: optional path to send to instead of proxy/replicate/<key>
+        :return bool: True if enough replicas acknowledged the write
+        """
+        futures = [self.pool.submit(self.send, method, node_address, key, payload, path) for node_address in peers]
+
+        return self.wait(futures, policy or self.policy, time.time())
+
+    def replicate_entries(self, peers, entries, policy=None):
+        """
+        Queue the causal context entries of a write for every peer. Returns
+        as soon as the policy is satisfied, so with the local policy right away
+        :param peers: addresses of the other replicas in the shard
+        :param entries: key -> causal context entry
+        :param policy: optional policy overriding the node default
+        :return bool: True if enough replicas acknowledged the write
+        """
+        start = time.time()
+        futures = [self.pipeline.submit(node_address, entries) for node_address in peers]
+
+        return self.wait(futures, policy or self.policy, start)
+
+    def wait(self, futures, policy, start):
+        """
+        Wait for as many acknowledgements of a write as a policy requires
+        :param futures: one future per peer, True if the peer acknowledged
+        :return bool: True if the policy is satisfied
+        """
+        peer_count = len(futures)
+        required = self.required_acks(policy, peer_count)
+
+        acks = 0
+        failures = 0
+
+        if required > 0:
+            for future in as_completed(futures):
+                if future.result():
+                    acks += 1
+                else:
+                    failures += 1
+
+                # stop waiting once satisfied, or once it can no longer be satisfied
+                if acks >= required or peer_count - failures < required:
+                    break
+
+        self.histograms[policy].record(time.time() - start)
+
+        return acks >= required
+
+    def stats(self):
+        """
+        Latency histograms of every write policy
+        :return dict:
+        """
+        response = {}
+        response['policy'] = self.policy
+
+        for name in ACK_POLICIES:
+            response[name] = self.histograms[name].to_dict()
+
+        response['queues'] = self.pipeline.stats()
+
+        return response
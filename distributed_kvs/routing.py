@@ -0,0 +1,129 @@
+"""
+    Routing of keys to shards. A view's hash ring is built once into a
+    sorted array of virtual node hashes, and a key's shard is found with a
+    single bisect. Points are placed like uhashring's default ring (160
+    virtual nodes per shard, md5 of "<shard>-<n>") so keys keep their shard
+"""
+
+from bisect import bisect_right
+from functools import lru_cache
+from hashlib import md5
+import myconstants
+
+
+def hashi(key):
+    """
+    Position of a key on the ring
+    :return int: the 128 bit md5 of the key
+    """
+    return int.from_bytes(md5(str(key).encode('utf-8')).digest(), 'big')
+
+
+class HashRing(object):
+    """
+        Sorted positions of the virtual nodes of a set of shards, and the
+        shard owning each of them. A position belongs to the first virtual
+        node at or after it, wrapping around the end of the ring
+    """
+    def __init__(self, shards, vnodes=myconstants.RING_VNODES):
+        """
+        :param shards: shard ids on the ring
+        :param vnodes: virtual nodes per shard
+        """
+        points = {}
+
+        # when two virtual nodes collide the later shard keeps the point
+        for shard_id in shards:
+            for i in range(vnodes):
+                points[hashi('{0}-{1}'.format(shard_id, i))] = shard_id
+
+        self.shards = list(shards)
+        self.positions = sorted(points)
+        self.owners = [points[position] for position in self.positions]
+        self.hashi = hashi
+
+    def get_node(self, key):
+        """
+        Shard of a key
+        :return: shard id, None if the ring is empty
+        """
+        if not self.positions:
+            return None
+
+        return self.owners[bisect_right(self.positions, hashi(key)) % len(self.positions)]
+
+    def get_points(self):
+        """
+        (position, shard id) of every virtual node, in ring order
+        :return list:
+        """
+        return list(zip(self.positions, self.owners))
+
+
+@lru_cache(maxsize=myconstants.RING_CACHE_SIZE)
+def cached_ring(shards):
+    """
+    Ring of a tuple of shard ids, built once for every view using it
+    :return HashRing:
+    """
+    return HashRing(shards)
+
+
+class RoutingTable(object):
+    """
+        Everything needed to route keys in a view: the hash ring of its
+        shards and the replicas of every shard
+    """
+    def __init__(self, partitions):
+        """
+        :param partitions: shard_id -> replicas
+        """
+        self.partitions = {shard_id: list(replicas) for shard_id, replicas in partitions.items()}
+        self.ring = cached_ring(tuple(self.partitions))
+
+        self.positions = self.ring.positions
+        self.owners = self.ring.owners
+        self.hashi = hashi
+
+    def get_node(self, key):
+        """
+        Shard of a key
+        :return: shard id, None if the view is empty
+        """
+        positions = self.positions
+
+        if not positions:
+            return None
+
+        return self.owners[bisect_right(positions, hashi(key)) % len(positions)]
+
+    def get_points(self):
+        return self.ring.get_points()
+
+    def replicas(self, key):
+        """
+        Replicas of the shard of a key
+        :return list: node addresses
+        """
+        return self.partitions.get(self.get_node(key), [])
+
+    def route_many(self, keys):
+        """
+        Group keys by shard
+        :param keys: iterable of keys
+        :return dict: shard_id -> keys of the shard, in the order given
+        """
+        positions = self.positions
+        owners = self.owners
+        count = len(positions)
+        routes = {}
+
+        if not count:
+            return routes
+
+        for key in keys:
+            digest = md5(str(key).encode('utf-8')).digest()
+            shard_id = owners[bisect_right(positions, int.from_bytes(digest, 'big')) % count]
+            routes.setdefault(shard_id, []).append(key)
+
+        return routes
@@ -0,0 +1,138 @@
+"""
+    Choice of the replica a forwarded request goes to. Requests are spread
+    over the replicas of a shard with the power of two choices: of two
+    random replicas the one with the lower expected wait is tried first
+"""
+
+import random
+import threading
+import time
+import myconstants
+
+
+class ReplicaSelector(object):
+    """
+        Orders the replicas of a shard for a forwarded request. Response
+        times and requests in flight are measured on the requests sent
+        through request(), peers which could not be reached come from the
+        transport
+    """
+    def __init__(self, transport, rng=None):
+        """
+        :param transport: PeerTransport sending the requests
+        :param rng: optional random.Random, for repeatable choices
+        """
+        self.transport = transport
+        self.rng = rng or random.Random()
+
+        self.lock = threading.Lock()
+        self.latency = {}           # node_address -> moving average of response times in seconds
+        self.sampled_at = {}        # node_address -> time of the last response time
+        self.inflight = {}          # node_address -> requests waiting for an answer
+
+    def request(self, method, node_address, path, **kwargs):
+        """
+        Send a forwarded request, measuring how long the replica takes
+        :return requests.Response:
+        """
+        start = self.begin(node_address)
+
+        try:
+            resp = self.transport.request(method, node_address, path, **kwargs)
+        finally:
+            seconds = self.end(node_address, start)
+
+        self.record(node_address, seconds)
+
+        return resp
+
+    def begin(self, node_address):
+        """
+        Count a request sent to a replica as in flight
+        :return float: time the request started
+        """
+        with self.lock:
+            self.inflight[node_address] = self.inflight.get(node_address, 0) + 1
+
+        return time.time()
+
+    def end(self, node_address, start):
+        """
+        Count a request as answered or failed
+        :return float: seconds the request took
+        """
+        seconds = time.time() - start
+
+        with self.lock:
+            self.inflight[node_address] -= 1
+
+        return seconds
+
+    def record(self, node_address, seconds):
+        """
+        Fold a response time into the replica's moving average, an average
+        gone stale starts over from the new response time
+        :return None:
+        """
+        alpha = myconstants.LATENCY_EWMA_ALPHA
+        now = time.time()
+
+        with self.lock:
+            average = self.latency.get(node_address)
+
+            if average is None or now - self.sampled_at[node_address] > myconstants.LATENCY_STALE_SECONDS:
+                self.latency[node_address] = seconds
+            else:
+                self.latency[node_address] = alpha * seconds + (1 - alpha) * average
+
+            self.sampled_at[node_address] = now
+
+    def score(self, node_address):
+        """
+        Expected wait of a request sent to a replica. Replicas without a
+        recent response time score 0, so they get requests and are measured
+        again, e.g. after a slow first request which opened the connection
+        :return float:
+        """
+        if time.time() - self.sampled_at.get(node_address, 0) > myconstants.LATENCY_STALE_SECONDS:
+            return 0.0
+
+        return self.latency.get(node_address, 0) * (self.inflight.get(node_address, 0) + 1)
+
+    def order(self, replicas, exclude=None):
+        """
+        Replicas in the order to try them. The better of two random available
+        replicas comes first, then the other available replicas by score, and
+        replicas which just failed come last, only tried if all others fail
+        :param replicas: addresses of the replicas of a shard
+        :param exclude: optional address to leave out, e.g. this node
+        :return list:
+        """
+        candidates = [node_address for node_address in replicas if node_address != exclude]
+        available = [node_address for node_address in candidates if self.transport.available(node_address)]
+        down = [node_address for node_address in candidates if node_address not in available]
+
+        if len(available) < 2:
+            return available + down
+
+        first, second = self.rng.sample(available, 2)
+
+        if self.score(second) < self.score(first):
+            first = second
+
+        rest = sorted((node_address for node_address in available if node_address != first), key=self.score)
+
+        return [first] + rest + down
+
+    def stats(self):
+        """
+        Response time and requests in flight of every replica
+        :return dict:
+        """
+        with self.lock:
+            return {node_address: {
+                        'latency-ms': self.latency[node_address] * 1000.0,
+                        'inflight': self.inflight.get(node_address, 0),
+                        'score-ms': self.score(node_address) * 1000.0,
+                        'available': self.transport.available(node_address)
+                    } for node_address in self.latency}
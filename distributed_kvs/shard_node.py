@@ -2,8 +2,9 @@
     Implementation of shard node
 """
 
-from flask import Flask, request, jsonify
-from uhashring import HashRing
+from flask import Flask, Response, request
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import json
 import requests
 import myconstants
@@ -11,44 +12,164 @@ import os
 import sys
 import time
 import threading
-from subprocess import check_call
-
-def gossip_task():
-    """
-    Trigger handle gossip every few seconds
-    """
-    url = os.path.join('http://', '127.0.0.1:13800', 'proxy/handle-gossip')
-    command = 'curl --request GET {0}'.format(url)
-    while True:
-        time.sleep(2)
-        try:
-            check_call(command, shell=True)
-        except:
-            print('Error: triggering gossip')
+import uuid
+from replication import Replicator, ACK_POLICIES, ACK_ONE
+from transport import PeerTransport
+from handoff import HintedHandoff
+from gossip import GossipScheduler
+from changelog import ChangeLog
+from merkle import MerkleTree
+from hlc import HybridLogicalClock
+from storage import MemoryStorage, MISSING, create_storage, prefix_end
+from wal import WriteAheadLog
+from migration import MigrationSender, MigrationPlan, decode_batch
+from coordinator import ViewChangeCoordinator
+from routing import RoutingTable
+from selection import ReplicaSelector
+from codec import NodeRequest, jsonify
+import codec
 
 class ShardNodeWrapper(object):
     """
         Class object to wrapp around Flask server and
         needed variables e.g., key-value store
     """
-    def __init__(self, ip, port, view, repl_factor):
+    def __init__(self, ip, port, view, repl_factor, write_ack=myconstants.DEFAULT_WRITE_ACK,
+                 gossip_interval=myconstants.GOSSIP_INTERVAL, data_dir=None, storage=myconstants.DEFAULT_STORAGE):
         self.app = Flask(__name__)                  # The Flask Server (Node)
-        self.kv_store = {}                          # The local key-value store
+        self.app.request_class = NodeRequest        # views read msgpack bodies of peers as json
+        self.kv_store = MemoryStorage()             # The local key-value store
         self.view = view.split(',')                 # The view, IP and PORT address of other nodes
         self.ip = ip
         self.port = port
         self.address = ''
         self.repl_factor = repl_factor
-        self.causal_context = {}
+        self.causal_context = {}                    # key -> version of its latest write, values are in kv_store
         self.currentHashRing = None
+        self.replicas = []
+        self.transport = PeerTransport()
+        self.selector = ReplicaSelector(self.transport)   # replica forwarded requests go to
+        self.handoff = HintedHandoff(self.transport)      # writes replicas missed
+        self.replicator = Replicator(self.transport, write_ack, handoff=self.handoff)
+        self.gossip = GossipScheduler(self.transport, self.gossip_peers, self.gossip_payload,
+                                      self.gossip_reply, self.merkle_repair, interval=gossip_interval)
+        self.merkle = MerkleTree()                  # hash tree of kv_store and tombstones
+        self.changelog = ChangeLog()                # sequence numbers of causal context changes
+        self.incarnation = uuid.uuid4().hex         # changes every time the node restarts
+        self.gossip_acked = {}                      # peer -> last changelog seq the peer acknowledged
+        self.peer_incarnations = {}                 # peer -> incarnation seen in its last gossip reply
+        self.received_seq = {}                      # peer -> last seq of the peer's changes we have
+        self.received_incarnation = {}              # peer -> incarnation of the changes we have
+        self.synced = {}                            # peer -> clock up to which we have the peer's writes
+        self.context_lock = threading.RLock()       # guards causal context changes
+        self.clock = HybridLogicalClock(myconstants.HLC_MAX_OFFSET)   # version stamps of writes
+        self.data_dir = data_dir                    # directory of the write-ahead log, None keeps everything in memory
+        self.wal = None
+        self.storage = storage                      # name of the storage engine
+        self.migrator = MigrationSender(self.transport)
+        self.migrations = {}                        # migration id -> last batch received
+        self.batch_pool = ThreadPoolExecutor(max_workers=myconstants.BATCH_WORKERS)
+        self.pending_view = None                    # view change prepared but not committed yet
+        self.transition = None                      # view change committed but not finished yet
+        self.finished_view = None                   # id of the latest finished view change
+        self.coordinator = ViewChangeCoordinator(self.transport, self.address, self.prepare_view,
+                                                 self.commit_view, self.finish_view, self.abort_view)
 
     def setup_gossip(self):
-        threading.Thread(target=gossip_task).start()
+        """
+        Start the gossip thread, GOSSIP_INTERVAL overrides the interval in seconds
+        :return None:
+        """
+        interval = os.environ.get('GOSSIP_INTERVAL')
+
+        if interval:
+            self.gossip.interval = float(interval)
+
+        self.gossip.start()
+
+    def setup_storage(self):
+        """
+        Create the storage engine, STORAGE overrides the engine. On-disk engines
+        keep their files in <data dir>/store, or a temporary directory
+        :return None:
+        """
+        storage = os.environ.get('STORAGE')
+
+        if storage:
+            self.storage = storage
+
+        data_dir = os.environ.get('DATA_DIR') or self.data_dir
+        directory = os.path.join(data_dir, 'store') if data_dir else None
+
+        self.kv_store = create_storage(self.storage, directory)
+
+    def setup_wal(self):
+        """
+        Recover the node from its write-ahead log and start logging changes,
+        DATA_DIR overrides the directory. Without a directory nothing is persisted
+        :return None:
+        """
+        data_dir = os.environ.get('DATA_DIR')
+
+        if data_dir:
+            self.data_dir = data_dir
+
+        if not self.data_dir:
+            return
+
+        self.wal = WriteAheadLog(self.data_dir, checkpoint=self.checkpoint)
+        snapshot, records = self.wal.open()
+        recovered = self.recover(snapshot, records)
+        self.wal.start()
+
+        if snapshot is None and recovered == 0:
+            # first start with this directory, peers may keep their watermarks
+            # of this node only while it comes back with the same incarnation
+            self.log_change({'op': 'incarnation', 'id': self.incarnation})
+
+        print('Recovered {0} keys and {1} log records from {2}'.format(self.kv_store.count(), recovered, self.data_dir))
+
+    def setup_hints(self):
+        """
+        Start replaying hinted writes. With a data directory hints are kept
+        in <data dir>/hints, so they are replayed after a restart too
+        :return None:
+        """
+        if self.data_dir:
+            self.handoff.open(os.path.join(self.data_dir, 'hints'))
+
+        self.handoff.start()
+
+    def setup_codec(self, name=myconstants.DEFAULT_CODEC):
+        """
+        Encoding of /proxy/* requests, CODEC overrides it. With msgpack the
+        node tells peers in every answer that it takes msgpack, and sends
+        msgpack to the peers which told it so. Other peers get JSON
+        :param name: 'msgpack' or 'json'
+        :return None:
+        """
+        name = os.environ.get('CODEC') or name
+
+        if name == 'msgpack' and not codec.available():
+            print('Error: msgpack is not installed, talking JSON to other nodes')
+            name = 'json'
+
+        if name != 'msgpack':
+            return
+
+        self.transport.content_type = codec.MSGPACK
+        self.app.after_request(self.advertise_codecs)
+
+    def advertise_codecs(self, response):
+        response.headers[codec.CODECS_HEADER] = 'msgpack'
+        return response
 
     def setup_routes(self):
         """
         Method used to set up the url rules for the Flask app
             /kvs/keys/<key>
+            /kvs/batch
+            /kvs/scan
             /kvs/key-count
             /kvs/view-change
         :return None:
@@ -59,6 +180,10 @@ class ShardNodeWrapper(object):
                 rule='/kvs/view-change', endpoint='view_change', view_func=self.view_change, methods=['PUT'])
         self.app.add_url_rule(
                 rule='/kvs/keys/<string:key>', endpoint='keys', view_func=self.keys, methods=['GET', 'PUT', 'DELETE'])
+        self.app.add_url_rule(
+                rule='/kvs/batch', endpoint='batch', view_func=self.batch, methods=['GET', 'PUT', 'DELETE'])
+        self.app.add_url_rule(
+                rule='/kvs/scan', endpoint='scan', view_func=self.scan, methods=['GET'])
         self.app.add_url_rule(
                 rule='/kvs/shards', endpoint='shards', view_func=self.shards, methods=['GET'])
         self.app.add_url_rule(
@@ -69,19 +194,54 @@ class ShardNodeWrapper(object):
             /proxy/kvs/keys/<key>
         """
         self.app.add_url_rule(
-                rule='/proxy/replicate/<string:key>', endpoint='replicate', view_func=self.replicate, methods=['PUT'])
+                rule='/proxy/replicate/<string:key>', endpoint='replicate', view_func=self.replicate, methods=['PUT', 'DELETE'])
         self.app.add_url_rule(
                 rule='/proxy/kvs/keys/<string:key>', endpoint='proxy_keys', view_func=self.proxy_keys, methods=['GET', 'PUT', 'DELETE'])
+        self.app.add_url_rule(
+                rule='/proxy/batch', endpoint='proxy_batch', view_func=self.proxy_batch, methods=['GET', 'PUT', 'DELETE'])
+        self.app.add_url_rule(
+                rule='/proxy/scan', endpoint='proxy_scan', view_func=self.proxy_scan, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/replicate-batch', endpoint='replicate_batch', view_func=self.replicate_batch, methods=['PUT'])
         self.app.add_url_rule(
                 rule='/proxy/view-change', endpoint='proxy_view_change', view_func=self.proxy_view_change, methods=['PUT'])
+        # prepare, commit or abort phase of a view change
+        self.app.add_url_rule(
+                rule='/proxy/view-change/<string:phase>', endpoint='proxy_view_change_phase', view_func=self.proxy_view_change_phase, methods=['PUT'])
+        self.app.add_url_rule(
+                rule='/proxy/view-change-status', endpoint='view_change_status', view_func=self.view_change_status, methods=['GET'])
         # receive dictionary from other nodes
         self.app.add_url_rule(
                 rule='/proxy/receive-dict', endpoint='proxy_receive_dict', view_func=self.proxy_receive_dict, methods=['PUT'])
+        # receive keys moving to this node in batches
+        self.app.add_url_rule(
+                rule='/proxy/migrate/<string:migration_id>', endpoint='proxy_migrate', view_func=self.proxy_migrate, methods=['GET', 'PUT'])
+        # hand a single key to its new shard before its migration arrived
+        self.app.add_url_rule(
+                rule='/proxy/migrate-key/<string:key>', endpoint='proxy_migrate_key', view_func=self.proxy_migrate_key, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/migration-stats', endpoint='migration_stats', view_func=self.migration_stats, methods=['GET'])
         # used to trigger gossip
         self.app.add_url_rule(
                 rule='/proxy/handle-gossip', endpoint='handle_gossip', view_func=self.handle_gossip, methods=['GET'])
         self.app.add_url_rule(
                 rule='/proxy/node-causal-context', endpoint='node_causal_context', view_func=self.node_causal_context, methods=['GET', 'PUT'])
+        self.app.add_url_rule(
+                rule='/proxy/replication-stats', endpoint='replication_stats', view_func=self.replication_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/merkle', endpoint='merkle', view_func=self.handle_merkle, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/gossip-stats', endpoint='gossip_stats', view_func=self.gossip_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/replica-stats', endpoint='replica_stats', view_func=self.replica_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/hint-stats', endpoint='hint_stats', view_func=self.hint_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/health-stats', endpoint='health_stats', view_func=self.health_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/transport-stats', endpoint='transport_stats', view_func=self.transport_stats, methods=['GET'])
+        self.app.add_url_rule(
+                rule='/proxy/wal-stats', endpoint='wal_stats', view_func=self.wal_stats, methods=['GET'])
 
 
     def setup_view(self):
@@ -107,6 +267,22 @@ class ShardNodeWrapper(object):
         if repl_value:
             self.repl_factor = int(repl_value)
 
+    def setup_write_ack(self):
+        """
+        Function used to set up the write acknowledgement policy at initiation
+        :return None:
+        """
+        write_ack = os.environ.get('WRITE_ACK')
+
+        if not write_ack:
+            return
+
+        if write_ack not in ACK_POLICIES:
+            print('Error: WRITE_ACK must be one of {0}, not {1}'.format(', '.join(ACK_POLICIES), write_ack))
+            sys.exit(1)
+
+        self.replicator.policy = write_ack
+
     def setup_pototetial_replicas(self):
         """
         Determine which nodes in the view should be this nodes replica
@@ -123,9 +299,8 @@ class ShardNodeWrapper(object):
         # create dictionary for entire all shard_ids -> replicas
         self.all_partitions = replica_partitions
 
-        # get list of shard_id's for current_hash_ring
-        shards = list(self.all_partitions.keys())
-        self.currentHashRing = HashRing(nodes=shards)
+        # routing table of the current view
+        self.currentHashRing = RoutingTable(self.all_partitions)
 
         # look for shard_id and replicas list for this node
         for key in replica_partitions:
@@ -148,12 +323,40 @@ class ShardNodeWrapper(object):
         else:
             self.address = str(self.ip) + ':' + str(self.port)
 
-    def run(self):
+        self.coordinator.address = self.address
+
+    def run(self, server=myconstants.DEFAULT_SERVER, threads=myconstants.SERVER_THREADS):
         """
-        Method to start flask server
+        Method to start the server
+            dev         Flask development server with the debugger on
+            production  waitress, a multi-threaded production WSGI server
+            asyncio     aiohttp event loop, see aio_node.py
+        The node's state lives in this process, so it scales with threads
+        rather than worker processes
+        :param server: 'dev', 'production' or 'asyncio'
+        :param threads: number of threads handling requests in production,
+                        or running Flask views with asyncio
         :return None:
         """
-        self.app.run(host=self.ip, port=self.port, debug=True)
+        if server == 'dev':
+            # the reloader would start a second copy of the node, gossip thread included
+            self.app.run(host=self.ip, port=self.port, debug=True, use_reloader=False)
+            return
+
+        if server == 'asyncio':
+            from aio_node import AsyncNodeRuntime
+
+            AsyncNodeRuntime(self, threads).serve(self.ip, self.port)
+            return
+
+        try:
+            from waitress import serve
+        except ImportError:
+            print('Error: waitress is not installed, install requirements.txt or run with -s dev')
+            sys.exit(1)
+
+        serve(self.app, host=self.ip, port=self.port, threads=threads,
+              connection_limit=myconstants.SERVER_CONNECTION_LIMIT)
 
     def key_count(self):
         """
@@ -162,7 +365,7 @@ class ShardNodeWrapper(object):
         :return count: the total count of keys in the store
         """
         response = {}
-        count = len(self.kv_store)
+        count = self.kv_store.count()
 
         response['message'] = 'Key count retrieved successfully'
         response['key-count'] = count
@@ -197,7 +400,7 @@ class ShardNodeWrapper(object):
         if shard_id == self.shard_id:
             response['message'] = 'Shard information retrieved successfully'
             response['shard-id'] = self.shard_id
-            response['key-count'] = len(self.kv_store)
+            response['key-count'] = self.kv_store.count()
             response['replicas'] = self.replicas
             code = 200
 
@@ -210,10 +413,8 @@ class ShardNodeWrapper(object):
         #    of their key-count
         for node_address in replicas:
             # send a /kvs/key-count request
-            url = os.path.join('http://', node_address, 'kvs/key-count')
-
             try:
-                resp = requests.get(url, timeout=myconstants.TIMEOUT)
+                resp = self.transport.get(node_address, 'kvs/key-count')
 
                 # if we get a response
                 json_resp = json.loads(resp.text)
@@ -225,273 +426,382 @@ class ShardNodeWrapper(object):
                 code = 200
 
                 return jsonify(response), code
-            except:
+            except (requests.exceptions.RequestException, ValueError, KeyError):
                 print('Error: cannot contact shard node')
 
-        # Maybe handle the case that all nodes in shard_id are down?
-        # However, TA said this will not occur
+        response['message'] = 'Error in GET'
+        response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
 
+        return jsonify(response), 503
 
 
     def view_change(self):
         """
         Method used to handle the changing of a view
-        in the distributed key-value store
+        in the distributed key-value store. Every node of the old and new
+        view is told at once to prepare, then to commit the view, and the
+        view change answers once all of them sent their keys
         :return status: the status of the HTTP PUT request
         """
-        self.causal_context = {}
         response = {}
 
         # Only accepting PUT requests
-        try:
-            contents = request.get_json()
-        except:
-            print('Error: Invalid json')
+        contents = request.get_json(silent=True)
 
         try:
-            new_view = contents['view']
-        except:
-            print('Error: unable to get new view key value from json')
+            view_list = list(contents['view'].split(','))
+            repl_factor = int(contents['repl-factor'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            print('Error: unable to get new view and repl-factor from json')
+            response['error'] = 'Bad view change'
+            response['message'] = 'Error in PUT'
+            return jsonify(response), 400
+
+        # every node names its migrations after the view change, and plans
+        # them from the view this node had before
+        body = {}
+        body['view'] = contents['view']
+        body['repl-factor'] = repl_factor
+        body['view-id'] = uuid.uuid4().hex
+        body['old-partitions'] = self.all_partitions
 
         """
-            0. We need to determine the replicas given a replication factor
+            1. Prepare and commit the view on all nodes of the old and new view
         """
-        repl_factor = int(contents['repl-factor'])
-        partitions = {}
+        all_nodes = []
 
-        view_list = list(new_view.split(','))
-        count = 1
+        for node_address in self.view + view_list:
+            if node_address not in all_nodes:
+                all_nodes.append(node_address)
 
-        for i in range(0, len(view_list), repl_factor):
-            partitions[str(count)] = view_list[i : i + repl_factor]
-            count += 1
+        if not self.coordinator.run(body, all_nodes):
+            status = self.coordinator.status()
+            response['error'] = status.get('error')
+            response['message'] = 'View change failed'
+            response['view-change'] = status
+            return jsonify(response), 503
 
-        # get shard_id's for current hash ring
-        shards = list(partitions.keys())
-        self.currentHashRing = HashRing(nodes=shards)
+        """
+            2. All nodes are done resharding so query for meta data
+        """
+        response['message'] = 'View change successful'
+        response['shards'] = []
+        code = 200
 
-        # create dictionary for entire all shard_ids -> replicas
-        self.all_partitions = partitions
+        others = {shard_id: replicas for shard_id, replicas in self.all_partitions.items() if self.address not in replicas}
+        key_counts = self.coordinator.key_counts(others)
 
-        # look for shard_id and replicas list for this node
-        for key in partitions:
-            value = partitions[key]
-            if self.address in value:
-                self.replicas = value
-                self.shard_id = str(key)
+        if self.address in view_list:
+            key_counts[self.shard_id] = self.kv_store.count()
+
+        for shard_id in self.all_partitions:
+            node_data = {}
 
-        new_dict = {}
+            if key_counts[shard_id] is not None:
+                node_data['shard-id'] = shard_id
+                node_data['key-count'] = key_counts[shard_id]
+                node_data['replicas'] = self.all_partitions[shard_id]
+
+            response['shards'].append(node_data)
 
-        # at this point we need to perform hashing
-        # create id to shard_node replica dictionary
+        status = self.coordinator.status()
+        print('View change {0} took {1:.0f} ms'.format(status['view-id'], status['total-ms']))
 
+        return jsonify(response), code
+
+    def view_change_status(self):
         """
-            1. Tell all other nodes in old view to re hash keys
+        Function used to get the progress and timing of every node in
+        the latest view change this node coordinated
         """
-        all_nodes = self.view
-        all_nodes.extend(view_list)
-        all_nodes = set(all_nodes)
-        all_nodes = list(all_nodes)
+        return jsonify(self.coordinator.status()), 200
 
-        for node_address in all_nodes:
-            # do not execute loop if node_address is our own address
-            if node_address == self.address:
-                continue
+    def proxy_view_change_phase(self, phase):
+        """
+        Method to handle a phase of a view change coordinated by another node
+            prepare     check the new view and keep it until the commit
+            commit      switch to the new view and send the keys changing owner,
+                        the answer is the ack that the migration is done
+            finish      forget the old view and drop the keys which moved away
+            abort       forget the prepared view
+        """
+        handlers = {'prepare': self.prepare_view, 'commit': self.commit_view, 'finish': self.finish_view,
+                    'abort': self.abort_view}
+        response = {}
 
-            url = os.path.join('http://', node_address, 'proxy/view-change')
+        try:
+            contents = request.get_json()
+            answer = handlers[phase](contents)
+        except (KeyError, TypeError, ValueError):
+            print('Error: bad {0} of view change'.format(phase))
+            response['error'] = 'Bad view change'
+            response['message'] = 'Error in PUT'
+            return jsonify(response), 400
 
-            try:
-                resp = requests.put(url, json=request.get_json(), timeout=myconstants.TIMEOUT)
-            except:
-                print('Error: cannot notify shard node of view change')
+        return jsonify(answer), 200
 
+    def proxy_view_change(self):
         """
-            2. Hash keys
+        Method to handle receiving a proxy view change in one step, from
+        nodes coordinating view changes without the prepare phase
         """
-        for key in shards:
-            new_dict[str(key)] = {}
+        contents = request.get_json()
+        contents.setdefault('view-id', uuid.uuid4().hex)
+        self.commit_view(contents)
+        self.finish_view(contents)
 
-        for key in self.kv_store:
-            new_shard = self.currentHashRing.get_node(key)
-            new_dict[new_shard][key] = self.kv_store[key]
+        return jsonify({}), 200
 
+    def prepare_view(self, body):
         """
-            3. Update VIEW
+        Function used to check a new view and keep it until it is committed.
+        Other nodes may commit first and send us requests routed with the new
+        view, so keys moving here are already fetched from their old shard
+        :param body: view change with 'view', 'repl-factor', 'view-id' and 'old-partitions'
+        :return dict: the node's answer
         """
-        self.view = view_list
+        pending = self.plan_transition(body)
 
-        """
-            4. Now need to determine which keys will stay
-            on this current node
-        """
-        new_kv_store = {}
+        with self.context_lock:
+            self.pending_view = pending
 
-        for key in new_dict:
-            if self.shard_id == key:
-                new_kv_store = new_dict[key].copy()
+        answer = {}
+        answer['prepared'] = body['view-id']
+        answer['keys-before'] = self.kv_store.count()
 
-        self.kv_store = new_kv_store
+        return answer
 
+    def abort_view(self, body):
         """
-            5. Now need to send other nodes their new key values
-            TODO: what about updating own replicas?
-            NOTE: I think they would have determined which nodes to keep on their own
+        Function used to forget a prepared or committed view
+        :return dict: the node's answer
         """
-        for shard_id in new_dict:
-            replicas = self.all_partitions[shard_id]
+        transition = self.transition
 
-            for node_address in replicas:
-                if node_address == self.address:
-                    continue
+        if transition is not None and transition['view-id'] == body['view-id']:
+            return self.rollback_view(transition)
 
-                url = os.path.join('http://', node_address, 'proxy/receive-dict')
-                payload = json.dumps(new_dict[shard_id])
+        with self.context_lock:
+            pending = self.pending_view
 
-                try:
-                    resp = requests.put(url, json=payload, timeout=myconstants.TIMEOUT)
-                except:
-                    print('TODO: better error handling sending dictionary to another shard node')
+            if pending is None or pending['view-id'] != body['view-id']:
+                return {'aborted': body['view-id']}
+
+            self.pending_view = None
+
+            # keys fetched for the new view are not ours in the old one
+            self.drop_keys(list(pending['pulled']))
+
+        return {'aborted': body['view-id']}
 
+    def rollback_view(self, transition):
         """
-            6. Hopefully by this time we all nodes are done resharding so query for meta data
+        Function used to go back to the view a committed view change started
+        from. Until the view change finishes the old replicas keep their keys
+        and get the writes of keys moving away, so only the keys received
+        for the new view are dropped
+        :param transition: the committed view change
+        :return dict: the node's answer
         """
-        response['message'] = 'View change successful'
-        response['shards'] = []
-        code = 200
+        old_partitions = transition['old-partitions']
+        view_list = []
+        replicas = []
+        shard_id = None
 
-        for shard_id in self.all_partitions:
-            node_data = {}
+        for key in old_partitions:
+            view_list.extend(old_partitions[key])
 
-            if shard_id == self.shard_id:
-                node_data['shard-id'] = shard_id
-                node_data['key-count'] = len(self.kv_store)
-                node_data['replicas'] = self.all_partitions[shard_id]
-            else:
-                for node_address in self.all_partitions[shard_id]:
-                    url = os.path.join('http://', node_address, 'kvs/key-count')
+            if self.address in old_partitions[key]:
+                replicas = old_partitions[key]
+                shard_id = str(key)
 
-                    try:
-                        resp = requests.get(url, timeout=myconstants.TIMEOUT)
+        with self.context_lock:
+            self.transition = None
+            self.all_partitions = old_partitions
+            self.replicas = replicas
+            self.shard_id = shard_id
+            self.currentHashRing = RoutingTable(old_partitions)
+            self.view = view_list
+            self.gossip.reset()
 
-                        json_resp = json.loads(resp.text)
-                        node_data['shard-id'] = shard_id
-                        node_data['key-count'] = json_resp['key-count']
-                        node_data['replicas'] = self.all_partitions[shard_id]
-                        break
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        print('Not able to get key count of annother shard')
+            drop = transition['plan'].rollback(self.address, self.kv_store.keys())
+            self.drop_keys(drop)
 
-            response['shards'].append(node_data)
+        self.reset_causal_context()
+        self.forget_former_replicas()
+
+        answer = {}
+        answer['aborted'] = transition['view-id']
+        answer['keys-dropped'] = len(drop)
 
+        return answer
+
+    def forget_former_replicas(self):
         """
-            7. Reset causal context
+        Function used to drop the hints and the replication queues of nodes
+        which are not replicas of this shard anymore
+        :return None:
         """
-        self.causal_context = {}
-
-        return jsonify(response), code
+        for node_address in self.handoff.peers():
+            if node_address not in self.replicas:
+                self.handoff.drop(node_address)
 
+        for node_address in self.replicator.pipeline.peers():
+            if node_address not in self.replicas:
+                self.replicator.pipeline.drop(node_address)
 
-    def proxy_view_change(self):
+    def commit_view(self, body):
         """
-        Method to handle receiving a proxy view change. If a node
-        receives a proxy view change, it means that another node was the
-        node who received the initial /view-change from the client
+        Function used to switch to a new view and send the keys changing
+        owner. Until the view change finishes the node keeps the old view
+        around: keys moving here are fetched from their old shard when asked
+        for before their migration arrived, and writes to them are forwarded
+        to the old shard, so requests are served during the whole migration
+        :param body: view change with 'view', 'repl-factor', 'view-id', 'old-partitions'
+                     and optionally 'alive', the nodes which prepared the view
+        :return dict: the node's answer, sent once its keys were acknowledged
         """
-        self.causal_context = {}
-        response = {}
-        code = 200
+        view_list = list(body['view'].split(','))
 
-        # Only accepting PUT requests
-        try:
-            contents = request.get_json()
-        except:
-            print('Error: Invalid json')
+        if self.transition is not None:
+            # the previous view change never finished
+            self.finish_view({'view-id': self.transition['view-id']})
 
-        try:
-            new_view = contents['view']
-        except:
-            print('Error: unable to get new view key value from json')
+        """
+            1. Find the keys changing owner
+        """
+        transition = self.plan_transition(body)
+        partitions = transition['partitions']
+        plan = transition['plan']
 
-        repl_factor = int(contents['repl-factor'])
-        partitions = {}
-        view_list = list(new_view.split(','))
-        count = 1
+        with self.context_lock:
+            pending = self.pending_view
+            self.pending_view = None
 
-        for i in range(0, len(view_list), repl_factor):
-            partitions[str(count)] = view_list[i : i + repl_factor]
-            count += 1
+        if pending is not None and pending['view-id'] == body['view-id']:
+            transition['pulled'] = pending['pulled']
 
-        # create dictionary for entire all shard_ids -> replicas
-        self.all_partitions = partitions
+        """
+            2. Update VIEW, requests see the transition before the new ring
+        """
+        replicas = []
+        shard_id = None
 
         # look for shard_id and replicas list for this node
         for key in partitions:
             value = partitions[key]
             if self.address in value:
-                self.replicas = value
-                self.shard_id = str(key)
+                replicas = value
+                shard_id = str(key)
+
+        self.transition = transition
+        self.all_partitions = partitions
+        self.replicas = replicas
+        self.shard_id = shard_id
+        self.currentHashRing = transition['ring']
+        self.view = view_list
+        self.gossip.reset()
 
-        # at this point we need to perform hashing
-        # create id to shard_node dictionary
-        shard_keys = list(self.all_partitions.keys())
+        """
+            3. Now need to send the keys changing owner to the nodes
+            which do not have them yet
+        """
+        outgoing, _ = plan.split(self.address, self.kv_store.keys())
+        migrations = self.send_keys(body['view-id'], plan, outgoing)
 
-        # hr = HashRing(nodes=shard_keys)
-        self.currentHashRing = HashRing(nodes=shard_keys)
+        answer = {}
+        answer['committed'] = body['view-id']
+        answer['keys-sent'] = sum(stats.keys for stats in migrations)
+        answer['migrations'] = [stats.to_dict() for stats in migrations]
+        answer['migrated'] = all(stats.done for stats in migrations)
 
-        new_dict = {}
+        return answer
 
+    def finish_view(self, body):
         """
-            1. Update VIEW
+        Function used to end a view change once every node sent its keys.
+        The old view is forgotten and the keys which are not ours anymore dropped
+        :param body: view change with 'view-id'
+        :return dict: the node's answer
         """
-        self.view = view_list
+        transition = self.transition
+        answer = {}
+        answer['finished'] = body['view-id']
+
+        if transition is None or transition['view-id'] != body['view-id']:
+            return answer
 
         """
-            2. Hash keys
+            1. Now need to drop the keys which are not ours anymore
         """
-        for key in shard_keys:
-            new_dict[str(key)] = {}
+        with self.context_lock:
+            self.transition = None
+            self.finished_view = transition['view-id']
+            _, drop = transition['plan'].split(self.address, self.kv_store.keys())
+            self.drop_keys(drop)
 
-        for key in self.kv_store:
-            new_shard = self.currentHashRing.get_node(key)
-            new_dict[new_shard][key] = self.kv_store[key]
+        """
+            2. Reset causal context
+        """
+        self.reset_causal_context()
 
         """
-            3. Now need to determine which keys will stay
-            on this current node
+            3. Forget the health of the nodes which left the view, and the
+            hints and queued writes of nodes which are not replicas of this shard anymore
         """
-        new_kv_store = {}
+        for replicas in transition['old-partitions'].values():
+            for node_address in replicas:
+                if node_address not in self.view:
+                    self.transport.health.forget(node_address)
 
-        for key in new_dict:
-            if self.shard_id == key:
-                new_kv_store = new_dict[key].copy()
+        self.forget_former_replicas()
 
-        self.kv_store = new_kv_store
+        answer['keys-dropped'] = len(drop)
+        answer['keys-pulled'] = len(transition['pulled'])
 
+        return answer
+
+    def plan_transition(self, body):
         """
-            4. Now need to send other nodes their new key values.
+        Function used to work out what changes in a view change
+        :param body: view change with 'view', 'repl-factor', 'view-id', 'old-partitions'
+                     and optionally 'alive', the nodes which prepared the view
+        :return dict: the view change's partitions, ring and MigrationPlan
         """
-        for shard_id in new_dict:
-            replicas = self.all_partitions[shard_id]
-
-            for node_address in replicas:
-                if node_address == self.address:
-                    continue
+        partitions = self.view_partitions(body['view'], int(body['repl-factor']))
+        old_partitions = body.get('old-partitions') or self.all_partitions
+        alive = set(body['alive']) if body.get('alive') else None
+        ring = RoutingTable(partitions)
 
-                url = os.path.join('http://', node_address, 'proxy/receive-dict')
-                payload = json.dumps(new_dict[shard_id])
+        transition = {}
+        transition['view-id'] = body['view-id']
+        transition['partitions'] = partitions
+        transition['ring'] = ring
+        transition['plan'] = self.plan_migration(old_partitions, partitions, ring, alive)
+        transition['old-partitions'] = old_partitions
+        transition['pulled'] = set()            # keys already fetched from their old shard
 
-                try:
-                    resp = requests.put(url, json=payload, timeout=myconstants.TIMEOUT)
-                except:
-                    print('TODO: better error handling sending dictionary to another shard node')
+        return transition
 
+    def view_partitions(self, view, repl_factor):
         """
-            5. Reset causal context
+        Function used to split a view into shards
+        :param view: comma separated node addresses
+        :param repl_factor: replicas per shard
+        :return dict: shard_id -> replicas
         """
-        self.causal_context = {}
+        if repl_factor < 1:
+            raise ValueError('repl-factor must be at least 1')
 
-        return jsonify(response), code
+        view_list = list(view.split(','))
+        partitions = {}
+        count = 1
+
+        for i in range(0, len(view_list), repl_factor):
+            partitions[str(count)] = view_list[i : i + repl_factor]
+            count += 1
 
+        return partitions
 
 
     def proxy_receive_dict(self):
@@ -504,484 +814,942 @@ class ShardNodeWrapper(object):
         response['message'] = myconstants.UPDATED_MESSAGE
         code = 200
 
+        contents = request.get_json(silent=True)
+
         try:
-            contents = json.loads(request.get_json())
-        except:
+            # older nodes send the store encoded as a json string
+            if isinstance(contents, str):
+                contents = json.loads(contents)
+        except ValueError:
+            contents = None
+
+        if not isinstance(contents, dict):
             print('Error: Invalid Json')
+            response['message'] = 'Error in PUT'
+            response['error'] = 'Invalid json'
+            return jsonify(response), 400
 
         # Just need to add new keys to store
-        self.kv_store = {**self.kv_store, **contents}
+        with self.context_lock:
+            self.kv_store.update(contents)
+            self.log_change({'op': 'store', 'items': contents})
+
+            for key, value in contents.items():
+                if key not in self.causal_context:
+                    self.merkle.update(key, 0, True, value)
+
+        self.wait_durable()
         print('kv store new length: {0}'.format(len(contents.keys())))
 
         return jsonify(response), code
 
-
-    def keys(self, key):
+    def proxy_migrate(self, migration_id):
         """
-        Method used to handle the GET, PUT, or DELETE of a key
-        in the distributed key-value store
-        :param key: the key of interest
-        :return status: the response of the given HTTP request
+        Function used to receive keys moving to this node during a view change.
+            PUT ?batch=<n>      NDJSON batch of keys, acknowledged with the last batch received
+            GET                 last batch received, for the sender to resume from
+        Keys only replace older versions, so a resent batch does no harm
         """
         response = {}
-        contents = request.get_json()
-        context = contents['causal-context']
+        code = 200
 
-        resp = None
+        if request.method == 'PUT':
+            number = request.args.get('batch', 0, type=int)
 
-        message = None
-        code = -1
-        replaced = False
+            try:
+                entries = decode_batch(request.get_data())
+            except (ValueError, KeyError):
+                response['message'] = myconstants.BAD_FORMAT_RESPONSE
+                return jsonify(response), 400
 
-        """
-            GET requests handling
-        """
-        if request.method == 'GET':
+            self.combine_causal_contexts(entries)
+            self.wait_durable()
 
-            # get shard of key
-            correct_shard_id = self.currentHashRing.get_node(key)
+            # other new replicas of the shard get the keys from this node
+            forward = request.args.get('forward')
 
-            if correct_shard_id == self.shard_id:
-                """
-                    At this point key has been hashed to current node.
-                    We still need to determine if key exists
-                """
-                self.combine_causal_contexts(context, self.causal_context)
-
-                if key in self.kv_store:
-                    response['doesExist'] = True
-                    response['message'] = myconstants.RETRIEVED_MESSAGE
-                    response['value'] = self.kv_store[key]
-                    response['causal-context'] = self.causal_context
-                    code = 200
-                else:
-                    response['doesExist'] = False
-                    response['message'] = myconstants.GET_ERROR_MESSAGE
-                    response['error'] = myconstants.KEY_ERROR
-                    response['causal-context'] = self.causal_context
-                    code = 404
+            if forward:
+                for node_address in forward.split(','):
+                    self.migrator.forward(node_address, migration_id, number, request.get_data())
 
-                return jsonify(response), code
-            else:
-                """
-                    Need to ask other nodes of each shard
-                    NOTE: need to make sure we communicate with at least
-                          one node for each shard
-                """
-                proxy_path = 'proxy/kvs/keys'
+            with self.context_lock:
+                self.migrations[migration_id] = max(self.migrations.get(migration_id, 0), number)
 
-                partition = self.all_partitions[correct_shard_id]
+        response['migration'] = migration_id
+        response['acked'] = self.migrations.get(migration_id, 0)
 
-                for node_address in partition:
-                    url = os.path.join('http://', node_address, proxy_path, key)
+        return jsonify(response), code
 
-                    try:
-                        resp = requests.get(url, json=contents, timeout=myconstants.TIMEOUT)
+    def proxy_migrate_key(self, key):
+        """
+        Function used to hand a key to its new shard during a view change,
+        when the key is asked for before its migration arrived
+        """
+        response = {}
 
-                        return resp.text, resp.status_code
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        """
-                            We were not able to connect to another node, maybe node is
-                            down? Thus continue to try and contact other nodes for a
-                            certain shard
-                        """
-                        continue
+        with self.context_lock:
+            value = self.kv_store.get(key, MISSING)
 
-                # TODO handle 503 (timeout errors)
-                response['message'] = myconstants.GET_ERROR_MESSAGE
-                response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
-                response['causal-context'] = self.causal_context
-                code = 503
+            response['key'] = key
+            response['timestamp'] = self.local_version(key)
+            response['doesExist'] = value is not MISSING
 
-                return jsonify(response), code
+            if value is not MISSING:
+                response['value'] = value
 
-            # At this point we did not find a shard with the given key,
-            # so just return the response from the last node we contacted
-            return resp.text, resp.status_code
+        return jsonify(response), 200
 
+    def pull_moved_key(self, key):
         """
-            PUT requests handling
+        Function used during a view change to fetch a key moving to this node
+        from its old shard, unless it already arrived. The key only replaces
+        older versions, so a write made here first is kept
+        :param key: key about to be served by this node
+        :return None:
         """
-        if request.method == 'PUT':
-            """
-                1. Need to determine if PUT request is an 'update' or 'insert'
+        transition = self.transition or self.pending_view
 
-                An 'update' is determined if current shard node or any other shard node
-                has the existing key
+        if transition is None or key in self.causal_context or self.kv_store.contains(key):
+            return
 
-                A 'insert' is determined if no shard node has the current key.
-                Also will want to insert key to node with least amount of keys
-            """
+        move = transition['plan'].move(key)
 
-            try:
-                content = request.get_json()
-            except:
-                # Error: Invalid Json format, which shouldn't happen for this assignment
-                return jsonify(myconstants.BAD_FORMAT_RESPONSE), 400
+        if self.address not in move['targets'] or key in transition['pulled']:
+            return
 
-            correct_shard_id = self.currentHashRing.get_node(key)
+        for node_address in transition['old-partitions'].get(move['from'], []):
+            try:
+                resp = self.transport.get(node_address, 'proxy/migrate-key/' + key)
+                resp.raise_for_status()
+                entry = resp.json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
 
-            # key mapped to current shard
-            if correct_shard_id == self.shard_id:
+            if entry['doesExist'] or entry['timestamp'] > 0:
+                self.combine_causal_contexts({key: entry})
 
-                # first verify length of key
-                if len(key) > myconstants.KEY_LENGTH:
-                    response['message'] = 'Error in PUT'
-                    response['error'] = 'Key is too long'
-                    response['causal-context'] = self.causal_context
-                    code = 400
-                    return jsonify(response), code
+            transition['pulled'].add(key)
+            return
 
-                # attempt to get value from PUT request
-                try:
-                    value = contents['value']
-                except:
-                    # Error: Key value did not exist
-                    response['message'] = 'Error in PUT'
-                    response['error'] = 'Value is missing'
-                    response['causal-context'] = self.causal_context
-                    code = 400
-                    return jsonify(response), code
-
-                if key in self.kv_store:
-                    message = myconstants.UPDATED_MESSAGE
-                    code = 200
-                    replaced = True
-                else:
-                    message = myconstants.ADDED_MESSAGE
-                    code = 201
-                    replaced = False
+    def forward_to_old_shard(self, method, key, json_obj):
+        """
+        Function used during a view change to pass a write of a key moving to
+        this shard on to the replicas of its old shard, for nodes still
+        routing with the old view
+        :param method: 'PUT' or 'DELETE'
+        :param key: key that was written
+        :param json_obj: body for the /proxy/replicate/<key> request
+        :return None:
+        """
+        transition = self.transition
 
-                self.kv_store[key] = value
+        if transition is None:
+            return
 
-                """
-                    Updating the causal-context object for the current node with the updated value
-                """
-                self.handle_causal_context(key, value)
+        move = transition['plan'].move(key)
+        peers = [node_address for node_address in transition['old-partitions'].get(move['from'], [])
+                 if node_address not in move['keep']]
 
-                self.combine_causal_contexts(context, self.causal_context)
+        if peers:
+            payload = dict(json_obj)
+            payload['transition'] = transition['view-id']
+            self.replicator.replicate(method, peers, key, payload, ACK_ONE)
 
-                """
-                    Replicate
+    def migration_stats(self):
+        """
+        Function used to get the counters of the latest migrations sent by this node
+        """
+        return jsonify(self.migrator.stats()), 200
 
-                    Need to tell all other nodes in same replica about the
-                    newly inserted/update value
-                """
-                for node_address in self.all_partitions[self.shard_id]:
-                    if node_address == self.address:
-                        continue
+    def plan_migration(self, old_partitions, partitions, new_ring, alive=None):
+        """
+        Function used to compare the hash rings of the old and new view
+        :param old_partitions: shard_id -> replicas before the view change
+        :param partitions: shard_id -> replicas after the view change
+        :param new_ring: hash ring of the new view
+        :param alive: optional nodes which prepared the view change, only they send keys
+        :return MigrationPlan:
+        """
+        if not old_partitions:
+            old_partitions = partitions
 
-                    url = os.path.join('http://', node_address, 'proxy/replicate', key)
+        old_ring = RoutingTable(old_partitions)
 
-                    try:
-                        json_object = request.get_json()
-                        json_object['causal-context'] = self.causal_context
-                        resp = requests.put(url, json=json_object, timeout=myconstants.TIMEOUT)
+        return MigrationPlan(old_ring, old_partitions, new_ring, partitions, alive)
 
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        print('Error: we were not able to communicate with another replica')
+    def migration_items(self, keys):
+        """
+        Stream of the keys to migrate with their values and versions, values
+        are read as the stream is consumed so the store is never copied
+        :param keys: keys to migrate, in the same order on every attempt
+        :return iterator of (key, value, timestamp):
+        """
+        for key in keys:
+            value = self.kv_store.get(key, MISSING)
 
-                response['replaced'] = replaced
-                response['message'] = message
-                response['causal-context'] = self.causal_context
+            if value is not MISSING:
+                yield key, value, self.local_version(key)
 
-                return jsonify(response), code
+    def send_keys(self, view_id, plan, outgoing):
+        """
+        Function used to stream the keys this node sends to the new replicas
+        of their shard. Keys go to one replica, which forwards them to the
+        others, and the next replica is tried if it cannot be reached
+        :param view_id: id of the view change, used to name the migrations
+        :param plan: MigrationPlan of the view change
+        :param outgoing: (old shard, new shard) -> keys to send
+        :return list: MigrationStats of every migration
+        """
+        results = []
 
-            else:
-                proxy_path = 'proxy/kvs/keys'
+        for move_id, keys in outgoing.items():
+            targets = plan.moves[move_id]['targets']
+            migration_id = '{0}-{1}-{2}'.format(view_id, move_id[0], move_id[1])
 
-                for node_address in self.all_partitions[correct_shard_id]:
-                    url = os.path.join('http://', node_address, proxy_path, key)
+            for i, node_address in enumerate(targets):
+                forward = targets[:i] + targets[i + 1:]
+                stats = self.migrator.send(node_address, migration_id, self.migration_items(keys), forward)
+                results.append(stats)
 
-                    try:
-                        resp = requests.put(url, json=contents, timeout=myconstants.TIMEOUT)
+                if stats.done:
+                    break
 
-                        return resp.text, resp.status_code
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        continue
+        return results
 
-                ###### TODO check if need to handle 503 here or not?
-                return resp.text, resp.status_code
+    def drop_keys(self, keys):
         """
-            DELETE requests handling
+        Function used to remove the keys this node does not hold in the new view
+        :param keys: keys to remove
+        :return None:
         """
-        if request.method == 'DELETE':
+        with self.context_lock:
+            for key in keys:
+                self.kv_store.delete(key)
+                self.causal_context.pop(key, None)
+                self.merkle.remove(key)
 
-            correct_shard_id = self.currentHashRing.get_node(key)
+            self.log_change({'op': 'drop', 'keys': keys})
 
-            if correct_shard_id == self.shard_id:
-                # Need to delete key value from store
-                if key not in self.kv_store:
-                    response['doesExist'] = False
-                    response['error'] = myconstants.KEY_ERROR
-                    response['message'] = myconstants.DELETE_ERROR_MESSAGE
-                    response['causal-context'] = self.causal_context
-                    code = 404
-                    return jsonify(response), code
 
-                self.kv_store.pop(key, None)
-
-                """
-                    Updating the causal-context object for the current node with the updated value
-                """
-                try:
-                    key_causal_context = self.causal_context[key]
-                    key_causal_context['timestamp'] = str(time.time())
-                    key_causal_context['value'] = ""
-                    key_causal_context['doesExist'] = False
-                except KeyError:
-                    """
-                        If key does not exist in the causal-context object
-                    """
-                    key_causal_context = {}
-                    key_causal_context['timestamp'] = str(time.time())
-                    key_causal_context['value'] = ""
-                    key_causal_context['doesExist'] = False
-
-                self.causal_context[key] = key_causal_context
+    def keys(self, key):
+        """
+        Method used to handle the GET, PUT, or DELETE of a key
+        in the distributed key-value store
+        :param key: the key of interest
+        :return status: the response of the given HTTP request
+        """
+        contents = request.get_json(silent=True) or {}
+        token = self.context_token(contents)
 
-                """
-                    Replicate
+        # get shard of key
+        correct_shard_id = self.currentHashRing.get_node(key)
 
-                    Need to tell all other nodes in same replica about the
-                    newly inserted/update value
-                """
-                for node_address in self.all_partitions[self.shard_id]:
-                    if node_address == self.address:
-                        continue
+        if correct_shard_id == self.shard_id:
+            """
+                At this point key has been hashed to current node
+            """
+            self.pull_moved_key(key)
 
-                    url = os.path.join('http://', node_address, 'proxy/replicate', key)
+            if request.method == 'GET':
+                response, code = self.get_key(key, token)
+            elif request.method == 'PUT':
+                response, code = self.put_key(key, contents, token)
+            else:
+                response, code = self.delete_key(key, token)
 
-                    try:
-                        json_obj = request.get_json()
-                        json_obj['causal-context'] = self.causal_context
-                        resp = requests.delete(url, json=json_obj, timeout=myconstants.TIMEOUT)
+            return jsonify(response), code
 
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        print('Error: we were not able to communicate with another replica')
+        """
+            Need to ask the nodes of the shard the key hashed to.
+            NOTE: need to make sure we communicate with at least
+                  one node of the shard. Requests are spread over the
+                  replicas by latency, the causal context token makes
+                  any replica serve the client's own writes
+        """
+        proxy_path = 'proxy/kvs/keys/'
 
+        for node_address in self.selector.order(self.all_partitions[correct_shard_id]):
+            try:
+                resp = self.selector.request(request.method, node_address, proxy_path + key, json=contents,
+                                             headers={'Accept': codec.JSON})
 
+                # the owning replica fans writes out to the rest of the shard
+                return resp.text, resp.status_code
+            except (requests.Timeout, requests.exceptions.ConnectionError):
+                """
+                    We were not able to connect to another node, maybe node is
+                    down? Thus continue to try and contact other nodes for a
+                    certain shard
+                """
+                continue
 
-                response['causal-context'] = self.causal_context
-                response['doesExist'] = True
-                response['message'] = myconstants.DELETE_SUCCESS_MESSAGE
-
-                code = 200
-                return jsonify(response), code
+        response = {}
+        response['message'] = self.error_message(request.method)
+        response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+        response['causal-context'] = token
+        code = 503
 
-            else:
-                proxy_path = 'proxy/kvs/keys'
+        return jsonify(response), code
 
-                for node_address in self.all_partitions[correct_shard_id]:
 
-                    url = os.path.join('http://', node_address, proxy_path, key)
+    def proxy_keys(self, key):
+        """
+        Method similar to keys, but instead it does not ask other nodes about a key.
+        proxy_keys just returns whether it finds its key in it's local storage or not
+        """
+        if self.transition is not None and self.currentHashRing.get_node(key) != self.shard_id:
+            # sent by a node still routing with the old view
+            return self.keys(key)
 
-                    try:
-                        resp = requests.delete(url, json=contents, timeout=myconstants.TIMEOUT)
+        contents = request.get_json(silent=True) or {}
+        token = self.context_token(contents)
 
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        continue
+        self.pull_moved_key(key)
 
+        if request.method == 'GET':
+            response, code = self.get_key(key, token)
+        elif request.method == 'PUT':
+            response, code = self.put_key(key, contents, token)
+        else:
+            response, code = self.delete_key(key, token)
 
-                ###### TODO check if need to handle 503 here or not?
-                return resp.text, resp.status_code
+        response['address'] = self.address
 
+        return jsonify(response), code
 
-    def proxy_keys(self, key):
+    def batch(self):
         """
-        Method similar to keys, but instead it does not ask other nodes about a key.
-        proxy_keys just returns whether it finds its key in it's local storage or not
+        Method used to handle the GET, PUT, or DELETE of many keys in one request
+            GET, DELETE     {"keys": [...], "causal-context": ...}
+            PUT             {"items": {key: value}, "causal-context": ...}
+        Keys are grouped by shard and every shard gets one sub-batch, all at
+        once. The response holds the result of every key, with its status code
+        :return status: the response of the given HTTP request
         """
+        contents = request.get_json(silent=True)
+        token = self.context_token(contents if isinstance(contents, dict) else {})
         response = {}
-        contents = request.get_json()
-        context = contents['causal-context']
-        code = 999
 
+        try:
+            keys, items = self.batch_keys(contents)
+        except ValueError:
+            response['message'] = 'Error in {0}'.format(request.method)
+            response['error'] = 'Bad batch, expected at most {0} keys or items'.format(myconstants.BATCH_MAX_KEYS)
+            response['causal-context'] = token
+            return jsonify(response), 400
+
+        policy = request.args.get('write-ack')
+        routes = self.currentHashRing.route_many(keys)
+        futures = {}
+
+        # other shards first, so they work while this node does its part
+        for shard_id, shard_keys in routes.items():
+            if shard_id != self.shard_id:
+                body = self.batch_body(contents, shard_keys, items)
+                futures[shard_id] = self.batch_pool.submit(self.forward_batch, shard_id, request.method, body, policy)
+
+        results = {}
+        tokens = [token]
+
+        if self.shard_id in routes:
+            shard_results, shard_token = self.batch_local(request.method, routes[self.shard_id], items, token, policy)
+            results.update(shard_results)
+            tokens.append(shard_token)
+
+        for shard_id, future in futures.items():
+            shard_results, shard_token = future.result()
+            results.update(shard_results)
+            tokens.append(shard_token)
+
+        response['message'] = myconstants.BATCH_MESSAGE
+        response['results'] = {key: results[key] for key in keys}
+        response['causal-context'] = self.merge_tokens(tokens)
+
+        return jsonify(response), 200
+
+    def proxy_batch(self):
         """
-            GET requests handling forward from another shard node
+        Method similar to batch, but the keys are all of this node's shard.
+        During a view change nodes still routing with the old view may send
+        keys which moved away, those are routed again
         """
-        if request.method == 'GET':
+        contents = request.get_json(silent=True)
+        token = self.context_token(contents if isinstance(contents, dict) else {})
 
-            self.combine_causal_contexts(context, self.causal_context)
+        try:
+            keys, items = self.batch_keys(contents)
+        except ValueError:
+            return jsonify({'message': 'Error in {0}'.format(request.method), 'causal-context': token}), 400
 
-            if key in self.kv_store:
-                response['doesExist'] = True
-                response['message'] = myconstants.RETRIEVED_MESSAGE
-                response['value'] = self.kv_store[key]
-                response['address'] = self.address
-                response['causal-context'] = self.causal_context
-                code = 200
-            else:
-                response['doesExist'] = False
-                response['error'] = myconstants.KEY_ERROR
-                response['message'] = myconstants.GET_ERROR_MESSAGE
-                response['address'] = self.address
-                response['causal-context'] = self.causal_context
-                code = 404
+        if self.transition is not None and any(self.currentHashRing.get_node(key) != self.shard_id for key in keys):
+            return self.batch()
 
-            return jsonify(response), code
+        results, token = self.batch_local(request.method, keys, items, token, request.args.get('write-ack'))
+
+        response = {}
+        response['message'] = myconstants.BATCH_MESSAGE
+        response['results'] = results
+        response['causal-context'] = token
+        response['address'] = self.address
+
+        return jsonify(response), 200
 
+    def batch_keys(self, contents):
         """
-            PUT requests handling forward from another shard node
+        Function used to get the keys of a batch request
+        :param contents: json body of the request
+        :return (list, dict): keys, and key -> value for PUT (None otherwise)
         """
+        if not isinstance(contents, dict):
+            raise ValueError('bad batch')
+
         if request.method == 'PUT':
-            contents = request.get_json()
+            items = contents.get('items')
+            keys = list(items) if isinstance(items, dict) else None
+        else:
+            items = None
+            keys = contents.get('keys')
 
-            if len(key) > myconstants.KEY_LENGTH:
-                response['message'] = 'Error in PUT'
-                response['error'] = 'Key is too long'
-                response['causal-context'] = self.causal_context
-                response['address'] = self.address
-                code = 400
-                return jsonify(response), code
+        if not isinstance(keys, list):
+            raise ValueError('bad batch')
 
-            if key in self.kv_store:
-                replaced = True
-                message = myconstants.UPDATED_MESSAGE
-                code = 200
-            else:
-                replaced = False
-                message = myconstants.ADDED_MESSAGE
-                code = 201
+        if len(keys) > myconstants.BATCH_MAX_KEYS or not all(isinstance(key, str) for key in keys):
+            raise ValueError('bad batch')
+
+        return keys, items
+
+    def batch_body(self, contents, keys, items):
+        """
+        Body of the sub-batch of some keys
+        :return dict:
+        """
+        body = {}
+        body['causal-context'] = contents.get('causal-context', {})
+
+        if items is not None:
+            body['items'] = {key: items[key] for key in keys}
+        else:
+            body['keys'] = keys
 
+        return body
+
+    def forward_batch(self, shard_id, method, body, policy=None):
+        """
+        Function used to send a sub-batch to a replica of its shard, the next one is tried if it does not answer
+        :return (dict, dict): key -> result, and the causal context token of the shard
+        """
+        params = {'write-ack': policy} if policy else None
+
+        for node_address in self.selector.order(self.all_partitions[shard_id]):
             try:
-                value = contents['value']
-            except:
-                # Error: Key value did not exist
-                response['message'] = 'Error in PUT'
-                response['error'] = 'Value is missing'
-                response['causal-context'] = self.causal_context
-                response['address'] = self.address
-                code = 400
-                return jsonify(response), code
+                resp = self.selector.request(method, node_address, 'proxy/batch', json=body, params=params)
+                resp.raise_for_status()
+                json_resp = resp.json()
+                return json_resp['results'], json_resp['causal-context']
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                continue
 
+        keys = body['items'] if 'items' in body else body['keys']
+        results = {}
+
+        for key in keys:
+            result = {}
+            result['message'] = self.error_message(method)
+            result['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+            result['status-code'] = 503
+            results[key] = result
+
+        return results, {}
+
+    def batch_local(self, method, keys, items, token, policy=None):
+        """
+        Function used to read or write keys of this node's shard. Writes are
+        applied together and sent to the other replicas in one request
+        :param method: 'GET', 'PUT' or 'DELETE'
+        :param keys: keys of this node's shard
+        :param items: key -> value for PUT
+        :param token: causal context token of the client
+        :param policy: optional write acknowledgement policy
+        :return (dict, dict): key -> result, and the causal context token
+        """
+        results = {}
+        entries = {}
+
+        for key in keys:
+            self.pull_moved_key(key)
+
+        if method == 'GET':
+            new_token = token
+
+            for key in keys:
+                result, code = self.get_key(key, token)
+                new_token = self.merge_tokens([new_token, result.pop('causal-context')])
+                result['status-code'] = code
+                results[key] = result
+
+            return results, new_token
+
+        with self.context_lock:
+            for key in keys:
+                result = {}
+
+                if method == 'PUT' and len(key) > myconstants.KEY_LENGTH:
+                    result['message'] = 'Error in PUT'
+                    result['error'] = 'Key is too long'
+                    result['status-code'] = 400
+                elif method == 'PUT':
+                    replaced = self.kv_store.put(key, items[key])
+                    entries[key] = self.handle_causal_context(key, items[key])
+
+                    result['replaced'] = replaced
+                    result['message'] = myconstants.UPDATED_MESSAGE if replaced else myconstants.ADDED_MESSAGE
+                    result['status-code'] = 200 if replaced else 201
+                elif self.kv_store.delete(key):
+                    entries[key] = self.handle_causal_context(key, '', exists=False)
+
+                    result['doesExist'] = True
+                    result['message'] = myconstants.DELETE_SUCCESS_MESSAGE
+                    result['status-code'] = 200
+                else:
+                    result['doesExist'] = False
+                    result['error'] = myconstants.KEY_ERROR
+                    result['message'] = myconstants.DELETE_ERROR_MESSAGE
+                    result['status-code'] = 404
 
-            """
-                Update/Insert the Key
-            """
-            self.kv_store[key] = value
+                results[key] = result
 
-            """
-                Updating the causal-context object for the current node with the updated value
-            """
-            self.handle_causal_context(key, value)
+        if not entries:
+            return results, token
 
-            self.combine_causal_contexts(self.causal_context, context)
+        self.wait_durable()
 
-            """
-                Replicate
+        """
+            Replicate
 
-                Need to tell all other nodes in same replica about the
-                newly inserted/update value
-            """
-            for node_address in self.all_partitions[self.shard_id]:
-                if node_address == self.address:
-                    continue
+            Need to tell all other nodes in same replica about the
+            new writes, queued together
+        """
+        peers = [node_address for node_address in self.all_partitions[self.shard_id] if node_address != self.address]
 
-                url = os.path.join('http://', node_address, 'proxy/replicate', key)
+        if policy not in ACK_POLICIES:
+            policy = None
 
-                try:
-                    json_obj = request.get_json()
-                    json_obj['causal-context'] = self.causal_context
-                    resp = requests.put(url, json=json_obj, timeout=myconstants.TIMEOUT)
+        if not self.replicator.replicate_entries(peers, entries, policy):
+            for key in entries:
+                result = {}
+                result['message'] = self.error_message(method)
+                result['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+                result['status-code'] = 503
+                results[key] = result
 
-                except (requests.Timeout, requests.exceptions.ConnectionError):
-                    print('Error: we were not able to communicate with another replica')
+            return results, token
 
-            # Respond back to client
-            response['replaced'] = replaced
-            response['message'] = message
-            response['causal-context'] = self.causal_context
-            response['address'] = self.address
+        for key, entry in entries.items():
+            json_obj = {}
+            json_obj['causal-context'] = {key: entry}
+            if method == 'PUT':
+                json_obj['value'] = entry['value']
 
-            return jsonify(response), code
+            self.forward_to_old_shard(method, key, json_obj)
+
+        return results, self.token_after(token, max(entry['timestamp'] for entry in entries.values()))
+
+    def replicate_batch(self):
         """
-            DELETE requests handling forward from another shard node
+        Function used to receive the writes of a batch from another replica
+        of the same shard
         """
-        if request.method == 'DELETE':
-            if key in self.kv_store:
-                # Need to delete key value from store
-                self.kv_store.pop(key, None)
+        response = {}
+        contents = request.get_json()
 
+        self.combine_causal_contexts(contents['causal-context'])
+        self.wait_durable()
 
-                """
-                    Updating the causal-context object for the current node with the updated value
-                """
-                try:
-                    key_causal_context = self.causal_context[key]
-                    key_causal_context['timestamp'] = str(time.time())
-                    key_causal_context['value'] = ""
-                    key_causal_context['doesExist'] = False
-                except KeyError:
-                    """
-                        If key does not exist in the causal-context object
-                    """
-                    key_causal_context = {}
-                    key_causal_context['timestamp'] = str(time.time())
-                    key_causal_context['value'] = ""
-                    key_causal_context['doesExist'] = False
+        response['message'] = myconstants.UPDATED_MESSAGE
+        response['address'] = self.address
+
+        return jsonify(response), 200
+
+    def merge_tokens(self, tokens):
+        """
+        Token depending on everything the given tokens depend on
+        :param tokens: list of causal context tokens
+        :return dict: shard id -> newest version
+        """
+        merged = {}
 
+        for token in tokens:
+            for shard_id, version in token.items():
+                if version > merged.get(shard_id, 0):
+                    merged[shard_id] = version
 
-                self.causal_context[key] = key_causal_context
+        return merged
 
-                self.combine_causal_contexts(self.causal_context, context)
+    def scan(self):
+        """
+        Method used to list keys in order, a page at a time
+            ?prefix=<p>             keys starting with p
+            ?start=<a>&end=<b>      keys with a <= key < b
+            ?limit=<n>              keys per page
+            ?cursor=<key>           continue after the cursor of the previous page
+            ?stream=true            send every key in range as NDJSON, one line per key
+        One replica of every shard is asked at once and their sorted pages are merged
+        :return status: the response of the given HTTP request
+        """
+        response = {}
 
-                """
-                    Replicate
+        try:
+            start, end, after, limit = self.scan_range(request.args)
+        except ValueError as error:
+            response['message'] = 'Error in GET'
+            response['error'] = str(error)
+            return jsonify(response), 400
 
-                    Need to tell all other nodes in same replica about the
-                    newly inserted/update value
-                """
-                for node_address in self.all_partitions[self.shard_id]:
-                    if node_address == self.address:
-                        continue
+        if request.args.get('stream', '').lower() in ('1', 'true'):
+            max_keys = limit if 'limit' in request.args else None
+            return Response(self.stream_scan(start, end, after, max_keys), mimetype='application/x-ndjson')
 
-                    url = os.path.join('http://', node_address, 'proxy/replicate', key)
+        futures = {}
+
+        for shard_id in self.all_partitions:
+            if shard_id != self.shard_id:
+                futures[shard_id] = self.batch_pool.submit(self.forward_scan, shard_id, start, end, after, limit)
 
-                    try:
-                        json_obj = request.get_json()
-                        json_obj['causal-context'] = self.causal_context
-                        resp = requests.delete(url, json=json_obj, timeout=myconstants.TIMEOUT)
+        pages = []
 
-                    except (requests.Timeout, requests.exceptions.ConnectionError):
-                        print('Error: we were not able to communicate with another replica')
+        if self.shard_id in self.all_partitions:
+            pages.append(self.scan_local(start, end, after, limit))
+
+        for shard_id, future in futures.items():
+            page = future.result()
+
+            if page is None:
+                response['message'] = 'Error in GET'
+                response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+                return jsonify(response), 503
 
+            pages.append(page)
 
-                response['doesExist'] = True
-                response['message'] = myconstants.DELETE_SUCCESS_MESSAGE
-                response['address'] = self.address
-                response['causal-context'] = self.causal_context
+        merged = list(heapq.merge(*[page['items'] for page in pages], key=lambda item: item[0]))
+        items = merged[:limit]
+        more = len(merged) > limit or any(page['more'] for page in pages)
 
+        response['message'] = 'Scan successful'
+        response['items'] = [{'key': key, 'value': value} for key, value in items]
+        response['cursor'] = items[-1][0] if more and items else None
+
+        return jsonify(response), 200
+
+    def proxy_scan(self):
+        """
+        Method similar to scan, but only lists the keys of this node
+        """
+        try:
+            start, end, after, limit = self.scan_range(request.args)
+        except ValueError as error:
+            return jsonify({'message': 'Error in GET', 'error': str(error)}), 400
+
+        return jsonify(self.scan_local(start, end, after, limit)), 200
+
+    def scan_range(self, args):
+        """
+        Function used to get the range of a scan from its query parameters
+        :return (str, str, str, int): start, end, key the scan continues after, and page size
+        """
+        prefix = args.get('prefix')
+        start = args.get('start')
+        end = args.get('end')
+        after = args.get('cursor') or args.get('after')
+
+        if prefix is not None:
+            if start is not None or end is not None:
+                raise ValueError('Use either prefix or start and end')
+            start = prefix
+            end = prefix_end(prefix)
+
+        try:
+            limit = int(args.get('limit', myconstants.SCAN_DEFAULT_LIMIT))
+        except ValueError:
+            raise ValueError('limit must be a number')
+
+        if limit < 1 or limit > myconstants.SCAN_MAX_LIMIT:
+            raise ValueError('limit must be between 1 and {0}'.format(myconstants.SCAN_MAX_LIMIT))
+
+        return start, end, after, limit
+
+    def scan_local(self, start, end, after, limit):
+        """
+        Function used to list keys of this node in order
+        :param start: first key, None for no lower bound
+        :param end: key after the last one, None for no upper bound
+        :param after: only keys after this one, None for all
+        :param limit: max number of keys
+        :return dict: 'items' [key, value] pairs, and 'more' if keys were left out
+        """
+        if after is not None and (start is None or after >= start):
+            start = after
+
+        items = []
+        more = False
+
+        for key, value in self.kv_store.scan(start, end, limit + 2):
+            if after is not None and key <= after:
+                continue
+
+            if len(items) == limit:
+                more = True
+                break
+
+            items.append([key, value])
+
+        return {'items': items, 'more': more}
+
+    def forward_scan(self, shard_id, start, end, after, limit):
+        """
+        Function used to get a page of keys from a replica of a shard, the next one is tried if it does not answer
+        :return dict: the page, None if no replica answered
+        """
+        params = {'limit': limit}
+
+        for name, value in (('start', start), ('end', end), ('after', after)):
+            if value is not None:
+                params[name] = value
+
+        for node_address in self.selector.order(self.all_partitions[shard_id]):
+            try:
+                resp = self.selector.request('GET', node_address, 'proxy/scan', params=params)
+                resp.raise_for_status()
+                return resp.json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+
+        return None
+
+    def stream_scan(self, start, end, after, max_keys=None):
+        """
+        Generator of the NDJSON lines of a streamed scan. Every shard is read
+        a page at a time as the merge consumes it, the last line holds the
+        cursor to continue from if max_keys stopped the scan early
+        :return iterator of str:
+        """
+        def shard_items(shard_id):
+            cursor = after
+
+            while True:
+                if shard_id == self.shard_id:
+                    page = self.scan_local(start, end, cursor, myconstants.SCAN_DEFAULT_LIMIT)
+                else:
+                    page = self.forward_scan(shard_id, start, end, cursor, myconstants.SCAN_DEFAULT_LIMIT)
+
+                if page is None:
+                    raise IOError('shard {0} is unreachable'.format(shard_id))
+
+                for key, value in page['items']:
+                    yield key, value
+
+                if not page['more'] or not page['items']:
+                    return
+
+                cursor = page['items'][-1][0]
+
+        shards = [shard_items(shard_id) for shard_id in self.all_partitions]
+        count = 0
+        cursor = None
+
+        try:
+            for key, value in heapq.merge(*shards, key=lambda item: item[0]):
+                if max_keys is not None and count == max_keys:
+                    break
+
+                yield json.dumps({'key': key, 'value': value}) + '\n'
+                cursor = key
+                count += 1
+            else:
+                cursor = None
+        except IOError as error:
+            yield json.dumps({'error': str(error)}) + '\n'
+            return
+
+        yield json.dumps({'cursor': cursor}) + '\n'
+
+    def get_key(self, key, token):
+        """
+        Function used to read a key stored on this node's shard
+        :param key: the key of interest
+        :param token: causal context token of the client
+        :return (dict, int): response and status code
+        """
+        response = {}
+
+        if not self.causally_ready(key, token):
+            # we may be missing a write the client depends on
+            response['message'] = myconstants.GET_ERROR_MESSAGE
+            response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+            response['causal-context'] = token
+            return response, 400
+
+        value = self.kv_store.get(key, MISSING)
+
+        if value is not MISSING:
+            response['doesExist'] = True
+            response['message'] = myconstants.RETRIEVED_MESSAGE
+            response['value'] = value
+            code = 200
+        else:
+            response['doesExist'] = False
+            response['message'] = myconstants.GET_ERROR_MESSAGE
+            response['error'] = myconstants.KEY_ERROR
+            code = 404
+
+        response['causal-context'] = self.token_after(token, self.local_version(key))
+
+        return response, code
+
+    def put_key(self, key, contents, token):
+        """
+        Function used to insert or update a key stored on this node's shard
+        and replicate it to the other replicas
+        :param key: the key of interest
+        :param contents: json body of the request
+        :param token: causal context token of the client
+        :return (dict, int): response and status code
+        """
+        response = {}
+
+        # first verify length of key
+        if len(key) > myconstants.KEY_LENGTH:
+            response['message'] = 'Error in PUT'
+            response['error'] = 'Key is too long'
+            response['causal-context'] = token
+            return response, 400
+
+        # attempt to get value from PUT request
+        try:
+            value = contents['value']
+        except KeyError:
+            response['message'] = 'Error in PUT'
+            response['error'] = 'Value is missing'
+            response['causal-context'] = token
+            return response, 400
+
+        with self.context_lock:
+            replaced = self.kv_store.put(key, value)
+
+            if replaced:
+                message = myconstants.UPDATED_MESSAGE
                 code = 200
             else:
+                message = myconstants.ADDED_MESSAGE
+                code = 201
+
+            """
+                Updating the causal-context object for the current node with the updated value
+            """
+            entry = self.handle_causal_context(key, value)
+
+        self.wait_durable()
+
+        """
+            Replicate
+
+            Need to tell all other nodes in same replica about the
+            newly inserted/update value
+        """
+        json_obj = {}
+        json_obj['value'] = value
+        json_obj['causal-context'] = {key: entry}
+
+        if not self.replicate_write('PUT', key, json_obj):
+            return self.replication_failed_response('Error in PUT', self.token_after(token, entry['timestamp']))
+
+        self.forward_to_old_shard('PUT', key, json_obj)
+
+        response['replaced'] = replaced
+        response['message'] = message
+        response['causal-context'] = self.token_after(token, entry['timestamp'])
+
+        return response, code
+
+    def delete_key(self, key, token):
+        """
+        Function used to delete a key stored on this node's shard
+        and replicate the delete to the other replicas
+        :param key: the key of interest
+        :param token: causal context token of the client
+        :return (dict, int): response and status code
+        """
+        response = {}
+
+        with self.context_lock:
+            if not self.kv_store.delete(key):
                 response['doesExist'] = False
                 response['error'] = myconstants.KEY_ERROR
                 response['message'] = myconstants.DELETE_ERROR_MESSAGE
-                response['causal-context'] = self.causal_context
+                response['causal-context'] = token
+                return response, 404
 
-                code = 404
+            """
+                Updating the causal-context object for the current node with a tombstone
+            """
+            entry = self.handle_causal_context(key, '', exists=False)
 
-            return jsonify(response), code
+        self.wait_durable()
+
+        """
+            Replicate
+
+            Need to tell all other nodes in same replica about the delete
+        """
+        json_obj = {}
+        json_obj['causal-context'] = {key: entry}
 
+        if not self.replicate_write('DELETE', key, json_obj):
+            return self.replication_failed_response(myconstants.DELETE_ERROR_MESSAGE,
+                                                    self.token_after(token, entry['timestamp']))
 
+        self.forward_to_old_shard('DELETE', key, json_obj)
+
+        response['doesExist'] = True
+        response['message'] = myconstants.DELETE_SUCCESS_MESSAGE
+        response['causal-context'] = self.token_after(token, entry['timestamp'])
+
+        return response, 200
+
+    def error_message(self, method):
+        """
+        Error message of a failed request of the given method
+        :return string:
+        """
+        if method == 'PUT':
+            return 'Error in PUT'
+        if method == 'DELETE':
+            return myconstants.DELETE_ERROR_MESSAGE
+
+        return myconstants.GET_ERROR_MESSAGE
 
     def replicate(self, key):
         """
         Function used to handle other nodes receiving a replicated value from
-        another node in the same replica
+        another node in the same replica. The causal context of the request
+        only holds the entry of the replicated key
         """
         response = {}
-        code = 999
+        code = 200
         contents = request.get_json()
         context = contents['causal-context']
-        value = contents['value']
+
+        if contents.get('transition') is not None and contents['transition'] == self.finished_view:
+            # forwarded by a new owner after this node dropped the keys of the old view
+            response['message'] = myconstants.UPDATED_MESSAGE
+            response['address'] = self.address
+            return jsonify(response), code
 
         """
             PUT requests handling forward from another shard node
         """
         if request.method == 'PUT':
             # at this point we have a valid value and key
-            if key in self.kv_store:
+            if self.kv_store.contains(key):
                 replaced = True
                 message = myconstants.UPDATED_MESSAGE
                 code = 200
@@ -990,129 +1758,757 @@ class ShardNodeWrapper(object):
                 message = myconstants.ADDED_MESSAGE
                 code = 201
 
-            self.causal_context = context
+            # replicas are written concurrently, so keep the newest write
+            self.combine_causal_contexts(context)
 
             response['replaced'] = replaced
             response['message'] = message
-            response['causal-context'] = self.causal_context
             response['address'] = self.address
-
-            self.kv_store[key] = value
         """
             DELETE requests handling forward from another shard node
         """
         if request.method == 'DELETE':
-            try:
-                self.kv_store.pop(key, None)
-            except:
-                print('Exception: trying to delete a key via replication')
-
-            self.causal_context = context
+            self.combine_causal_contexts(context)
 
             response['doesExist'] = False
             response['message'] = myconstants.DELETE_SUCCESS_MESSAGE
-            response['causal-context'] = self.causal_context
             response['address'] = self.address
+            code = 200
+
+        self.wait_durable()
 
         return jsonify(response), code
 
-    def handle_causal_context(self, key, value):
+    def replicate_write(self, method, key, json_obj):
+        """
+        Function used to send a write to all other nodes in the same shard.
+        The write is queued for every replica and sent in a batch with the
+        other writes queued meanwhile.
+        The owning node may override its write policy per request with ?write-ack=<policy>
+        :param method: 'PUT' or 'DELETE'
+        :param key: key that was written
+        :param json_obj: body with the 'causal-context' entry of the key
+        :return bool: True if the write acknowledgement policy was satisfied
+        """
+        peers = [node_address for node_address in self.all_partitions[self.shard_id] if node_address != self.address]
+        policy = request.args.get('write-ack')
+
+        if policy not in ACK_POLICIES:
+            policy = None
+
+        return self.replicator.replicate_entries(peers, json_obj['causal-context'], policy)
+
+    def replication_failed_response(self, message, token):
+        """
+        Response used when not enough replicas acknowledged a write. The write
+        is not rolled back: it stays applied here and queued or hinted for the
+        replicas, so the token includes it and a retry with it reads its own write
+        :param message: message of the failed request
+        :param token: causal context token of the client, after the write
+        :return (dict, int): 503 response
+        """
+        response = {}
+        response['message'] = message
+        response['error'] = myconstants.UNABLE_TO_SERVICE_MESSAGE
+        response['causal-context'] = token
+
+        return response, 503
+
+    def replication_stats(self):
+        """
+        Function used to get the replication latency histograms of this node
+        """
+        return jsonify(self.replicator.stats()), 200
+
+    def wal_stats(self):
+        """
+        Function used to get the write-ahead log counters of this node
+        """
+        if self.wal is None:
+            return jsonify({'enabled': False}), 200
+
+        response = self.wal.stats()
+        response['enabled'] = True
+
+        return jsonify(response), 200
+
+    def replica_stats(self):
+        """
+        Function used to get the response times the replica selection uses
+        """
+        return jsonify(self.selector.stats()), 200
+
+    def hint_stats(self):
+        """
+        Function used to get the writes waiting to be replayed to other replicas
+        """
+        return jsonify(self.handoff.stats()), 200
+
+    def health_stats(self):
+        """
+        Function used to get the breaker state and suspicion level of every peer
+        """
+        return jsonify(self.transport.health.stats()), 200
+
+    def transport_stats(self):
+        """
+        Function used to get the connection reuse metrics of this node
+        """
+        return jsonify(self.transport.stats()), 200
+
+    def handle_causal_context(self, key, value, exists=True):
         """
         Function used to handle the addition of an event to
         the current causal context
         :param key: key in API call (e.g. http://127.0.0.1:13800/kvs/keys/<key>)
+        :param value: value written, empty for a delete
+        :param exists: False if the event is a delete
+        :return dict: the causal context entry of the event
         """
-        # Add event to causal context
-        try:
-            self.causal_context[key] = {}
-            self.causal_context[key]['timestamp'] = str(time.time())
-            self.causal_context[key]['value'] = value
-            self.causal_context[key]['doesExist'] = True
-        except:
-            print('Error: Issue adding to causal context')
+        with self.context_lock:
+            # the write must win over the version it replaces, even one a
+            # replica with a fast clock stamped ahead of ours
+            current = self.causal_context.get(key)
+            timestamp = self.clock.now()
 
-    def handle_gossip(self):
+            if current is not None and current['timestamp'] >= timestamp:
+                timestamp = current['timestamp'] + 1
+                self.clock.update(timestamp)
+
+            entry = {}
+            entry['timestamp'] = timestamp
+            entry['value'] = value
+            entry['doesExist'] = exists
+
+            self.set_version(key, entry)
+            self.note_change(key, entry)
+
+        return entry
+
+    def context_token(self, contents):
         """
-        Function used to get the causal context of other replica nodes in
-        same shard
+        Function used to get the causal context token of a request. The token maps
+        each shard id to the version of the newest write of that shard the client
+        depends on, so it stays O(number of shards)
+        :param contents: json body of the request
+        :return dict: shard id -> version
         """
-        response = {}
-        code = 200
+        token = {}
+        context = contents.get('causal-context')
+
+        if not isinstance(context, dict):
+            return token
+
+        for shard_id, version in context.items():
+            # ignore anything which is not a version, e.g. old style contexts
+            if not isinstance(version, int) or isinstance(version, bool):
+                continue
 
+            # no write of the store can be that far ahead of the wall clock
+            if self.clock.too_far(version):
+                print('Error: ignoring causal context version {0} ahead of the clock'.format(version))
+                continue
+
+            token[shard_id] = version
+
+        # writes made after the client saw these versions must order after them
+        if token:
+            self.clock.update(max(token.values()))
+
+        return token
+
+    def token_after(self, token, version):
+        """
+        Token to send back after the client observed a version of this shard
+        :return dict:
+        """
+        new_token = dict(token)
+
+        if version > new_token.get(self.shard_id, 0):
+            new_token[self.shard_id] = version
+
+        return new_token
+
+    def local_version(self, key):
         """
-            1. At this point the current node we are on is 1st in replicas list,
-               and thus should trigger gossip
+        Version of the local entry of a key, 0 if the key has no entry
+        :return int:
         """
-        all_context = self.causal_context
+        entry = self.causal_context.get(key)
+
+        if entry is None:
+            return 0
 
+        return entry['timestamp']
+
+    def complete_version(self, unreachable=()):
         """
-            3. At this point we have determined the causal context for all the replicas.
-               Need to distributed to replicas and update our own causal context
+        Version up to which this node holds every write of its shard it can get.
+        It has all of its own writes, and from each other replica everything up
+        to the clock of the last complete delta received from that replica.
+        Replicas which are down are left out, or every read would wait for them
+        :param unreachable: replicas which could not be reached just now
+        :return int: infinity if the shard has no other replica up
         """
-        for node_address in self.replicas:
-            if self.address == node_address:
-                continue
+        peers = [node_address for node_address in self.gossip_peers()
+                 if node_address not in unreachable and self.transport.available(node_address)]
+
+        if not peers:
+            return float('inf')
 
-            url = os.path.join('http://', node_address, 'proxy/node-causal-context')
+        return min(self.synced.get(node_address, 0) for node_address in peers)
+
+    def causally_ready(self, key, token):
+        """
+        Function used to decide if a key can be read without breaking causality.
+        A missing write older than the local entry of the key would lose to it
+        anyway, otherwise every write up to the client's version must be here.
+        Stamps are totally ordered and every write is stamped after what its
+        client saw, so the newest version of any shard in the token bounds the
+        writes of this shard the client may depend on, e.g. through a read of
+        another shard. If not, try to pull the missing writes from the other
+        replicas. Replicas which could not be reached are left out, and then
+        only the version of this shard in the token has to be met
+        :return bool:
+        """
+        required = max(token.values(), default=0)
+
+        if required <= self.local_version(key) or required <= self.complete_version():
+            return True
+
+        unreachable = self.catch_up(required)
+
+        if unreachable:
+            # the newer versions of other shards can not be checked without
+            # them, only what the client depends on in this shard
+            required = token.get(self.shard_id, 0)
+
+        return required <= self.local_version(key) or required <= self.complete_version(unreachable)
+
+    def catch_up(self, required=0):
+        """
+        Function used to pull the changes we have not received yet from the
+        other replicas of the shard
+        :param required: version the replicas' deltas must be complete up to
+        :return list: replicas which could not be reached
+        """
+        unreachable = []
+
+        for node_address in self.gossip_peers():
+            params = {}
+            params['since'] = self.received_seq.get(node_address, 0)
+            params['incarnation'] = self.received_incarnation.get(node_address, '')
+            params['clock'] = required
 
             try:
-                resp = requests.put(url, json=all_context, timeout=2)
-            except (requests.Timeout, requests.exceptions.ConnectionError):
-                print('Error: Was not able to reach node when updating causal context')
-                return jsonify(response), code
+                resp = self.transport.get(node_address, 'proxy/node-causal-context', params=params,
+                                          timeout=myconstants.CATCH_UP_TIMEOUT)
+                self.apply_delta(resp.json())
+            except (requests.exceptions.RequestException, ValueError):
+                print('Error: unable to catch up with replica {0}'.format(node_address))
+                unreachable.append(node_address)
 
-        return jsonify(response), code
+        return unreachable
+
+    def handle_gossip(self):
+        """
+        Function used to run a gossip round right away instead of
+        waiting for the gossip thread
+        """
+        return jsonify(self.gossip.run_round()), 200
+
+    def gossip_peers(self):
+        """
+        Other replicas in the same shard
+        :return list:
+        """
+        return [node_address for node_address in self.replicas if node_address != self.address]
+
+    def gossip_payload(self, node_address):
+        """
+        Changes pushed to another replica during a gossip round. Only entries
+        changed since the last sequence number the replica acknowledged are sent
+        :param node_address: replica the payload is sent to
+        :return dict:
+        """
+        payload = self.build_delta(self.gossip_acked.get(node_address, 0))
+
+        # never hand out changes which a crash could still lose
+        self.wait_durable()
+
+        return payload
+
+    def build_delta(self, since):
+        """
+        Causal context entries changed after a sequence number. The clock is
+        read under the same lock writes take, so every write of this node up
+        to the clock is in the delta or was in an earlier one
+        :param since: sequence number the receiver already has
+        :return dict:
+        """
+        with self.context_lock:
+            keys, seq = self.changelog.since(since)
+            entries = {}
+
+            for key in keys:
+                entry = self.context_entry(key)
+                if entry is not None:
+                    entries[key] = entry
+
+            payload = {}
+            payload['from'] = self.address
+            payload['incarnation'] = self.incarnation
+            payload['base'] = since
+            payload['seq'] = seq
+            payload['clock'] = self.clock.now()
+            payload['entries'] = entries
+
+        return payload
+
+    def apply_delta(self, payload):
+        """
+        Merge a delta of another replica. If it follows the last delta we got
+        from that replica, we now have all its writes up to its clock
+        :param payload: delta built by build_delta on the other replica
+        :return None:
+        """
+        node_address = payload['from']
+        incarnation = payload['incarnation']
+
+        self.clock.update(payload['clock'])
+        self.combine_causal_contexts(payload['entries'])
+
+        with self.context_lock:
+            if self.received_incarnation.get(node_address) != incarnation:
+                # first delta, or the replica restarted
+                self.received_incarnation[node_address] = incarnation
+                self.received_seq[node_address] = 0
+                self.synced[node_address] = 0
+
+            if payload['base'] <= self.received_seq[node_address]:
+                self.received_seq[node_address] = max(self.received_seq[node_address], payload['seq'])
+                self.synced[node_address] = max(self.synced[node_address], payload['clock'])
+
+            self.log_peer(node_address)
+
+    def gossip_reply(self, node_address, payload, resp):
+        """
+        Move the watermark of a replica forward once it acknowledged a payload.
+        If the replica restarted it lost everything, so start again from 0
+        :return None:
+        """
+        try:
+            contents = resp.json()
+        except ValueError:
+            return
+
+        self.transport.health.heartbeat(node_address)
+
+        incarnation = contents.get('incarnation')
+        known = self.peer_incarnations.get(node_address)
+        self.peer_incarnations[node_address] = incarnation
+
+        if known is not None and known != incarnation:
+            self.gossip_acked[node_address] = 0
+        else:
+            self.gossip_acked[node_address] = contents.get('ack', 0)
+
+        self.log_peer(node_address)
+
+    def gossip_stats(self):
+        """
+        Function used to get the gossip counters of this node
+        """
+        return jsonify(self.gossip.stats()), 200
 
     def node_causal_context(self):
         """
-        Function used to handle GET and PUT requests of Causal Context
+        Function used to handle GET and PUT requests of Causal Context.
+            GET ?since=<seq>&incarnation=<id>&clock=<version>
+                                                pull the changes after seq, in a
+                                                delta complete up to at least version
+            PUT                                 delta pushed by another replica
         :return None:
         """
         response = {}
         code = 200
 
         if request.method == 'GET':
-            response['causal-context'] = self.causal_context
+            since = request.args.get('since', 0, type=int)
 
-            return jsonify(response), code
+            # writes after the asker's version get later stamps than it
+            self.clock.update(request.args.get('clock', 0, type=int))
+
+            # sequence numbers of an older incarnation mean nothing to us
+            if request.args.get('incarnation') != self.incarnation:
+                since = 0
+
+            payload = self.build_delta(since)
+            self.wait_durable()
+
+            return jsonify(payload), code
 
         if request.method == 'PUT':
+            contents = request.get_json(silent=True)
+
             try:
-                contents = request.get_json()
-            except:
-                print('Error: Invalid json')
+                seq = contents['seq']
+                self.apply_delta(contents)
+            except (KeyError, TypeError, ValueError) as error:
+                print('Error: Invalid delta {0}'.format(error))
+                response['message'] = 'Error in PUT'
+                response['error'] = 'Invalid delta'
+                return jsonify(response), 400
+
+            # only acknowledge changes which survive a restart
+            self.wait_durable()
 
-            self.combine_causal_contexts(self.causal_context, contents)
+            response['incarnation'] = self.incarnation
+            response['ack'] = seq
 
             return jsonify(response), code
 
-    def combine_causal_contexts(self, curr_context, clients_context):
+    def combine_causal_contexts(self, context):
         """
-        Function used to combine the client's causal context with the current nodes
-        causal context
+        Function used to merge the causal context entries of another replica into
+        the current node's causal context. Only the keys in the given context are
+        looked at, and only entries newer than ours are applied to the key-value store
+        :param context: causal context to merge
+        :return None:
         """
-        new_context = {**curr_context, **clients_context}
+        with self.context_lock:
+            for key, entry in context.items():
+                try:
+                    timestamp = int(entry['timestamp'])
+                except (KeyError, TypeError, ValueError):
+                    print('Error: invalid causal context entry for key {0}'.format(key))
+                    continue
+
+                # an entry stamped too far ahead would win over every write
+                # clients make here until our clock catches up with it
+                if not self.clock.update(timestamp):
+                    print('Error: causal context entry for key {0} is too far ahead of the clock'.format(key))
+                    continue
+
+                current = self.causal_context.get(key)
+
+                if current is not None and timestamp <= current['timestamp']:
+                    continue
+
+                new_entry = {}
+                new_entry['timestamp'] = timestamp
+                new_entry['value'] = entry.get('value', '')
+                new_entry['doesExist'] = entry.get('doesExist', False)
+
+                self.set_version(key, new_entry)
 
-        for key, value in new_context.items():
-            # Check if key exists in both nodes
-            if key in curr_context and key in clients_context:
-                # Check timestamp if both nodes have a certain key value
-                if float(clients_context[key]['timestamp']) > float(curr_context[key]['timestamp']):
-                    new_context[key] = clients_context[key]
+                if new_entry['doesExist']:
+                    self.kv_store.put(key, new_entry['value'])
                 else:
-                    new_context[key] = curr_context[key]
+                    self.kv_store.delete(key)
+
+                # record keys that changed so gossip sends them to the other replicas
+                self.note_change(key, new_entry)
+
+    def set_version(self, key, entry):
+        """
+        Function used to set the causal context entry of a key. Only the
+        version is kept, the value is in kv_store so on-disk engines keep
+        values out of memory
+        :param key: key that changed
+        :param entry: causal context entry, with or without its value
+        :return None:
+        """
+        version = {}
+        version['timestamp'] = entry['timestamp']
+        version['doesExist'] = entry['doesExist']
+
+        self.causal_context[key] = version
+
+    def context_entry(self, key):
+        """
+        Causal context entry of a key with its value, as sent to other replicas
+        :return dict: None if the key has no entry
+        """
+        version = self.causal_context.get(key)
+
+        if version is None:
+            return None
+
+        entry = dict(version)
+        entry['value'] = self.kv_store.get(key, '') if version['doesExist'] else ''
+
+        return entry
+
+    def reset_causal_context(self):
+        """
+        Function used to clear the causal context, e.g. on a view change
+        :return None:
+        """
+        with self.context_lock:
+            self.causal_context = {}
+            self.changelog.reset()
+            self.gossip_acked = {}
+            self.log_change({'op': 'reset'})
+
+            # keys kept across the reset have no version, they take part in
+            # anti-entropy with timestamp 0 so any versioned write wins
+            self.rebuild_merkle()
+
+    def rebuild_merkle(self):
+        """
+        Function used to rebuild the Merkle tree from the causal context and
+        the keys which have no causal context entry
+        :return None:
+        """
+        with self.context_lock:
+            items = []
+
+            for key in self.kv_store.keys():
+                if key not in self.causal_context:
+                    items.append((key, 0, True, self.kv_store.get(key)))
+
+            for key, entry in self.causal_context.items():
+                value = self.kv_store.get(key) if entry['doesExist'] else None
+                items.append((key, entry['timestamp'], entry['doesExist'], value))
+
+            self.merkle.rebuild(items)
+
+    def note_change(self, key, entry):
+        """
+        Function used to record a change of a causal context entry for gossip
+        and anti-entropy
+        :param key: key that changed
+        :param entry: new causal context entry of the key
+        :return None:
+        """
+        seq = self.changelog.record(key)
+        self.merkle.update(key, entry['timestamp'], entry['doesExist'], entry.get('value'))
+        self.log_change({'op': 'entry', 'key': key, 'seq': seq, 'entry': entry})
+
+    def log_change(self, record):
+        """
+        Function used to append a change to the write-ahead log. Called with
+        context_lock held so the log has the changes in the order they were made
+        :param record: change to log
+        :return None:
+        """
+        if self.wal is not None:
+            self.wal.append(record)
+
+    def log_peer(self, node_address):
+        """
+        Function used to log the gossip watermarks of a replica, so after a
+        restart only changes newer than them are exchanged
+        :return None:
+        """
+        if self.wal is None:
+            return
+
+        record = self.peer_state(node_address)
+        record['op'] = 'peer'
+        record['peer'] = node_address
+
+        self.wal.append(record)
+
+    def peer_state(self, node_address):
+        """
+        Gossip watermarks of a replica
+        :return dict:
+        """
+        state = {}
+        state['acked'] = self.gossip_acked.get(node_address, 0)
+        state['peer-incarnation'] = self.peer_incarnations.get(node_address)
+        state['received-seq'] = self.received_seq.get(node_address, 0)
+        state['received-incarnation'] = self.received_incarnation.get(node_address)
+        state['synced'] = self.synced.get(node_address, 0)
+
+        return state
 
-        # Should update key_value store to reflect new_context
-        for key in new_context:
-            curr_obj = new_context[key]
+    def restore_peer(self, node_address, state):
+        """
+        Function used to restore the gossip watermarks of a replica from the log
+        :return None:
+        """
+        self.gossip_acked[node_address] = state['acked']
+        self.received_seq[node_address] = state['received-seq']
+        self.synced[node_address] = state['synced']
+
+        if state['peer-incarnation'] is not None:
+            self.peer_incarnations[node_address] = state['peer-incarnation']
+        if state['received-incarnation'] is not None:
+            self.received_incarnation[node_address] = state['received-incarnation']
+
+    def wait_durable(self):
+        """
+        Function used to wait until every logged change is on disk. Concurrent
+        callers share fsyncs, see WriteAheadLog
+        :return None:
+        """
+        if self.wal is not None:
+            self.wal.sync()
+
+    def checkpoint(self):
+        """
+        Function used to write a snapshot of the node and delete the log
+        segments it covers. Only copying the state blocks writes
+        :return None:
+        """
+        with self.context_lock:
+            segment = self.wal.rotate()
+
+            state = {}
+            state['incarnation'] = self.incarnation
+            state['seq'] = self.changelog.seq
+            state['entries'] = [[key, seq, self.causal_context[key]] for key, seq in self.changelog.items()
+                                if key in self.causal_context]
+            # a persistent engine already holds the store
+            state['store'] = None if self.kv_store.persistent else self.kv_store.snapshot()
+            state['peers'] = {}
+
+            for node_address in set(self.gossip_acked) | set(self.received_seq):
+                state['peers'][node_address] = self.peer_state(node_address)
+
+        # the changes of the segments the snapshot replaces must be on disk first
+        self.kv_store.flush()
+        self.wal.write_snapshot(state, segment)
+
+    def recover(self, snapshot, records):
+        """
+        Function used to rebuild the node from a snapshot and the log records
+        written after it. Changes keep their sequence numbers and the node its
+        incarnation, so replicas only exchange what changed while it was down
+        :param snapshot: snapshot written by checkpoint, None if there is none
+        :param records: log records written after the snapshot
+        :return int: number of records replayed
+        """
+        count = 0
+
+        with self.context_lock:
+            if snapshot is not None:
+                self.incarnation = snapshot['incarnation']
+                self.changelog.seq = snapshot['seq']
+                if snapshot['store'] is not None:
+                    self.kv_store.update(snapshot['store'])
+
+                for key, seq, entry in snapshot['entries']:
+                    self.set_version(key, entry)
+                    self.changelog.restore(key, seq)
+
+                for node_address, state in snapshot['peers'].items():
+                    self.restore_peer(node_address, state)
+
+            for record in records:
+                self.replay(record)
+                count += 1
+
+            for entry in self.causal_context.values():
+                self.clock.update(entry['timestamp'])
+
+            self.rebuild_merkle()
+
+        return count
+
+    def replay(self, record):
+        """
+        Function used to apply one write-ahead log record
+        :return None:
+        """
+        op = record['op']
+
+        if op == 'entry':
+            key = record['key']
+            entry = record['entry']
 
-            if curr_obj['doesExist'] == True:
-                self.kv_store[key] = curr_obj['value']
+            self.set_version(key, entry)
+            self.changelog.restore(key, record['seq'])
+
+            if entry['doesExist']:
+                self.kv_store.put(key, entry['value'])
             else:
-                try:
-                    self.kv_store.pop(key, None)
-                except:
-                    print('Exception attemting to delete key in causal context')
+                self.kv_store.delete(key)
+        elif op == 'store':
+            self.kv_store.update(record['items'])
+        elif op == 'drop':
+            for key in record['keys']:
+                self.kv_store.delete(key)
+                self.causal_context.pop(key, None)
+        elif op == 'reset':
+            self.causal_context = {}
+            self.changelog.reset()
+            self.gossip_acked = {}
+        elif op == 'peer':
+            self.restore_peer(record['peer'], record)
+        elif op == 'incarnation':
+            self.incarnation = record['id']
+        else:
+            print('Error: unknown write-ahead log record {0}'.format(op))
+
+    def handle_merkle(self):
+        """
+        Function used by other replicas to compare Merkle trees.
+            GET /proxy/merkle?nodes=1,2,3     hashes of tree nodes
+            GET /proxy/merkle?buckets=4,5     entries of keys in buckets
+        """
+        response = {}
+        code = 200
+
+        nodes = request.args.get('nodes')
+        buckets = request.args.get('buckets')
+
+        if nodes:
+            response['hashes'] = {}
+            for index in nodes.split(','):
+                response['hashes'][index] = self.merkle.node_hash(int(index))
+
+        if buckets:
+            response['entries'] = {}
+            for bucket in buckets.split(','):
+                for key in self.merkle.bucket_keys(int(bucket)):
+                    entry = self.anti_entropy_entry(key)
+                    if entry is not None:
+                        response['entries'][key] = entry
+
+        return jsonify(response), code
+
+    def anti_entropy_entry(self, key):
+        """
+        Causal context entry of a key, keys without one are given timestamp 0
+        :return dict: None if the key is unknown
+        """
+        if key in self.causal_context:
+            return self.context_entry(key)
+
+        value = self.kv_store.get(key, MISSING)
+
+        if value is not MISSING:
+            return {'timestamp': 0, 'value': value, 'doesExist': True}
+
+        return None
+
+    def merkle_repair(self, node_address):
+        """
+        Compare Merkle trees with another replica and pull the entries of the
+        buckets that differ. The other replica pulls from us the same way
+        :param node_address: replica to compare with
+        :return int: number of entries pulled
+        """
+        def get_remote_hashes(indices):
+            nodes = ','.join(str(index) for index in indices)
+            resp = self.transport.get(node_address, 'proxy/merkle', params={'nodes': nodes})
+            hashes = resp.json()['hashes']
+
+            return {int(index): value for index, value in hashes.items()}
+
+        buckets = self.merkle.diff(get_remote_hashes)
+        pulled = 0
+
+        for i in range(0, len(buckets), myconstants.MERKLE_BATCH):
+            chunk = ','.join(str(bucket) for bucket in buckets[i : i + myconstants.MERKLE_BATCH])
+            resp = self.transport.get(node_address, 'proxy/merkle', params={'buckets': chunk})
+            entries = resp.json()['entries']
+
+            self.combine_causal_contexts(entries)
+            pulled += len(entries)
 
-        # update causal context
-        self.causal_context = new_context
\ No newline at end of file
+        return pulled
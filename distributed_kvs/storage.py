@@ -0,0 +1,619 @@
+"""
+    Storage engines holding the key-value pairs of a node. Request handlers,
+    replication, gossip and view changes all go through the same interface,
+    so engines must be safe to use from many threads at once
+"""
+
+from bisect import bisect_left, bisect_right, insort
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+import myconstants
+from wal import fsync_directory
+
+MISSING = object()      # default of get() telling a missing key from a stored None
+STORAGE_ENGINES = ['memory', 'mmap']
+
+
+def create_storage(engine, directory=None):
+    """
+    Create a storage engine by name
+    :param engine: one of STORAGE_ENGINES
+    :param directory: directory of the files of on-disk engines, a temporary one if None
+    :return StorageEngine:
+    """
+    if engine == 'memory':
+        return MemoryStorage()
+
+    if engine == 'mmap':
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='kvs-')
+        return MmapStorage(directory)
+
+    raise ValueError('unknown storage engine {0}'.format(engine))
+
+
+def prefix_end(prefix):
+    """
+    First key after every key starting with a prefix
+    :return str: None if there is no such key
+    """
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+
+    if not prefix:
+        return None
+
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class KeyIndex(object):
+    """
+        Keys in sorted order, kept in chunks of at most 2 * chunk_size keys
+        so an insert or delete only shifts one chunk. Scans walk the chunks
+        from the first key in range instead of sorting the store
+    """
+    def __init__(self, chunk_size=myconstants.INDEX_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = []            # sorted lists of keys, each after the previous one
+        self.maxes = []             # last key of every chunk
+        self.lock = threading.Lock()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def load(self, keys):
+        """
+        Replace the index with the given keys
+        :return None:
+        """
+        keys = sorted(keys)
+
+        with self.lock:
+            self.chunks = [keys[i : i + self.chunk_size] for i in range(0, len(keys), self.chunk_size)]
+            self.maxes = [chunk[-1] for chunk in self.chunks]
+            self.length = len(keys)
+
+    def add(self, key):
+        """
+        Insert a key which is not in the index yet
+        :return None:
+        """
+        with self.lock:
+            self.length += 1
+
+            if not self.chunks:
+                self.chunks.append([key])
+                self.maxes.append(key)
+                return
+
+            i = min(bisect_left(self.maxes, key), len(self.chunks) - 1)
+            chunk = self.chunks[i]
+            insort(chunk, key)
+            self.maxes[i] = chunk[-1]
+
+            if len(chunk) > 2 * self.chunk_size:
+                self.chunks[i : i + 1] = [chunk[:self.chunk_size], chunk[self.chunk_size:]]
+                self.maxes[i : i + 1] = [chunk[self.chunk_size - 1], chunk[-1]]
+
+    def remove(self, key):
+        """
+        Remove a key, if it is in the index
+        :return None:
+        """
+        with self.lock:
+            i = bisect_left(self.maxes, key)
+
+            if i == len(self.chunks):
+                return
+
+            chunk = self.chunks[i]
+            j = bisect_left(chunk, key)
+
+            if j == len(chunk) or chunk[j] != key:
+                return
+
+            del chunk[j]
+            self.length -= 1
+
+            if chunk:
+                self.maxes[i] = chunk[-1]
+            else:
+                del self.chunks[i]
+                del self.maxes[i]
+
+    def range(self, start=None, end=None, limit=None):
+        """
+        Keys with start <= key < end, in order
+        :param limit: max number of keys
+        :return list:
+        """
+        keys = []
+
+        with self.lock:
+            i = bisect_left(self.maxes, start) if start is not None else 0
+            j = bisect_left(self.chunks[i], start) if start is not None and i < len(self.chunks) else 0
+
+            while i < len(self.chunks):
+                chunk = self.chunks[i]
+                stop = bisect_left(chunk, end) if end is not None else len(chunk)
+                keys.extend(chunk[j : stop])
+
+                if stop < len(chunk) or (limit is not None and len(keys) >= limit):
+                    break
+
+                i += 1
+                j = 0
+
+        return keys[:limit] if limit is not None else keys
+
+
+class StorageEngine(object):
+    """
+        Interface of a storage engine
+    """
+    persistent = False      # True if the data survives a restart without the write-ahead log
+
+    def get(self, key, default=None):
+        """
+        Value of a key
+        :return: default if the key is not stored
+        """
+        raise NotImplementedError
+
+    def put(self, key, value):
+        """
+        Insert or update a key
+        :return bool: True if the key was already stored
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """
+        Remove a key
+        :return bool: True if the key was stored
+        """
+        raise NotImplementedError
+
+    def contains(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def update(self, items):
+        """
+        Insert or update many keys
+        :param items: dict key -> value
+        :return None:
+        """
+        for key, value in items.items():
+            self.put(key, value)
+
+    def count(self):
+        """
+        Number of keys stored
+        :return int:
+        """
+        raise NotImplementedError
+
+    def keys(self):
+        """
+        Keys stored, in no particular order
+        :return list:
+        """
+        raise NotImplementedError
+
+    def scan(self, start=None, end=None, limit=None):
+        """
+        Key-value pairs with start <= key < end, in key order. Keys are read
+        from the ordered index a page at a time, so the store is never
+        sorted or copied, and keys written during the scan may be missed
+        :param start: first key, None for no lower bound
+        :param end: key after the last one, None for no upper bound
+        :param limit: max number of pairs, None for all of them
+        :return iterator of (key, value):
+        """
+        count = 0
+
+        while limit is None or count < limit:
+            keys = self.index.range(start, end, myconstants.INDEX_SCAN_PAGE)
+
+            for key in keys:
+                value = self.get(key, MISSING)
+
+                if value is not MISSING:
+                    yield key, value
+                    count += 1
+
+                    if limit is not None and count >= limit:
+                        return
+
+            if len(keys) < myconstants.INDEX_SCAN_PAGE:
+                return
+
+            # next page starts right after the last key
+            start = keys[-1] + '\0'
+
+    def snapshot(self):
+        """
+        Point in time copy of the whole store
+        :return dict:
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Make the data of a persistent engine durable
+        :return None:
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(StorageEngine):
+    """
+        In-memory engine. Keys are spread over stripes, each a dict with its
+        own lock, so writers of different keys rarely wait on each other and
+        no operation needs to copy or replace the whole store
+    """
+    def __init__(self, stripes=myconstants.STORAGE_STRIPES):
+        self.stripes = [{} for _ in range(stripes)]
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.index = KeyIndex()
+
+    def stripe(self, key):
+        """
+        Stripe number of a key
+        :return int:
+        """
+        return hash(key) % len(self.stripes)
+
+    def get(self, key, default=None):
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            return self.stripes[i].get(key, default)
+
+    def put(self, key, value):
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            existed = key in self.stripes[i]
+            self.stripes[i][key] = value
+
+            if not existed:
+                self.index.add(key)
+
+        return existed
+
+    def delete(self, key):
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            existed = self.stripes[i].pop(key, MISSING) is not MISSING
+
+            if existed:
+                self.index.remove(key)
+
+        return existed
+
+    def count(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    def keys(self):
+        keys = []
+
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                keys.extend(self.stripes[i])
+
+        return keys
+
+    def snapshot(self):
+        """
+        Copy of the store taken with every stripe locked, so no write is
+        half visible. Locks are always taken in stripe order
+        """
+        for lock in self.locks:
+            lock.acquire()
+
+        try:
+            store = {}
+            for stripe in self.stripes:
+                store.update(stripe)
+
+            return store
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+
+class MmapStorage(StorageEngine):
+    """
+        On-disk engine for stores larger than memory. Values live in an
+        append-only file mapped into memory, only the keys and an index of
+        where their latest record is stay on the heap. Every put or delete
+        appends a record:
+            crc32, key length, value length, flags    (4 unsigned ints)
+            key                                       (utf-8)
+            value                                     (json)
+        Records with a bad crc end the file, so a torn last write is dropped
+        when the file is opened again. Overwritten and deleted records are
+        garbage, the file is rewritten once garbage outgrows the live data
+    """
+    HEADER = struct.Struct('<IIII')
+    TOMBSTONE = 1
+
+    persistent = True
+
+    def __init__(self, directory, stripes=myconstants.STORAGE_STRIPES,
+                 initial_size=myconstants.MMAP_INITIAL_SIZE, compact_ratio=myconstants.MMAP_COMPACT_RATIO):
+        self.path = os.path.join(directory, 'store.mmap')
+        self.initial_size = initial_size
+        self.compact_ratio = compact_ratio
+
+        self.indexes = [{} for _ in range(stripes)]    # stripe -> key -> (value offset, value length)
+        self.index = KeyIndex()                         # keys in order, for scans
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.append_lock = threading.Lock()             # guards tail, file and map
+
+        self.live_bytes = 0
+        self.garbage_bytes = 0
+        self.compactions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+
+        self.file = open(self.path, 'r+b')
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size < initial_size:
+            self.file.truncate(initial_size)
+            size = initial_size
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.tail = self.load()
+        self.index.load(self.keys())
+
+    def stripe(self, key):
+        return hash(key) % len(self.indexes)
+
+    def load(self):
+        """
+        Rebuild the index from the records in the file
+        :return int: offset after the last valid record
+        """
+        offset = 0
+        size = len(self.map)
+
+        while offset + self.HEADER.size <= size:
+            crc, key_length, value_length, flags = self.HEADER.unpack_from(self.map, offset)
+
+            if key_length == 0:
+                break
+
+            end = offset + self.HEADER.size + key_length + value_length
+            if end > size:
+                break
+
+            body = self.map[offset + 4 : end]
+            if zlib.crc32(body) != crc:
+                print('Error: ignoring the end of {0} after a torn write'.format(self.path))
+                break
+
+            key = bytes(self.map[offset + self.HEADER.size : offset + self.HEADER.size + key_length]).decode('utf-8')
+            self.drop(key)
+
+            if not flags & self.TOMBSTONE:
+                value_offset = offset + self.HEADER.size + key_length
+                self.indexes[self.stripe(key)][key] = (value_offset, value_length)
+                self.live_bytes += end - offset
+            else:
+                self.garbage_bytes += end - offset
+
+            offset = end
+
+        return offset
+
+    def drop(self, key):
+        """
+        Remove a key from the index and count its record as garbage,
+        the lock of its stripe must be held
+        :return bool: True if the key was in the index
+        """
+        location = self.indexes[self.stripe(key)].pop(key, None)
+
+        if location is None:
+            return False
+
+        length = self.HEADER.size + len(key.encode('utf-8')) + location[1]
+        self.live_bytes -= length
+        self.garbage_bytes += length
+
+        return True
+
+    def append(self, key, data, flags):
+        """
+        Append a record, the lock of the key's stripe must be held so records
+        of a key reach the file in the order of the index updates
+        :return (int, int): offset and length of the value
+        """
+        key_data = key.encode('utf-8')
+        body = self.HEADER.pack(0, len(key_data), len(data), flags)[4:] + key_data + data
+        record = struct.pack('<I', zlib.crc32(body)) + body
+
+        with self.append_lock:
+            offset = self.tail
+            self.reserve(offset + len(record) + self.HEADER.size)
+            self.map[offset : offset + len(record)] = record
+            self.tail = offset + len(record)
+
+        return offset + self.HEADER.size + len(key_data), len(data)
+
+    def reserve(self, size):
+        """
+        Grow the file to hold at least size bytes, append_lock must be held.
+        The old map is not closed: readers which took it before the remap
+        still read valid bytes, it is released once they are done
+        :return None:
+        """
+        if size <= len(self.map):
+            return
+
+        new_size = len(self.map)
+        while new_size < size:
+            new_size *= 2
+
+        self.file.truncate(new_size)
+        self.map = mmap.mmap(self.file.fileno(), new_size)
+
+    def read(self, location):
+        offset, length = location
+        return json.loads(self.map[offset : offset + length])
+
+    def get(self, key, default=None):
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            location = self.indexes[i].get(key)
+
+            if location is None:
+                return default
+
+            data = self.map[location[0] : location[0] + location[1]]
+
+        return json.loads(data)
+
+    def put(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            existed = self.drop(key)
+            location = self.append(key, data, 0)
+            self.indexes[i][key] = location
+            self.live_bytes += self.HEADER.size + len(key.encode('utf-8')) + location[1]
+
+            if not existed:
+                self.index.add(key)
+
+        self.maybe_compact()
+
+        return existed
+
+    def delete(self, key):
+        i = self.stripe(key)
+
+        with self.locks[i]:
+            if not self.drop(key):
+                return False
+
+            self.append(key, b'', self.TOMBSTONE)
+            self.garbage_bytes += self.HEADER.size + len(key.encode('utf-8'))
+            self.index.remove(key)
+
+        self.maybe_compact()
+
+        return True
+
+    def count(self):
+        return sum(len(index) for index in self.indexes)
+
+    def keys(self):
+        keys = []
+
+        for i in range(len(self.indexes)):
+            with self.locks[i]:
+                keys.extend(self.indexes[i])
+
+        return keys
+
+    def snapshot(self):
+        self.lock_all()
+
+        try:
+            store = {}
+            for index in self.indexes:
+                for key, location in index.items():
+                    store[key] = self.read(location)
+
+            return store
+        finally:
+            self.unlock_all()
+
+    def lock_all(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def unlock_all(self):
+        for lock in self.locks:
+            lock.release()
+
+    def maybe_compact(self):
+        """
+        Compact once garbage is compact_ratio times the live data, and the
+        file has outgrown its initial size
+        :return None:
+        """
+        if self.garbage_bytes > self.compact_ratio * max(self.live_bytes, self.initial_size):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the file with only the latest record of each key. Everything
+        is locked while the live records are copied
+        :return None:
+        """
+        self.lock_all()
+
+        try:
+            with self.append_lock:
+                if self.garbage_bytes <= self.compact_ratio * max(self.live_bytes, self.initial_size):
+                    return
+
+                tmp_path = self.path + '.compact'
+                size = max(self.initial_size, 2 * self.live_bytes)
+                offset = 0
+
+                with open(tmp_path, 'w+b') as tmp_file:
+                    tmp_file.truncate(size)
+                    tmp_map = mmap.mmap(tmp_file.fileno(), size)
+
+                    for index in self.indexes:
+                        for key, (value_offset, value_length) in index.items():
+                            start = value_offset - self.HEADER.size - len(key.encode('utf-8'))
+                            end = value_offset + value_length
+
+                            tmp_map[offset : offset + end - start] = self.map[start : end]
+                            index[key] = (value_offset - start + offset, value_length)
+                            offset += end - start
+
+                    tmp_map.flush()
+                    tmp_map.close()
+
+                # the rename must be durable before records are appended to the new file
+                os.replace(tmp_path, self.path)
+                fsync_directory(os.path.dirname(os.path.abspath(self.path)))
+
+                self.file.close()
+                self.file = open(self.path, 'r+b')
+                self.map = mmap.mmap(self.file.fileno(), size)
+                self.tail = offset
+                self.garbage_bytes = 0
+                self.compactions += 1
+        finally:
+            self.unlock_all()
+
+    def flush(self):
+        with self.append_lock:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
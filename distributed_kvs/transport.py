@@ -0,0 +1,216 @@
+"""
+    Node to node transport. Keeps one pooled keep-alive session per peer
+    so forwarding and replication reuse TCP connections, and the encoding
+    each peer takes, see codec.py
+"""
+
+import functools
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from health import PeerHealth, PeerUnavailable, PROBE, REJECT
+import codec
+import myconstants
+
+
+class PeerTransport(object):
+    """
+        Wrapper around a requests.Session per peer address
+    """
+    def __init__(self, pool_size=myconstants.PEER_POOL_SIZE, timeout=myconstants.TIMEOUT, health=None,
+                 content_type=codec.JSON):
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.content_type = content_type    # encoding used with peers which take it
+        self.codecs = {}            # node_address -> encoding the peer takes
+        self.sessions = {}          # node_address -> requests.Session
+        self.timeouts = {}          # node_address -> timeout overriding the default
+        self.request_counts = {}    # node_address -> number of requests sent
+        self.error_counts = {}      # node_address -> number of failed requests
+        self.health = health or PeerHealth()
+
+    def url(self, node_address, path):
+        """
+        Build the url of a path on another node
+        :param node_address: IP and PORT of the node
+        :param path: path without leading slash e.g. 'proxy/kvs/keys/<key>'
+        :return string:
+        """
+        return 'http://' + node_address + '/' + path
+
+    def session(self, node_address):
+        """
+        Get the session of a peer, creating it the first time the peer is contacted
+        :param node_address: IP and PORT of the node
+        :return requests.Session:
+        """
+        session = self.sessions.get(node_address)
+
+        if session is not None:
+            return session
+
+        with self.lock:
+            if node_address not in self.sessions:
+                session = requests.Session()
+                # retries are handled by the callers, they move on to another replica
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0, pool_block=False)
+                session.mount('http://', adapter)
+
+                self.sessions[node_address] = session
+                self.request_counts[node_address] = 0
+                self.error_counts[node_address] = 0
+
+            return self.sessions[node_address]
+
+    def set_timeout(self, node_address, timeout):
+        """
+        Override the timeout used for a single peer
+        :return None:
+        """
+        self.timeouts[node_address] = timeout
+
+    def encode(self, node_address, obj):
+        """
+        Body of a request to a peer, in the encoding the peer takes. Objects
+        msgpack cannot encode, e.g. ints of 64 bits and more, are sent as JSON
+        :return (string, bytes): content type and body
+        """
+        if self.codecs.get(node_address) == codec.MSGPACK:
+            try:
+                return codec.MSGPACK, codec.encode(codec.MSGPACK, obj)
+            except (OverflowError, TypeError, ValueError):
+                pass
+
+        return codec.JSON, codec.encode(codec.JSON, obj)
+
+    def prepare(self, node_address, path, kwargs):
+        """
+        Encode the json of a /proxy/* request in msgpack and ask for a msgpack
+        answer, if the peer takes msgpack
+        :param kwargs: keyword arguments of the request
+        :return dict: keyword arguments to send the request with
+        """
+        if not path.startswith('proxy/') or self.codecs.get(node_address) != codec.MSGPACK:
+            return kwargs
+
+        headers = dict(kwargs.get('headers') or {})
+        # callers relaying the answer to a client keep asking for JSON
+        headers.setdefault('Accept', codec.ACCEPT_MSGPACK)
+
+        if kwargs.get('json') is not None:
+            headers['Content-Type'], kwargs['data'] = self.encode(node_address, kwargs.pop('json'))
+
+        kwargs['headers'] = headers
+
+        return kwargs
+
+    def learn(self, node_address, headers):
+        """
+        Remember the encoding a peer takes from the headers of its answer
+        :return None:
+        """
+        if self.content_type != codec.MSGPACK or not codec.available():
+            return
+
+        offered = headers.get(codec.CODECS_HEADER) or ''
+
+        self.codecs[node_address] = codec.MSGPACK if 'msgpack' in offered else codec.JSON
+
+    def request(self, method, node_address, path, **kwargs):
+        """
+        Send a request to another node over its pooled session. Raises the
+        same exceptions as requests, so callers keep their error handling.
+        A request to a peer whose breaker is open raises PeerUnavailable
+        without being sent, and a probe of such a peer uses a short timeout.
+        resp.json() decodes msgpack answers too
+        :param method: HTTP method
+        :param node_address: IP and PORT of the node
+        :param path: path without leading slash
+        :return requests.Response:
+        """
+        session = self.session(node_address)
+        decision = self.health.before(node_address)
+
+        if decision == REJECT:
+            raise PeerUnavailable('Node {0} is down'.format(node_address))
+        if decision == PROBE:
+            kwargs.setdefault('timeout', myconstants.BREAKER_PROBE_TIMEOUT)
+
+        kwargs.setdefault('timeout', self.timeouts.get(node_address, self.timeout))
+        kwargs = self.prepare(node_address, path, kwargs)
+
+        with self.lock:
+            self.request_counts[node_address] += 1
+
+        try:
+            resp = session.request(method, self.url(node_address, path), **kwargs)
+        except (requests.Timeout, requests.exceptions.ConnectionError):
+            with self.lock:
+                self.error_counts[node_address] += 1
+            self.health.failure(node_address)
+            raise
+        except requests.exceptions.RequestException:
+            with self.lock:
+                self.error_counts[node_address] += 1
+            # the peer answered, even if badly
+            self.health.success(node_address)
+            raise
+
+        self.health.success(node_address)
+        self.learn(node_address, resp.headers)
+
+        if resp.headers.get('Content-Type', '').startswith(codec.MSGPACK):
+            resp.json = functools.partial(codec.decode, codec.MSGPACK, resp.content)
+
+        return resp
+
+    def available(self, node_address):
+        """
+        Whether requests to a peer are sent, i.e. its breaker is closed and
+        it is not suspected
+        :return bool:
+        """
+        return self.health.available(node_address)
+
+    def get(self, node_address, path, **kwargs):
+        return self.request('GET', node_address, path, **kwargs)
+
+    def put(self, node_address, path, **kwargs):
+        return self.request('PUT', node_address, path, **kwargs)
+
+    def delete(self, node_address, path, **kwargs):
+        return self.request('DELETE', node_address, path, **kwargs)
+
+    def stats(self):
+        """
+        Connection reuse metrics per peer
+        :return dict:
+        """
+        response = {}
+
+        for node_address, session in list(self.sessions.items()):
+            connections = 0
+            adapter = session.get_adapter('http://')
+
+            # urllib3 counts the connections each pool had to open
+            for pool_key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(pool_key)
+                if pool is not None:
+                    connections += pool.num_connections
+
+            requests_sent = self.request_counts[node_address]
+            reused = max(requests_sent - connections, 0)
+
+            response[node_address] = {
+                'requests': requests_sent,
+                'errors': self.error_counts[node_address],
+                'connections-opened': connections,
+                'connections-reused': reused,
+                'reuse-ratio': (float(reused) / requests_sent) if requests_sent else 0.0,
+                'timeout': self.timeouts.get(node_address, self.timeout),
+                'codec': self.codecs.get(node_address, codec.JSON),
+                'available': self.available(node_address)
+            }
+
+        return response
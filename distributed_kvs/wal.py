@@ -0,0 +1,333 @@
+"""
+    Write-ahead log of a node. Changes are appended as JSON lines to log
+    segments and made durable by a background thread which fsyncs every
+    record appended while the previous fsync was running in one go (group
+    commit). Snapshots of the whole node state let older segments be deleted
+"""
+
+import json
+import os
+import threading
+import time
+import myconstants
+
+SNAPSHOT_FILE = 'snapshot.json'
+SEGMENT_PREFIX = 'wal.'
+SEGMENT_SUFFIX = '.log'
+
+
+def fsync_directory(directory):
+    """
+    Make file creations and renames in a directory durable
+    :return None:
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog(object):
+    """
+        Records are appended to the current segment wal.<n>.log. A snapshot
+        taken at segment n holds the state of everything logged before segment
+        n, so recovery loads the snapshot and replays segments n and above
+    """
+    def __init__(self, directory, checkpoint=None, snapshot_records=myconstants.WAL_SNAPSHOT_RECORDS,
+                 group_commit_delay=myconstants.WAL_GROUP_COMMIT_DELAY):
+        """
+        :param directory: directory holding the snapshot and log segments
+        :param checkpoint: optional function taking a snapshot, called in its own thread
+                           once snapshot_records records were logged since the last one
+        :param group_commit_delay: seconds to wait for more records before each fsync
+        """
+        self.directory = directory
+        self.checkpoint = checkpoint
+        self.snapshot_records = snapshot_records
+        self.group_commit_delay = group_commit_delay
+
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+        self.segment = 0                # segment new records go to
+        self.pending = []               # (segment, line) not written yet
+        self.appended = 0               # ticket of the last appended record
+        self.durable = 0                # ticket up to which records are fsynced
+        self.since_snapshot = 0         # records appended since the last snapshot
+        self.rotate_ticket = 0          # last ticket of the segments before a rotation
+        self.checkpointing = False
+
+        self.file = None
+        self.file_segment = None
+
+        self.fsyncs = 0
+        self.synced_records = 0
+        self.snapshots = 0
+        self.last_snapshot_ms = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '{0}{1:010d}{2}'.format(SEGMENT_PREFIX, segment, SEGMENT_SUFFIX))
+
+    def segments(self):
+        """
+        Numbers of the segments on disk, oldest first
+        :return list:
+        """
+        segments = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+
+        segments.sort()
+
+        return segments
+
+    def open(self):
+        """
+        Read what a previous run left in the directory. New records go to a
+        fresh segment, so nothing is appended after a torn last record
+        :return (dict, iterator): the snapshot (None if there is none) and the records logged after it
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        snapshot = None
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+        first = snapshot['segment'] if snapshot is not None else 0
+        segments = [segment for segment in self.segments() if segment >= first]
+
+        self.segment = max(segments + [first - 1]) + 1
+
+        return snapshot, self.replay(segments)
+
+    def replay(self, segments):
+        """
+        Records of the given segments in the order they were appended
+        :return iterator of dict:
+        """
+        for segment in segments:
+            with open(self.segment_path(segment)) as segment_file:
+                for line in segment_file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # torn write of the last record before a crash
+                        print('Error: ignoring the end of log segment {0}'.format(segment))
+                        break
+
+    def start(self):
+        """
+        Start the thread writing and fsyncing records
+        :return None:
+        """
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='wal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, record):
+        """
+        Append a record. It is durable once wait() on the returned ticket returns.
+        Callers append under their own lock so records are in the order of the changes
+        :param record: json serializable dict
+        :return int: ticket of the record
+        """
+        line = json.dumps(record) + '\n'
+
+        with self.cond:
+            self.appended += 1
+            self.since_snapshot += 1
+            self.pending.append((self.segment, line))
+            self.cond.notify_all()
+
+            return self.appended
+
+    def wait(self, ticket):
+        """
+        Wait until the record of a ticket and every record before it are on disk
+        :return None:
+        """
+        with self.cond:
+            while self.durable < ticket and not self.closed:
+                self.cond.wait()
+
+    def sync(self):
+        """
+        Wait until every record appended so far is on disk
+        :return None:
+        """
+        with self.cond:
+            ticket = self.appended
+
+        self.wait(ticket)
+
+    def run(self):
+        """
+        Group commit loop. While one batch is being fsynced new records pile
+        up in pending and all go out with the next fsync
+        """
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+
+                if self.closed and not self.pending:
+                    break
+
+            if self.group_commit_delay > 0:
+                time.sleep(self.group_commit_delay)
+
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+                ticket = self.appended
+
+            try:
+                self.write_batch(batch)
+            except OSError as error:
+                print('Error: unable to write the write-ahead log {0}'.format(error))
+                with self.cond:
+                    self.pending = batch + self.pending
+                time.sleep(0.1)
+                continue
+
+            with self.cond:
+                self.durable = ticket
+                self.fsyncs += 1
+                self.synced_records += len(batch)
+                self.cond.notify_all()
+
+                start_checkpoint = self.checkpoint is not None and not self.checkpointing and \
+                    self.since_snapshot >= self.snapshot_records
+                if start_checkpoint:
+                    self.checkpointing = True
+
+            if start_checkpoint:
+                thread = threading.Thread(target=self.run_checkpoint, name='wal-checkpoint')
+                thread.daemon = True
+                thread.start()
+
+    def write_batch(self, batch):
+        """
+        Write records to their segments and fsync them
+        :return None:
+        """
+        for segment, line in batch:
+            if segment != self.file_segment:
+                self.close_file()
+                self.file = open(self.segment_path(segment), 'a')
+                self.file_segment = segment
+                fsync_directory(self.directory)
+
+            self.file.write(line)
+
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.file_segment = None
+
+    def run_checkpoint(self):
+        try:
+            self.checkpoint()
+        except Exception as error:
+            print('Error: snapshot failed {0}'.format(error))
+        finally:
+            with self.cond:
+                self.checkpointing = False
+
+    def rotate(self):
+        """
+        Start a new segment. Called under the same lock as append() while the
+        caller copies its state, so the state holds exactly the records of
+        the older segments
+        :return int: the new segment, to pass to write_snapshot
+        """
+        with self.cond:
+            self.segment += 1
+            self.since_snapshot = 0
+            self.rotate_ticket = self.appended
+
+            return self.segment
+
+    def write_snapshot(self, state, segment):
+        """
+        Atomically replace the snapshot, then delete the segments it covers
+        :param state: json serializable state of the node
+        :param segment: segment returned by rotate() when the state was copied
+        :return None:
+        """
+        start = time.time()
+        snapshot = dict(state)
+        snapshot['segment'] = segment
+
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        os.replace(tmp_path, path)
+        fsync_directory(self.directory)
+
+        # records of the old segments may still be on their way to disk
+        self.wait(self.rotate_ticket)
+
+        for old in self.segments():
+            if old < segment:
+                os.remove(self.segment_path(old))
+
+        with self.cond:
+            self.snapshots += 1
+            self.last_snapshot_ms = (time.time() - start) * 1000.0
+
+    def close(self):
+        """
+        Write what is pending and stop the log thread
+        :return None:
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.close_file()
+
+    def stats(self):
+        """
+        Write-ahead log counters
+        :return dict:
+        """
+        with self.cond:
+            return {
+                'segment': self.segment,
+                'appended': self.appended,
+                'durable': self.durable,
+                'fsyncs': self.fsyncs,
+                'records-per-fsync': self.synced_records / self.fsyncs if self.fsyncs else 0,
+                'since-snapshot': self.since_snapshot,
+                'snapshots': self.snapshots,
+                'last-snapshot-ms': self.last_snapshot_ms
+            }
@@ -0,0 +1,84 @@
+"""
+    Unit tests of the batch API on a single node shard
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import myconstants
+from shard_node import ShardNodeWrapper
+
+
+def make_node():
+    node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800', 1)
+    node.setup_routes()
+    node.setup_address()
+    node.setup_pototetial_replicas()
+    return node
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.client = make_node().app.test_client()
+
+    def batch(self, method, body):
+        return self.client.open('/kvs/batch', method=method, json=body)
+
+    def test_put_get_delete(self):
+        resp = self.batch('PUT', {'items': {'a': 1, 'b': 'x'}, 'causal-context': {}})
+        self.assertEqual(resp.status_code, 200)
+        results = resp.get_json()['results']
+        self.assertEqual([results['a']['status-code'], results['b']['status-code']], [201, 201])
+
+        token = resp.get_json()['causal-context']
+        resp = self.batch('GET', {'keys': ['a', 'b', 'c'], 'causal-context': token})
+        results = resp.get_json()['results']
+        self.assertEqual(results['a']['value'], 1)
+        self.assertEqual(results['b']['value'], 'x')
+        self.assertEqual(results['c']['status-code'], 404)
+
+        resp = self.batch('DELETE', {'keys': ['a', 'c'], 'causal-context': token})
+        results = resp.get_json()['results']
+        self.assertEqual(results['a']['status-code'], 200)
+        self.assertEqual(results['c']['status-code'], 404)
+
+        resp = self.batch('GET', {'keys': ['a'], 'causal-context': resp.get_json()['causal-context']})
+        self.assertEqual(resp.get_json()['results']['a']['status-code'], 404)
+
+    def test_malformed_bodies(self):
+        bad = [
+            ('PUT', {'items': ['a', 'b']}),
+            ('PUT', {'items': 'ab'}),
+            ('PUT', {'keys': ['a']}),
+            ('PUT', ['a']),
+            ('GET', {'keys': 'ab'}),
+            ('GET', {'keys': {'a': 1}}),
+            ('GET', {'keys': ['a', 1]}),
+            ('GET', {}),
+            ('DELETE', {'items': {'a': 1}}),
+            ('DELETE', 'a'),
+        ]
+
+        for method, body in bad:
+            resp = self.batch(method, body)
+            self.assertEqual(resp.status_code, 400, (method, body))
+            self.assertIn('Bad batch', resp.get_json()['error'])
+
+    def test_batch_max_keys(self):
+        keys = ['k{0}'.format(i) for i in range(myconstants.BATCH_MAX_KEYS + 1)]
+
+        self.assertEqual(self.batch('GET', {'keys': keys}).status_code, 400)
+        self.assertEqual(self.batch('PUT', {'items': {key: 1 for key in keys}}).status_code, 400)
+        self.assertEqual(self.batch('GET', {'keys': keys[:-1]}).status_code, 200)
+
+    def test_proxy_batch_rejects_malformed_bodies(self):
+        resp = self.client.put('/proxy/batch', json={'items': ['a']})
+
+        self.assertEqual(resp.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
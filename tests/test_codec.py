@@ -0,0 +1,128 @@
+"""
+    Unit tests of the node to node encoding and its negotiation
+"""
+
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import codec
+from flask import Flask, request
+from transport import PeerTransport
+
+
+@unittest.skipUnless(codec.available(), 'msgpack is not installed')
+class TestNegotiation(unittest.TestCase):
+    def transport(self):
+        transport = PeerTransport(content_type=codec.MSGPACK)
+        transport.learn('a:1', {codec.CODECS_HEADER: 'msgpack'})
+        transport.learn('b:1', {})
+        return transport
+
+    def test_peers_start_with_json(self):
+        transport = PeerTransport(content_type=codec.MSGPACK)
+        kwargs = transport.prepare('a:1', 'proxy/replicate-batch', {'json': {'x': 1}})
+
+        self.assertEqual(kwargs, {'json': {'x': 1}})
+        self.assertEqual(transport.encode('a:1', {'x': 1}), (codec.JSON, b'{"x": 1}'))
+
+    def test_msgpack_to_peers_which_take_it(self):
+        kwargs = self.transport().prepare('a:1', 'proxy/replicate-batch', {'json': {'x': 1}})
+
+        self.assertEqual(kwargs['headers']['Content-Type'], codec.MSGPACK)
+        self.assertEqual(kwargs['headers']['Accept'], codec.ACCEPT_MSGPACK)
+        self.assertEqual(codec.decode(codec.MSGPACK, kwargs['data']), {'x': 1})
+
+    def test_json_to_other_peers_and_public_routes(self):
+        transport = self.transport()
+
+        self.assertEqual(transport.prepare('b:1', 'proxy/replicate-batch', {'json': {'x': 1}}), {'json': {'x': 1}})
+        self.assertEqual(transport.prepare('a:1', 'kvs/key-count', {}), {})
+
+    def test_callers_keep_asking_for_json(self):
+        kwargs = self.transport().prepare('a:1', 'proxy/kvs/keys/k', {'json': {}, 'headers': {'Accept': codec.JSON}})
+
+        self.assertEqual(kwargs['headers']['Accept'], codec.JSON)
+
+    def test_ints_msgpack_cannot_hold_go_as_json(self):
+        kwargs = self.transport().prepare('a:1', 'proxy/replicate-batch', {'json': {'timestamp': 2 ** 70}})
+
+        self.assertEqual(kwargs['headers']['Content-Type'], codec.JSON)
+        self.assertEqual(json.loads(kwargs['data']), {'timestamp': 2 ** 70})
+
+    def test_peer_which_stops_offering_msgpack_gets_json(self):
+        transport = self.transport()
+        transport.learn('a:1', {})
+
+        self.assertEqual(transport.codecs['a:1'], codec.JSON)
+
+    def test_json_node_never_switches(self):
+        transport = PeerTransport(content_type=codec.JSON)
+        transport.learn('a:1', {codec.CODECS_HEADER: 'msgpack'})
+
+        self.assertNotIn('a:1', transport.codecs)
+
+
+@unittest.skipUnless(codec.available(), 'msgpack is not installed')
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.request_class = codec.NodeRequest
+
+        @app.route('/proxy/echo', methods=['PUT'])
+        def echo():
+            return codec.jsonify(request.get_json())
+
+        self.client = app.test_client()
+
+    def test_reads_msgpack_bodies(self):
+        resp = self.client.put('/proxy/echo', data=codec.encode(codec.MSGPACK, {'x': [1, 2]}),
+                               headers={'Content-Type': codec.MSGPACK})
+
+        self.assertEqual(resp.mimetype, codec.JSON)
+        self.assertEqual(resp.get_json(), {'x': [1, 2]})
+
+    def test_answers_msgpack_only_when_asked(self):
+        for accept in ['*/*', codec.JSON]:
+            resp = self.client.put('/proxy/echo', json={'x': 1}, headers={'Accept': accept})
+            self.assertEqual(resp.mimetype, codec.JSON)
+
+        resp = self.client.put('/proxy/echo', json={'x': 1}, headers={'Accept': codec.ACCEPT_MSGPACK})
+
+        self.assertEqual(resp.mimetype, codec.MSGPACK)
+        self.assertEqual(codec.decode(codec.MSGPACK, resp.data), {'x': 1})
+
+    def test_answers_json_when_msgpack_cannot_encode(self):
+        resp = self.client.put('/proxy/echo', json={'x': 2 ** 70}, headers={'Accept': codec.ACCEPT_MSGPACK})
+
+        self.assertEqual(resp.mimetype, codec.JSON)
+        self.assertEqual(resp.get_json(), {'x': 2 ** 70})
+
+
+class TestWithoutMsgpack(unittest.TestCase):
+    def test_json_only(self):
+        with mock.patch.object(codec, 'msgpack', None):
+            self.assertFalse(codec.available())
+
+            app = Flask(__name__)
+            with app.test_request_context('/proxy/x', headers={'Accept': codec.ACCEPT_MSGPACK}):
+                self.assertFalse(codec.wants_msgpack())
+                self.assertEqual(codec.jsonify({'x': 1}).mimetype, codec.JSON)
+
+    def test_transport_keeps_json(self):
+        transport = PeerTransport(content_type=codec.MSGPACK)
+
+        with mock.patch.object(codec, 'msgpack', None):
+            transport.learn('a:1', {codec.CODECS_HEADER: 'msgpack'})
+            content_type, body = transport.encode('a:1', {'x': 1})
+
+        self.assertEqual(content_type, codec.JSON)
+        self.assertEqual(json.loads(body), {'x': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+    Unit tests of the view change coordinator and migration plans
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from coordinator import ViewChangeCoordinator
+from migration import MigrationPlan
+from routing import RoutingTable
+
+
+class FakeResponse(object):
+    def __init__(self, answer):
+        self.answer = answer
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.answer
+
+
+class FakeTransport(object):
+    """
+        Answers the phases of the other nodes from a dict of answers
+    """
+    timeout = 1
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+
+    def put(self, node_address, path, json=None, timeout=None):
+        phase = path.rsplit('/', 1)[1]
+        self.calls.append((node_address, phase))
+        return FakeResponse(self.answers.get(phase, {}))
+
+
+class TestViewChangeCoordinator(unittest.TestCase):
+    def coordinator(self, commit_answer):
+        self.local_phases = []
+
+        def local(phase, answer):
+            def run(body):
+                self.local_phases.append(phase)
+                return answer
+            return run
+
+        self.transport = FakeTransport({'prepare': {'prepared': 'v1'}, 'commit': commit_answer})
+
+        return ViewChangeCoordinator(self.transport, 'a:1', local('prepare', {}), local('commit', {'migrated': True}),
+                                     local('finish', {}), local('abort', {}))
+
+    def body(self):
+        return {'view': 'a:1,b:1', 'repl-factor': 1, 'view-id': 'v1'}
+
+    def test_finishes_when_every_node_migrated(self):
+        coordinator = self.coordinator({'migrated': True})
+
+        self.assertTrue(coordinator.run(self.body(), ['a:1', 'b:1']))
+        self.assertEqual(self.local_phases, ['prepare', 'commit', 'finish'])
+        self.assertIn(('b:1', 'finish'), self.transport.calls)
+        self.assertEqual(coordinator.status()['phase'], 'done')
+
+    def test_aborts_when_a_migration_failed(self):
+        coordinator = self.coordinator({'migrated': False})
+
+        self.assertFalse(coordinator.run(self.body(), ['a:1', 'b:1']))
+        self.assertEqual(self.local_phases, ['prepare', 'commit', 'abort'])
+        self.assertIn(('b:1', 'abort'), self.transport.calls)
+        self.assertNotIn(('b:1', 'finish'), self.transport.calls)
+        self.assertEqual(coordinator.status()['phase'], 'aborted')
+        self.assertIn('migrated', coordinator.status()['error'])
+
+    def test_aborts_when_a_commit_has_no_answer(self):
+        coordinator = self.coordinator({})
+
+        self.assertFalse(coordinator.run(self.body(), ['a:1', 'b:1']))
+        self.assertEqual(self.local_phases[-1], 'abort')
+
+
+class TestMigrationPlan(unittest.TestCase):
+    def plan(self, old_partitions, new_partitions):
+        return MigrationPlan(RoutingTable(old_partitions), old_partitions, RoutingTable(new_partitions), new_partitions)
+
+    def test_split_sends_keys_changing_shard_once(self):
+        old_partitions = {'1': ['a:1']}
+        new_partitions = {'1': ['a:1'], '2': ['b:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        ring = RoutingTable(new_partitions)
+        keys = ['key{0}'.format(i) for i in range(200)]
+
+        outgoing, drop = plan.split('a:1', keys)
+        moving = sorted(key for key in keys if ring.get_node(key) == '2')
+
+        self.assertEqual(outgoing, {('1', '2'): moving})
+        self.assertEqual(sorted(drop), moving)
+
+        # b is not an old replica, it sends nothing
+        self.assertEqual(plan.split('b:1', moving), ({}, []))
+
+    def test_split_only_sends_to_new_replicas(self):
+        old_partitions = {'1': ['a:1']}
+        new_partitions = {'1': ['a:1', 'b:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        keys = ['key{0}'.format(i) for i in range(50)]
+
+        outgoing, drop = plan.split('a:1', keys)
+
+        self.assertEqual(outgoing, {('1', '1'): sorted(keys)})
+        self.assertEqual(plan.moves[('1', '1')]['targets'], ['b:1'])
+        self.assertEqual(drop, [])
+
+    def test_split_picks_a_live_sender(self):
+        old_partitions = {'1': ['a:1', 'b:1']}
+        new_partitions = {'1': ['c:1']}
+        plan = MigrationPlan(RoutingTable(old_partitions), old_partitions, RoutingTable(new_partitions),
+                             new_partitions, alive={'b:1', 'c:1'})
+        keys = ['key{0}'.format(i) for i in range(20)]
+
+        self.assertEqual(plan.split('a:1', keys)[0], {})
+        self.assertEqual(plan.split('b:1', keys)[0], {('1', '1'): sorted(keys)})
+
+    def test_drop_matches_the_new_ring(self):
+        old_partitions = {'1': ['a:1', 'b:1'], '2': ['c:1', 'd:1']}
+        new_partitions = {'1': ['a:1', 'e:1'], '2': ['b:1', 'c:1'], '3': ['d:1', 'f:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        old_ring = RoutingTable(old_partitions)
+        new_ring = RoutingTable(new_partitions)
+        keys = ['key{0}'.format(i) for i in range(500)]
+
+        for shard_id, replicas in old_partitions.items():
+            held = [key for key in keys if old_ring.get_node(key) == shard_id]
+
+            for node_address in replicas:
+                _, drop = plan.split(node_address, held)
+                expected = [key for key in held if node_address not in new_partitions[new_ring.get_node(key)]]
+
+                self.assertEqual(drop, expected, node_address)
+
+    def test_node_leaving_the_view_drops_everything(self):
+        old_partitions = {'1': ['a:1', 'b:1']}
+        new_partitions = {'1': ['a:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        keys = ['key{0}'.format(i) for i in range(50)]
+
+        self.assertEqual(plan.split('b:1', keys), ({}, keys))
+        self.assertEqual(plan.split('a:1', keys), ({}, []))
+
+    def test_sender_keeping_its_keys_drops_nothing(self):
+        old_partitions = {'1': ['a:1'], '2': ['b:1']}
+        new_partitions = {'1': ['a:1', 'b:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        old_ring = RoutingTable(old_partitions)
+        keys = ['key{0}'.format(i) for i in range(100)]
+        held = [key for key in keys if old_ring.get_node(key) == '2']
+
+        outgoing, drop = plan.split('b:1', held)
+
+        self.assertEqual(outgoing, {('2', '1'): sorted(held)})
+        self.assertEqual(drop, [])
+
+    def test_rollback_drops_only_received_keys(self):
+        old_partitions = {'1': ['a:1'], '2': ['b:1']}
+        new_partitions = {'1': ['a:1']}
+        plan = self.plan(old_partitions, new_partitions)
+        old_ring = RoutingTable(old_partitions)
+        keys = ['key{0}'.format(i) for i in range(200)]
+
+        received = sorted(key for key in keys if old_ring.get_node(key) == '2')
+
+        self.assertEqual(sorted(plan.rollback('a:1', keys)), received)
+        self.assertEqual(plan.rollback('b:1', received), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
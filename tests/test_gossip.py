@@ -0,0 +1,77 @@
+"""
+    Unit tests of the gossip scheduler
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import requests
+from gossip import GossipScheduler
+
+
+class FakeResponse(object):
+    content = b'{}'
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, down=()):
+        self.down = set(down)
+
+    def encode(self, node_address, obj):
+        return 'application/json', json.dumps(obj).encode('utf-8')
+
+    def put(self, node_address, path, **kwargs):
+        if node_address in self.down:
+            raise requests.exceptions.ConnectionError('down')
+
+        return FakeResponse()
+
+
+class TestGossipScheduler(unittest.TestCase):
+    def scheduler(self, repair, down=()):
+        return GossipScheduler(FakeTransport(down), lambda: ['a:1', 'b:1'], lambda peer: {'seq': 1},
+                               repair=repair, fanout=0, repair_every=1)
+
+    def test_bad_repair_answer_does_not_stop_the_round(self):
+        def repair(peer):
+            if peer == 'a:1':
+                raise KeyError('entries')
+            return 3
+
+        gossip = self.scheduler(repair)
+
+        for _ in range(2):
+            round_stats = gossip.run_round()
+
+        self.assertEqual(round_stats['repaired-keys'], 3)
+        self.assertEqual(gossip.stats()['rounds'], 2)
+        self.assertEqual(gossip.stats()['repaired-keys'], 6)
+
+    def test_malformed_answers_are_caught(self):
+        for error in [ValueError('not json'), TypeError('not a dict'), requests.exceptions.Timeout()]:
+            def repair(peer):
+                raise error
+
+            gossip = self.scheduler(repair)
+
+            self.assertEqual(gossip.run_round()['repaired-keys'], 0)
+            self.assertEqual(gossip.stats()['rounds'], 1)
+
+    def test_unreachable_peer_is_backed_off(self):
+        gossip = self.scheduler(lambda peer: 0, down=['a:1'])
+        round_stats = gossip.run_round()
+
+        self.assertEqual(round_stats['failed'], ['a:1'])
+        self.assertEqual(gossip.select_peers(), ['b:1'])
+        self.assertIn('a:1', gossip.stats()['backed-off'])
+
+
+if __name__ == '__main__':
+    unittest.main()
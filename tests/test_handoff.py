@@ -0,0 +1,161 @@
+"""
+    Unit tests of hinted handoff and the replay of hints
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import requests
+from handoff import HintQueue, HintedHandoff
+
+
+def entry(timestamp, value='v'):
+    return {'timestamp': timestamp, 'doesExist': True, 'value': value}
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code))
+
+
+class FakeTransport(object):
+    """
+        Records the batches replayed to each node. Nodes in down fail to
+        connect, nodes not in up are taken as unavailable by the breaker
+    """
+    def __init__(self):
+        self.up = set()
+        self.down = set()
+        self.batches = []
+        self.on_put = None
+
+    def available(self, node_address):
+        return node_address in self.up
+
+    def put(self, node_address, path, **kwargs):
+        if self.on_put is not None:
+            self.on_put()
+
+        if node_address in self.down:
+            raise requests.exceptions.ConnectionError('down')
+
+        self.batches.append((node_address, path, kwargs['json']['causal-context']))
+        return FakeResponse(200)
+
+
+class TestHintQueue(unittest.TestCase):
+    def test_newest_hint_of_a_key_wins(self):
+        queue = HintQueue('a:1')
+        queue.add({'k': entry(5, 'new')})
+        queue.add({'k': entry(3, 'old')})
+
+        self.assertEqual(queue.take(10), {'k': entry(5, 'new')})
+
+    def test_oldest_hints_dropped_beyond_max_keys(self):
+        queue = HintQueue('a:1', max_keys=2)
+        queue.add({'k1': entry(1), 'k2': entry(2), 'k3': entry(3)})
+
+        self.assertEqual(list(queue.take(10)), ['k2', 'k3'])
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+
+class TestHintedHandoff(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport()
+        self.handoff = HintedHandoff(self.transport, batch_keys=2)
+
+    def test_replay_in_batches(self):
+        self.handoff.hint('a:1', {'k{0}'.format(i): entry(i) for i in range(5)})
+        self.transport.up.add('a:1')
+
+        self.assertEqual(self.handoff.replay_all(), 5)
+        self.assertEqual([len(batch) for _, _, batch in self.transport.batches], [2, 2, 1])
+        self.assertEqual(self.transport.batches[0][1], 'proxy/replicate-batch')
+        self.assertEqual(self.handoff.stats()['peers']['a:1']['hints'], 0)
+
+    def test_unavailable_replica_is_skipped(self):
+        self.handoff.hint('a:1', {'k': entry(1)})
+
+        self.assertEqual(self.handoff.replay_all(), 0)
+        self.assertEqual(self.transport.batches, [])
+
+    def test_hints_kept_when_replay_fails(self):
+        self.handoff.hint('a:1', {'k': entry(1)})
+        self.transport.up.add('a:1')
+        self.transport.down.add('a:1')
+
+        self.assertEqual(self.handoff.replay_all(), 0)
+        self.assertEqual(self.handoff.stats()['failures'], 1)
+
+        self.transport.down.clear()
+
+        self.assertEqual(self.handoff.replay_all(), 1)
+        self.assertEqual(self.transport.batches, [('a:1', 'proxy/replicate-batch', {'k': entry(1)})])
+
+    def test_newer_hint_during_replay_is_kept(self):
+        self.handoff.hint('a:1', {'k': entry(1, 'old')})
+        self.transport.up.add('a:1')
+
+        def write_during_replay():
+            self.transport.on_put = None
+            self.handoff.hint('a:1', {'k': entry(2, 'new')})
+
+        self.transport.on_put = write_during_replay
+        self.handoff.replay('a:1')
+
+        # the first batch carried the old value, the newer hint is replayed after it
+        self.assertEqual([batch['k']['value'] for _, _, batch in self.transport.batches], ['old', 'new'])
+        self.assertEqual(self.handoff.stats()['peers']['a:1']['hints'], 0)
+
+
+class TestHintFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transport = FakeTransport()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hints_outlive_a_restart(self):
+        handoff = HintedHandoff(self.transport)
+        handoff.open(self.directory)
+        handoff.hint('127.0.0.1:13800', {'k1': entry(1), 'k2': entry(2)})
+        handoff.hint('127.0.0.1:13800', {'k1': entry(3, 'newer')})
+
+        path = handoff.file_path('127.0.0.1:13800')
+        with open(path, 'a') as f:
+            f.write('{"key": "k3", "ent')
+
+        restarted = HintedHandoff(self.transport)
+        restarted.open(self.directory)
+        self.transport.up.add('127.0.0.1:13800')
+
+        self.assertEqual(restarted.peers(), ['127.0.0.1:13800'])
+        self.assertEqual(restarted.replay_all(), 2)
+        self.assertEqual(self.transport.batches[0][2], {'k2': entry(2), 'k1': entry(3, 'newer')})
+
+    def test_drop_deletes_the_file(self):
+        handoff = HintedHandoff(self.transport)
+        handoff.open(self.directory)
+        handoff.hint('a:1', {'k': entry(1)})
+        path = handoff.file_path('a:1')
+
+        self.assertTrue(os.path.exists(path))
+
+        handoff.drop('a:1')
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(handoff.peers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+    Unit tests of the failure detector and the circuit breakers
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import myconstants
+from health import ALLOW, CLOSED, HALF_OPEN, OPEN, PROBE, REJECT, CircuitBreaker, PeerHealth, PhiAccrualDetector
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPhiAccrualDetector(unittest.TestCase):
+    def setUp(self):
+        self.detector = PhiAccrualDetector(min_std=0.5, min_samples=3)
+
+        for second in range(10):
+            self.detector.heartbeat('a:1', 1000.0 + second)
+
+    def test_phi_grows_with_silence(self):
+        last = 1009.0
+        phis = [self.detector.phi('a:1', last + elapsed) for elapsed in (0.5, 1, 2, 3, 5)]
+
+        self.assertEqual(phis, sorted(phis))
+        self.assertLess(phis[1], 1)
+        self.assertLess(phis[3], myconstants.PHI_THRESHOLD)
+        self.assertGreater(phis[4], myconstants.PHI_THRESHOLD)
+        self.assertEqual(self.detector.phi('a:1', last + 3600), myconstants.PHI_MAX)
+
+    def test_no_suspicion_without_enough_heartbeats(self):
+        self.detector.heartbeat('b:1', 1000.0)
+        self.detector.heartbeat('b:1', 1001.0)
+
+        self.assertEqual(self.detector.phi('b:1', 2000.0), 0.0)
+        self.assertEqual(self.detector.phi('unknown:1', 2000.0), 0.0)
+
+    def test_answers_reset_silence(self):
+        self.detector.seen('a:1', 1020.0)
+
+        self.assertLess(self.detector.phi('a:1', 1020.5), 1)
+
+    def test_window_keeps_latest_intervals(self):
+        detector = PhiAccrualDetector(window=4)
+
+        for second in range(10):
+            detector.heartbeat('a:1', float(second))
+
+        self.assertEqual(len(detector.intervals['a:1']), 4)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failures=2, open_seconds=1, max_open_seconds=4)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure(0)
+        self.assertEqual(self.breaker.before(0), ALLOW)
+
+        self.breaker.failure(0)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.before(0.5), REJECT)
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_success_resets_failures(self):
+        self.breaker.failure(0)
+        self.breaker.success()
+        self.breaker.failure(0)
+
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_probe_success_closes(self):
+        self.breaker.failure(0)
+        self.breaker.failure(0)
+
+        self.assertEqual(self.breaker.before(1), PROBE)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # only one probe at a time
+        self.assertEqual(self.breaker.before(1.1), REJECT)
+
+        self.breaker.success()
+
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.before(1.2), ALLOW)
+
+    def test_failed_probe_doubles_wait_up_to_max(self):
+        self.breaker.failure(0)
+        self.breaker.failure(0)
+        now = 0
+        waits = []
+
+        for _ in range(4):
+            now = self.breaker.probe_at
+            self.assertEqual(self.breaker.before(now), PROBE)
+            self.breaker.failure(now)
+            waits.append(self.breaker.probe_at - now)
+
+        self.assertEqual(waits, [2, 4, 4, 4])
+        self.assertEqual(self.breaker.state, OPEN)
+
+        self.assertEqual(self.breaker.before(self.breaker.probe_at), PROBE)
+        self.breaker.success()
+        self.breaker.failure(100)
+        self.breaker.failure(100)
+
+        self.assertEqual(self.breaker.probe_at, 101)
+
+    def test_lost_probe_does_not_block_forever(self):
+        self.breaker.failure(0)
+        self.breaker.failure(0)
+
+        self.assertEqual(self.breaker.before(1), PROBE)
+        self.assertEqual(self.breaker.before(4.5), REJECT)
+        self.assertEqual(self.breaker.before(5), PROBE)
+
+
+class TestPeerHealth(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.health = PeerHealth(threshold=8, clock=self.clock)
+
+        for _ in range(10):
+            self.health.heartbeat('a:1')
+            self.clock.now += 1
+
+    def test_suspected_peer_opens_breaker(self):
+        self.assertTrue(self.health.available('a:1'))
+
+        self.clock.now += 5
+
+        self.assertFalse(self.health.available('a:1'))
+        self.assertEqual(self.health.before('a:1'), REJECT)
+        self.assertEqual(self.health.breaker('a:1').state, OPEN)
+
+    def test_probe_closes_after_peer_returns(self):
+        self.health.failure('a:1')
+        self.health.failure('a:1')
+
+        self.assertFalse(self.health.available('a:1'))
+
+        self.clock.now += myconstants.BREAKER_OPEN_SECONDS
+
+        self.assertTrue(self.health.available('a:1'))
+        self.assertEqual(self.health.before('a:1'), PROBE)
+        self.assertFalse(self.health.available('a:1'))
+
+        self.health.success('a:1')
+
+        self.assertTrue(self.health.available('a:1'))
+        self.assertEqual(self.health.before('a:1'), ALLOW)
+
+    def test_heartbeat_closes_breaker(self):
+        self.health.failure('a:1')
+        self.health.failure('a:1')
+        self.health.heartbeat('a:1')
+
+        self.assertEqual(self.health.before('a:1'), ALLOW)
+
+    def test_forget(self):
+        self.health.failure('a:1')
+        self.health.failure('a:1')
+        self.health.forget('a:1')
+
+        self.assertTrue(self.health.available('a:1'))
+        self.assertEqual(self.health.stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
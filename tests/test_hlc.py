@@ -0,0 +1,47 @@
+"""
+    Unit tests of the hybrid logical clock
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from hlc import HybridLogicalClock, LOGICAL_BITS, physical_stamp
+
+
+class TestHybridLogicalClock(unittest.TestCase):
+    def test_stamps_increase(self):
+        clock = HybridLogicalClock()
+        stamps = [clock.now() for _ in range(1000)]
+
+        self.assertEqual(stamps, sorted(set(stamps)))
+
+    def test_update_orders_later_stamps_after(self):
+        clock = HybridLogicalClock(max_offset=60000)
+        observed = physical_stamp() + (5000 << LOGICAL_BITS)
+
+        self.assertTrue(clock.update(observed))
+        self.assertGreater(clock.now(), observed)
+
+    def test_update_ignores_stamps_too_far_ahead(self):
+        clock = HybridLogicalClock(max_offset=60000)
+        before = clock.now()
+
+        self.assertFalse(clock.update(2 ** 70))
+        self.assertFalse(clock.update(physical_stamp() + (120000 << LOGICAL_BITS)))
+
+        after = clock.now()
+        self.assertGreater(after, before)
+        self.assertLess(after, physical_stamp() + (1000 << LOGICAL_BITS))
+
+    def test_unbounded_clock_takes_any_stamp(self):
+        clock = HybridLogicalClock()
+
+        self.assertTrue(clock.update(2 ** 70))
+        self.assertGreater(clock.now(), 2 ** 70)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+    Unit tests of the Merkle tree used by anti-entropy
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from merkle import MerkleTree
+
+
+class TestMerkleTree(unittest.TestCase):
+    def test_same_entries_same_root(self):
+        ours = MerkleTree(depth=4)
+        theirs = MerkleTree(depth=4)
+
+        for i in range(50):
+            ours.update('k{0}'.format(i), i, True, 'v{0}'.format(i))
+        for i in reversed(range(50)):
+            theirs.update('k{0}'.format(i), i, True, 'v{0}'.format(i))
+
+        self.assertEqual(ours.root(), theirs.root())
+        self.assertEqual(ours.diff(lambda indices: {i: theirs.node_hash(i) for i in indices}), [])
+
+    def test_values_differ_under_same_timestamp(self):
+        ours = MerkleTree(depth=4)
+        theirs = MerkleTree(depth=4)
+
+        ours.update('a', 0, True, 'x')
+        theirs.update('a', 0, True, 'y')
+
+        self.assertNotEqual(ours.root(), theirs.root())
+        buckets = ours.diff(lambda indices: {i: theirs.node_hash(i) for i in indices})
+        self.assertEqual(buckets, [ours.bucket('a')])
+
+    def test_tombstones_ignore_value(self):
+        ours = MerkleTree(depth=4)
+        theirs = MerkleTree(depth=4)
+
+        ours.update('a', 7, False, '')
+        theirs.update('a', 7, False, None)
+
+        self.assertEqual(ours.root(), theirs.root())
+
+    def test_remove_restores_tree(self):
+        tree = MerkleTree(depth=4)
+        tree.update('a', 1, True, 'x')
+        before = tree.root()
+
+        tree.update('b', 2, True, 'y')
+        tree.remove('b')
+
+        self.assertEqual(tree.root(), before)
+        self.assertNotIn('b', tree.bucket_keys(tree.bucket('b')))
+
+    def test_rebuild_matches_updates(self):
+        items = [('k{0}'.format(i), i, i % 3 != 0, 'v{0}'.format(i)) for i in range(40)]
+        updated = MerkleTree(depth=4)
+        rebuilt = MerkleTree(depth=4)
+
+        for item in items:
+            updated.update(*item)
+        rebuilt.rebuild(items)
+
+        self.assertEqual(updated.root(), rebuilt.root())
+
+    def test_emptied_tree_matches_empty_tree(self):
+        tree = MerkleTree(depth=4)
+        tree.update('a', 1, True, 'x')
+        tree.remove('a')
+
+        self.assertEqual(tree.root(), MerkleTree(depth=4).root())
+
+
+if __name__ == '__main__':
+    unittest.main()
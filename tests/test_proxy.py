@@ -0,0 +1,83 @@
+"""
+    Unit tests of the node to node endpoints with malformed bodies
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from shard_node import ShardNodeWrapper
+
+
+def make_node():
+    node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800', 1)
+    node.setup_routes()
+    node.setup_address()
+    node.setup_pototetial_replicas()
+    return node
+
+
+class TestReceiveDict(unittest.TestCase):
+    def setUp(self):
+        self.node = make_node()
+        self.client = self.node.app.test_client()
+
+    def test_store_is_merged(self):
+        resp = self.client.put('/proxy/receive-dict', json={'a': 1})
+        self.assertEqual(resp.status_code, 200)
+
+        # older nodes send it encoded as a json string
+        resp = self.client.put('/proxy/receive-dict', json=json.dumps({'b': 2}))
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(self.node.kv_store.snapshot(), {'a': 1, 'b': 2})
+
+    def test_malformed_bodies(self):
+        for body in (['a'], 'not json', json.dumps(['a']), None):
+            resp = self.client.put('/proxy/receive-dict', json=body)
+            self.assertEqual(resp.status_code, 400, body)
+
+        resp = self.client.put('/proxy/receive-dict', data='{', content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.node.kv_store.count(), 0)
+
+
+
+class TestCausalContextDelta(unittest.TestCase):
+    def setUp(self):
+        self.node = make_node()
+        self.client = self.node.app.test_client()
+
+    def test_delta_is_applied(self):
+        peer = make_node()
+        peer.kv_store.put('a', 1)
+        peer.handle_causal_context('a', 1)
+        delta = peer.build_delta(0)
+
+        resp = self.client.put('/proxy/node-causal-context', json=delta)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['ack'], delta['seq'])
+        self.assertEqual(self.node.kv_store.get('a'), 1)
+
+    def test_malformed_bodies(self):
+        for body in (None, ['a'], {'from': 'a:1'}, {'seq': 1}, {'seq': 1, 'from': 'a:1', 'incarnation': 'x', 'clock': 'z'}):
+            resp = self.client.put('/proxy/node-causal-context', json=body)
+            self.assertEqual(resp.status_code, 400, body)
+
+
+class TestViewChangeBody(unittest.TestCase):
+    def test_malformed_bodies(self):
+        client = make_node().app.test_client()
+
+        for body in (None, ['a'], {'view': '127.0.0.1:13800'}, {'view': 1, 'repl-factor': 1},
+                     {'view': '127.0.0.1:13800', 'repl-factor': 'one'}):
+            resp = client.put('/kvs/view-change', json=body)
+            self.assertEqual(resp.status_code, 400, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+"""
+    Unit tests of write acknowledgement policies
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import requests
+from replication import Replicator, ReplicationPipeline, ACK_LOCAL, ACK_ONE, ACK_QUORUM, ACK_ALL
+from shard_node import ShardNodeWrapper
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeTransport(object):
+    """
+        Answers every request to a node with its status code, None for a node which is down
+    """
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def request(self, method, node_address, path, **kwargs):
+        status_code = self.statuses[node_address]
+
+        if status_code is None:
+            raise requests.exceptions.ConnectionError('down')
+
+        return FakeResponse(status_code)
+
+    def put(self, node_address, path, **kwargs):
+        return self.request('PUT', node_address, path, **kwargs)
+
+
+class FakeHandoff(object):
+    def __init__(self):
+        self.hints = []
+
+    def hint(self, node_address, entries):
+        self.hints.append(node_address)
+
+
+class TestWriteAck(unittest.TestCase):
+    entries = {'k': {'timestamp': 1, 'doesExist': True, 'value': 'v'}}
+
+    def replicator(self, statuses):
+        self.handoff = FakeHandoff()
+        return Replicator(FakeTransport(statuses), handoff=self.handoff)
+
+    def both_paths(self, statuses, policy):
+        """
+        Outcome of a write sent directly and through the replication queues
+        """
+        peers = list(statuses)
+        direct = self.replicator(statuses).replicate('PUT', peers, 'k', {'causal-context': self.entries}, policy)
+        queued = self.replicator(statuses).replicate_entries(peers, self.entries, policy)
+
+        return direct, queued
+
+    def test_required_acks(self):
+        replicator = self.replicator({})
+
+        self.assertEqual([replicator.required_acks(policy, 2) for policy in [ACK_LOCAL, ACK_ONE, ACK_QUORUM, ACK_ALL]],
+                         [0, 1, 1, 2])
+        self.assertEqual(replicator.required_acks(ACK_QUORUM, 4), 2)
+        self.assertEqual(replicator.required_acks(ACK_ONE, 0), 0)
+
+    def test_all_acknowledged(self):
+        self.assertEqual(self.both_paths({'a:1': 200, 'b:1': 201}, ACK_ALL), (True, True))
+
+    def test_local_never_waits(self):
+        self.assertEqual(self.both_paths({'a:1': None, 'b:1': None}, ACK_LOCAL), (True, True))
+
+    def test_quorum_with_a_replica_down(self):
+        self.assertEqual(self.both_paths({'a:1': 200, 'b:1': None}, ACK_QUORUM), (True, True))
+        self.assertEqual(self.both_paths({'a:1': 200, 'b:1': None}, ACK_ALL), (False, False))
+
+    def test_4xx_is_not_an_ack(self):
+        self.assertEqual(self.both_paths({'a:1': 404, 'b:1': 400}, ACK_ONE), (False, False))
+        self.assertEqual(self.both_paths({'a:1': 200, 'b:1': 400}, ACK_ALL), (False, False))
+        self.assertEqual(self.both_paths({'a:1': 200, 'b:1': 400}, ACK_ONE), (True, True))
+
+    def test_only_unreachable_or_failing_replicas_are_hinted(self):
+        statuses = {'a:1': 400, 'b:1': 503, 'c:1': None}
+        replicator = self.replicator(statuses)
+
+        for node_address in statuses:
+            self.assertFalse(replicator.send('PUT', node_address, 'k', {'causal-context': self.entries}))
+
+        self.assertEqual(sorted(self.handoff.hints), ['b:1', 'c:1'])
+
+
+class TestUnacknowledgedWrite(unittest.TestCase):
+    """
+        A write the policy cannot acknowledge stays applied and hinted, and its
+        503 carries a token which includes it
+    """
+    def setUp(self):
+        self.node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800,127.0.0.1:13801', 2)
+        self.node.setup_routes()
+        self.node.setup_address()
+        self.node.setup_pototetial_replicas()
+        self.handoff = FakeHandoff()
+        self.node.replicator = Replicator(FakeTransport({'127.0.0.1:13801': None}), handoff=self.handoff)
+        self.client = self.node.app.test_client()
+
+    def test_put(self):
+        resp = self.client.put('/kvs/keys/k?write-ack=all', json={'value': 'v', 'causal-context': {}})
+
+        self.assertEqual(resp.status_code, 503)
+        token = resp.get_json()['causal-context']
+        self.assertEqual(token, {str(self.node.shard_id): self.node.local_version('k')})
+        self.assertEqual(self.handoff.hints, ['127.0.0.1:13801'])
+
+        resp = self.client.get('/kvs/keys/k', json={'causal-context': token})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['value'], 'v')
+
+        # the retry overwrites the write with the same value
+        resp = self.client.put('/kvs/keys/k?write-ack=local', json={'value': 'v', 'causal-context': token})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.get_json()['replaced'])
+        self.assertGreater(resp.get_json()['causal-context'][str(self.node.shard_id)], token[str(self.node.shard_id)])
+
+    def test_delete(self):
+        self.client.put('/kvs/keys/k?write-ack=local', json={'value': 'v', 'causal-context': {}})
+        resp = self.client.delete('/kvs/keys/k?write-ack=all', json={'causal-context': {}})
+
+        self.assertEqual(resp.status_code, 503)
+        token = resp.get_json()['causal-context']
+        self.assertEqual(token, {str(self.node.shard_id): self.node.local_version('k')})
+
+        resp = self.client.get('/kvs/keys/k', json={'causal-context': token})
+        self.assertEqual(resp.status_code, 404)
+
+
+class BlockingTransport(object):
+    """
+        Holds every batch until released, then fails it as if the node was down
+    """
+    def __init__(self):
+        self.release = threading.Event()
+        self.sending = threading.Event()
+
+    def put(self, node_address, path, **kwargs):
+        self.sending.set()
+        self.release.wait(5)
+        raise requests.exceptions.ConnectionError('down')
+
+
+class TestFormerReplica(unittest.TestCase):
+    entries = TestWriteAck.entries
+
+    def test_drop_fails_queued_writes_and_stops_the_sender(self):
+        transport = BlockingTransport()
+        handoff = FakeHandoff()
+        pipeline = ReplicationPipeline(transport, handoff)
+
+        sent = pipeline.submit('a:1', self.entries)
+        self.assertTrue(transport.sending.wait(5))
+        queued = pipeline.submit('a:1', {'k2': self.entries['k']})
+        queue = pipeline.queues['a:1']
+
+        pipeline.drop('a:1')
+
+        self.assertFalse(queued.result(1))
+        self.assertEqual(pipeline.peers(), [])
+
+        transport.release.set()
+
+        self.assertFalse(sent.result(5))
+        queue.thread.join(5)
+        self.assertFalse(queue.thread.is_alive())
+        # the batch in flight is not hinted for a node which is not a replica anymore
+        self.assertEqual(handoff.hints, [])
+
+    def test_finished_view_change_drops_former_replica_queues(self):
+        node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800,127.0.0.1:13801', 2)
+        node.setup_routes()
+        node.setup_address()
+        node.setup_pototetial_replicas()
+        node.replicator = Replicator(FakeTransport({'127.0.0.1:13801': 200, '127.0.0.1:13802': 200}))
+
+        self.assertTrue(node.replicator.replicate_entries(['127.0.0.1:13801'], self.entries, ACK_ALL))
+
+        body = {'view': '127.0.0.1:13800,127.0.0.1:13802', 'repl-factor': 2, 'view-id': 1}
+        node.commit_view(body)
+
+        # until the view change finishes the old replica still gets its writes
+        self.assertEqual(node.replicator.pipeline.peers(), ['127.0.0.1:13801'])
+        queue = node.replicator.pipeline.queues['127.0.0.1:13801']
+
+        node.finish_view(body)
+
+        self.assertEqual(node.replicator.pipeline.peers(), [])
+        queue.thread.join(5)
+        self.assertFalse(queue.thread.is_alive())
+        self.assertTrue(node.replicator.replicate_entries(['127.0.0.1:13802'], self.entries, ACK_ALL))
+
+
+class TestWriteAckSetup(unittest.TestCase):
+    def setUp(self):
+        self.node = ShardNodeWrapper('127.0.0.1', 13800, '127.0.0.1:13800', 1)
+        self.environ = os.environ.get('WRITE_ACK')
+
+    def tearDown(self):
+        if self.environ is None:
+            os.environ.pop('WRITE_ACK', None)
+        else:
+            os.environ['WRITE_ACK'] = self.environ
+
+    def test_valid_policy(self):
+        os.environ['WRITE_ACK'] = 'quorum'
+        self.node.setup_write_ack()
+
+        self.assertEqual(self.node.replicator.policy, ACK_QUORUM)
+
+    def test_unknown_policy_exits(self):
+        os.environ['WRITE_ACK'] = 'majority'
+
+        with self.assertRaises(SystemExit):
+            self.node.setup_write_ack()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+    Unit tests of the routing table
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from routing import RoutingTable, hashi
+
+try:
+    import uhashring
+except ImportError:
+    uhashring = None
+
+
+KEYS = ['key{0}'.format(i) for i in range(3000)] + ['', 'é', 'a' * 50, 42]
+
+
+def partitions(count):
+    return {str(shard_id): ['127.0.0.1:{0}'.format(13800 + shard_id)] for shard_id in range(1, count + 1)}
+
+
+@unittest.skipUnless(uhashring, 'uhashring is not installed')
+class TestParityWithUhashring(unittest.TestCase):
+    def test_same_shard_as_uhashring(self):
+        for count in [1, 2, 3, 8, 17]:
+            table = RoutingTable(partitions(count))
+            ring = uhashring.HashRing(nodes=list(table.partitions))
+
+            for key in KEYS:
+                self.assertEqual(table.get_node(key), ring.get_node(key), (count, key))
+
+    def test_same_key_positions(self):
+        ring = uhashring.HashRing(nodes=['1', '2'])
+
+        for key in KEYS:
+            self.assertEqual(hashi(key), ring.hashi(key))
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_route_many_matches_get_node(self):
+        table = RoutingTable(partitions(5))
+        routes = table.route_many(KEYS)
+
+        self.assertEqual(sorted(routes), sorted(set(table.get_node(key) for key in KEYS)))
+        for shard_id, keys in routes.items():
+            self.assertEqual(keys, [key for key in KEYS if table.get_node(key) == shard_id])
+
+    def test_replicas(self):
+        table = RoutingTable({'1': ['a:1', 'b:1'], '2': ['c:1', 'd:1']})
+
+        for key in KEYS[:50]:
+            self.assertEqual(table.replicas(key), table.partitions[table.get_node(key)])
+
+    def test_views_with_the_same_shards_share_the_ring(self):
+        self.assertIs(RoutingTable({'1': ['a:1'], '2': ['b:1']}).ring, RoutingTable({'1': ['c:1'], '2': ['d:1']}).ring)
+
+    def test_empty_view(self):
+        table = RoutingTable({})
+
+        self.assertIsNone(table.get_node('key'))
+        self.assertEqual(table.replicas('key'), [])
+        self.assertEqual(table.route_many(['key']), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
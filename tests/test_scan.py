@@ -0,0 +1,144 @@
+"""
+    Unit tests of ordered scans, from the storage engine to /kvs/scan
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+import myconstants
+from shard_node import ShardNodeWrapper
+from storage import MemoryStorage, prefix_end
+
+
+def make_node(view='127.0.0.1:13800'):
+    node = ShardNodeWrapper('127.0.0.1', 13800, view, 1)
+    node.setup_routes()
+    node.setup_address()
+    node.setup_pototetial_replicas()
+    return node
+
+
+class TestStorageScan(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStorage(stripes=4)
+        self.store.update({'k{0:04d}'.format(i): i for i in range(1000)})
+
+    def test_scan_crosses_index_pages(self):
+        keys = [key for key, _ in self.store.scan()]
+
+        self.assertGreater(len(keys), myconstants.INDEX_SCAN_PAGE)
+        self.assertEqual(keys, sorted(self.store.keys()))
+
+    def test_bounds_and_limit(self):
+        self.assertEqual([key for key, _ in self.store.scan('k0998')], ['k0998', 'k0999'])
+        self.assertEqual([key for key, _ in self.store.scan('k0010', 'k0013')], ['k0010', 'k0011', 'k0012'])
+        self.assertEqual(len(list(self.store.scan('k0100', limit=300))), 300)
+        self.assertEqual(list(self.store.scan('z')), [])
+
+    def test_deleted_keys_are_skipped(self):
+        for i in range(0, 1000, 2):
+            self.store.delete('k{0:04d}'.format(i))
+
+        self.assertEqual([value for _, value in self.store.scan('k0000', 'k0010')], [1, 3, 5, 7, 9])
+
+
+class TestPrefixEnd(unittest.TestCase):
+    def test_prefix_end(self):
+        self.assertEqual(prefix_end('user:'), 'user;')
+        self.assertEqual(prefix_end('a' + chr(0x10FFFF)), 'b')
+        self.assertIsNone(prefix_end(chr(0x10FFFF)))
+        self.assertIsNone(prefix_end(''))
+
+    def test_prefix_range_holds_only_the_prefix(self):
+        store = MemoryStorage()
+        store.update({key: key for key in ['use', 'user', 'user:1', 'user:2', 'user;', 'users', 'v']})
+
+        self.assertEqual([key for key, _ in store.scan('user:', prefix_end('user:'))], ['user:1', 'user:2'])
+        self.assertEqual([key for key, _ in store.scan('user', prefix_end('user'))], ['user', 'user:1', 'user:2', 'user;', 'users'])
+
+
+class TestScanHandler(unittest.TestCase):
+    def setUp(self):
+        self.node = make_node()
+        self.client = self.node.app.test_client()
+
+        for i in range(25):
+            self.node.kv_store.put('a{0:02d}'.format(i), i)
+        self.node.kv_store.put('b', 'x')
+
+    def scan(self, **params):
+        return self.client.get('/kvs/scan', query_string=params)
+
+    def test_pages_follow_the_cursor_to_the_end(self):
+        keys = []
+        cursor = None
+
+        while True:
+            params = {'prefix': 'a', 'limit': 10}
+            if cursor is not None:
+                params['cursor'] = cursor
+
+            resp = self.scan(**params)
+            self.assertEqual(resp.status_code, 200)
+
+            page = resp.get_json()
+            keys.extend(item['key'] for item in page['items'])
+            cursor = page['cursor']
+
+            if cursor is None:
+                break
+
+        self.assertEqual(keys, ['a{0:02d}'.format(i) for i in range(25)])
+
+    def test_last_full_page_has_no_cursor(self):
+        page = self.scan(start='a15', end='a20', limit=5).get_json()
+
+        self.assertEqual([item['key'] for item in page['items']], ['a15', 'a16', 'a17', 'a18', 'a19'])
+        self.assertIsNone(page['cursor'])
+
+    def test_bad_ranges(self):
+        for params in ({'prefix': 'a', 'start': 'a'}, {'limit': 'ten'}, {'limit': 0},
+                       {'limit': myconstants.SCAN_MAX_LIMIT + 1}):
+            self.assertEqual(self.scan(**params).status_code, 400)
+
+    def stream(self, **params):
+        resp = self.scan(stream='true', **params)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+    def test_stream_ends_with_null_cursor(self):
+        lines = self.stream(prefix='a')
+
+        self.assertEqual([line['key'] for line in lines[:-1]], ['a{0:02d}'.format(i) for i in range(25)])
+        self.assertEqual(lines[-1], {'cursor': None})
+
+    def test_stream_stopped_by_limit_gives_cursor(self):
+        lines = self.stream(limit=3)
+
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], {'cursor': 'a02'})
+
+        lines = self.stream(limit=30, cursor='a02')
+
+        self.assertEqual(lines[0]['key'], 'a03')
+        self.assertEqual(lines[-2]['key'], 'b')
+        self.assertEqual(lines[-1], {'cursor': None})
+
+    def test_stream_reports_unreachable_shard(self):
+        node = make_node('127.0.0.1:13800,127.0.0.1:13801')
+        node.kv_store.put('a', 1)
+        node.forward_scan = lambda *args: None
+
+        resp = node.app.test_client().get('/kvs/scan', query_string={'stream': 'true'})
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+        self.assertIn('error', lines[-1])
+        self.assertNotIn({'cursor': None}, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+"""
+    Unit tests of the storage engines and their ordered key index
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from storage import KeyIndex, MemoryStorage, MmapStorage, MISSING, create_storage
+
+
+class TestKeyIndex(unittest.TestCase):
+    def test_add_remove_keep_keys_sorted(self):
+        index = KeyIndex(chunk_size=4)
+        keys = ['k{0:03d}'.format(i) for i in range(100)]
+        shuffled = list(keys)
+        random.Random(1).shuffle(shuffled)
+
+        for key in shuffled:
+            index.add(key)
+
+        self.assertEqual(index.range(), keys)
+        self.assertEqual(len(index), 100)
+        self.assertTrue(all(len(chunk) <= 8 for chunk in index.chunks))
+
+        for key in shuffled[:60]:
+            index.remove(key)
+
+        self.assertEqual(index.range(), sorted(shuffled[60:]))
+        self.assertEqual(len(index), 40)
+
+    def test_remove_unknown_key(self):
+        index = KeyIndex(chunk_size=4)
+        index.load(['a', 'c'])
+        index.remove('b')
+        index.remove('z')
+
+        self.assertEqual(index.range(), ['a', 'c'])
+        self.assertEqual(len(index), 2)
+
+    def test_range_bounds_and_limit(self):
+        index = KeyIndex(chunk_size=3)
+        index.load(['k{0:02d}'.format(i) for i in range(20)])
+
+        self.assertEqual(index.range('k05', 'k08'), ['k05', 'k06', 'k07'])
+        self.assertEqual(index.range('k04x', 'k06'), ['k05'])
+        self.assertEqual(index.range(None, 'k02'), ['k00', 'k01'])
+        self.assertEqual(index.range('k18'), ['k18', 'k19'])
+        self.assertEqual(index.range('k03', limit=4), ['k03', 'k04', 'k05', 'k06'])
+        self.assertEqual(index.range('z'), [])
+
+
+class TestMemoryStorage(unittest.TestCase):
+    def test_put_get_delete(self):
+        store = MemoryStorage(stripes=4)
+
+        self.assertFalse(store.put('a', 1))
+        self.assertTrue(store.put('a', 2))
+        store.put('b', None)
+
+        self.assertEqual(store.get('a'), 2)
+        self.assertIsNone(store.get('b', MISSING))
+        self.assertIs(store.get('c', MISSING), MISSING)
+        self.assertTrue(store.contains('b'))
+
+        self.assertTrue(store.delete('a'))
+        self.assertFalse(store.delete('a'))
+        self.assertEqual(store.count(), 1)
+        self.assertEqual(store.snapshot(), {'b': None})
+
+    def test_keys_spread_over_stripes(self):
+        store = MemoryStorage(stripes=8)
+        store.update({'k{0}'.format(i): i for i in range(200)})
+
+        self.assertEqual(store.count(), 200)
+        self.assertEqual(sorted(store.keys()), sorted('k{0}'.format(i) for i in range(200)))
+        self.assertGreater(sum(1 for stripe in store.stripes if stripe), 1)
+
+        for i, stripe in enumerate(store.stripes):
+            self.assertTrue(all(store.stripe(key) == i for key in stripe))
+
+    def test_concurrent_writers(self):
+        store = MemoryStorage(stripes=4)
+
+        def writer(n):
+            for i in range(500):
+                store.put('w{0}-{1}'.format(n, i), i)
+                if i % 2:
+                    store.delete('w{0}-{1}'.format(n, i - 1))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(store.count(), 8 * 250)
+        self.assertEqual(len(store.index), store.count())
+        self.assertEqual(store.index.range(), sorted(store.keys()))
+
+    def test_create_storage(self):
+        self.assertIsInstance(create_storage('memory'), MemoryStorage)
+
+        with self.assertRaises(ValueError):
+            create_storage('rocksdb')
+
+
+class TestMmapStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        store = MmapStorage(self.directory, stripes=4, initial_size=4096, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_put_get_delete(self):
+        store = self.open()
+
+        self.assertFalse(store.put('a', {'x': [1, 2]}))
+        self.assertTrue(store.put('a', 'new'))
+        store.put('b', None)
+
+        self.assertEqual(store.get('a'), 'new')
+        self.assertIsNone(store.get('b', MISSING))
+        self.assertTrue(store.delete('a'))
+        self.assertFalse(store.delete('a'))
+        self.assertIs(store.get('a', MISSING), MISSING)
+        self.assertEqual(store.snapshot(), {'b': None})
+        self.assertEqual(store.index.range(), ['b'])
+
+    def test_reopen(self):
+        store = self.open()
+        for i in range(100):
+            store.put('k{0}'.format(i), 'v{0}'.format(i))
+        for i in range(0, 100, 2):
+            store.delete('k{0}'.format(i))
+        store.close()
+
+        store = self.open()
+
+        self.assertEqual(store.count(), 50)
+        self.assertEqual(store.get('k1'), 'v1')
+        self.assertIs(store.get('k2', MISSING), MISSING)
+        self.assertEqual(store.index.range(), sorted('k{0}'.format(i) for i in range(1, 100, 2)))
+
+    def test_torn_last_record_is_dropped(self):
+        store = self.open()
+        store.put('a', 1)
+        store.put('b', 2)
+        tail = store.tail
+        store.close()
+
+        # a crash tore the record of b
+        with open(store.path, 'r+b') as store_file:
+            store_file.seek(tail - 1)
+            store_file.write(b'\xff')
+
+        store = self.open()
+
+        self.assertEqual(store.snapshot(), {'a': 1})
+
+    def test_compaction(self):
+        store = self.open()
+
+        for round_number in range(20):
+            for i in range(50):
+                store.put('k{0}'.format(i), 'v{0}-{1}'.format(i, round_number))
+        store.delete('k0')
+
+        self.assertGreater(store.compactions, 0)
+        self.assertLessEqual(store.tail, 4 * store.live_bytes + 4096)
+        self.assertEqual(store.get('k1'), 'v1-19')
+        store.close()
+
+        store = self.open()
+
+        self.assertEqual(store.count(), 49)
+        self.assertEqual(store.get('k49'), 'v49-19')
+        self.assertFalse(os.path.exists(store.path + '.compact'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+    Unit tests of the write-ahead log
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'distributed_kvs'))
+
+from wal import WriteAheadLog
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wals = []
+
+    def tearDown(self):
+        for wal in self.wals:
+            wal.close()
+
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        wal = WriteAheadLog(self.directory, **kwargs)
+        snapshot, records = wal.open()
+        records = list(records)
+        wal.start()
+        self.wals.append(wal)
+        return wal, snapshot, records
+
+    def test_group_commit(self):
+        wal, _, _ = self.open(group_commit_delay=0.02)
+
+        def writer(n):
+            for i in range(20):
+                wal.wait(wal.append({'writer': n, 'i': i}))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = wal.stats()
+        wal.close()
+
+        self.assertEqual(stats['durable'], 160)
+        self.assertLess(stats['fsyncs'], 160)
+        self.assertGreater(stats['records-per-fsync'], 1)
+
+        _, _, records = self.open()
+        self.assertEqual(len(records), 160)
+        for n in range(8):
+            self.assertEqual([r['i'] for r in records if r['writer'] == n], list(range(20)))
+
+    def test_snapshot_replaces_older_segments(self):
+        wal, _, _ = self.open(group_commit_delay=0)
+
+        for i in range(5):
+            wal.append({'i': i})
+        segment = wal.rotate()
+        for i in range(5, 8):
+            wal.append({'i': i})
+
+        wal.write_snapshot({'state': list(range(5))}, segment)
+        wal.sync()
+        wal.close()
+
+        self.assertEqual(wal.segments(), [segment])
+
+        _, snapshot, records = self.open()
+        self.assertEqual(snapshot['state'], list(range(5)))
+        self.assertEqual([r['i'] for r in records], [5, 6, 7])
+
+    def test_checkpoint_after_snapshot_records(self):
+        taken = threading.Event()
+        wal, _, _ = self.open(checkpoint=taken.set, snapshot_records=10, group_commit_delay=0)
+
+        for i in range(10):
+            wal.append({'i': i})
+        wal.sync()
+
+        self.assertTrue(taken.wait(2))
+        wal.close()
+
+    def test_recovery_after_truncation(self):
+        wal, _, _ = self.open(group_commit_delay=0)
+        for i in range(10):
+            wal.append({'i': i})
+        wal.sync()
+        wal.close()
+
+        # a crash tore the last record
+        path = wal.segment_path(wal.segments()[-1])
+        with open(path, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(path) - 4)
+
+        wal, _, records = self.open(group_commit_delay=0)
+        self.assertEqual([r['i'] for r in records], list(range(9)))
+
+        # new records go to a new segment, not after the torn one
+        wal.append({'i': 'new'})
+        wal.sync()
+        wal.close()
+
+        _, _, records = self.open()
+        self.assertEqual([r['i'] for r in records], list(range(9)) + ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()